@@ -1,23 +1,47 @@
+import asyncio
 import hashlib
+from collections import Counter
 from itertools import chain
 import hmac
-import json
-from json import JSONEncoder
-from typing import List
+import os
+import re
+import secrets
+import time
+import uuid
+from functools import partial
+from typing import Dict, Iterable, List, Set, Tuple
 from dataclasses import dataclass, field
+from datetime import datetime, timezone
 
 import jinja2
-from aiohttp.web import Response
+from aiohttp.web import Response, StreamResponse
 from maubot import MessageEvent, Plugin
 from maubot.handlers import command
+from mautrix.util.async_db import Database
 from mautrix.client.api.events import EventMethods
 from mautrix.client.api.rooms import RoomMethods
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
 from pathlib import Path
-
-from .matrix_utils import MatrixUtils, UserInfo, validate_matrix_id
-from .pretix import Pretix, AttendeeMatrixInformation
+from urllib.parse import urlencode, urlparse, parse_qs
+
+from . import jsonutil
+from .attendee_index import AttendeeIndex, normalize_matrix_id
+from .catalog import ItemCatalog, ticket_id
+from .health import HealthChecks, probe_event, probe_pretix_auth, probe_room_permissions
+from .export import export_attendees
+from .matrix_utils import MatrixUtils, UserInfo
+from .pretix import Pretix, PretixPool, AttendeeMatrixInformation, WEBHOOK_ACTIONS
+from .ratelimit import get_rate_limiter
+from .provision import plan_rooms, provision_rooms
+from .reconcile import Reconciler
+from .logutil import SampledLogger
+from .scheduler import PriorityScheduler, INTERACTIVE, BULK
+from .singleflight import SingleFlight, KeyedLocks
+from .watchdog import LoopWatchdog
+from .retry import RetryQueue, RetryScheduler, RetryEntry
+from .shared_state import SharedState, upgrade_table as shared_state_upgrade_table
+from .snapshot import CacheSnapshot, SnapshotWriter
 # ACCEPTED_TOPICS = ["issue.new", "git.receive", "pull-request.new"]
 
 NL = "      \n"
@@ -29,16 +53,62 @@ class Config(BaseProxyConfig):
         helper.copy("pretix_client_secret")
         helper.copy("pretix_redirect_url")
         helper.copy("allowlist")
+        helper.copy("pretix_instances")
+        helper.copy("pretix_pool_size")
+        helper.copy("pretix_rate_limit")
+        helper.copy("pretix_rate_burst")
+        helper.copy("pretix_max_retries")
+        helper.copy("pretix_max_retry_after")
+        helper.copy("pretix_circuit_threshold")
+        helper.copy("pretix_circuit_reset")
+        helper.copy("questions")
+        helper.copy("event_questions")
+        helper.copy("shared_state_url")
+        helper.copy("shared_job_lease")
+        helper.copy("attendee_power_level")
+        helper.copy("room_state_cache_ttl")
+        helper.copy("provision_visibility")
+        helper.copy("provision_concurrency")
+        helper.copy("reconcile_interval")
+        helper.copy("reconcile_jitter")
+        helper.copy("reconcile_concurrency")
+        helper.copy("retry_interval")
+        helper.copy("retry_base_delay")
+        helper.copy("retry_max_delay")
+        helper.copy("retry_max_attempts")
+        helper.copy("export_secret")
+        helper.copy("export_link_ttl")
+        helper.copy("loop_watchdog")
+        helper.copy("loop_stall_threshold")
+        helper.copy("log_sample_every")
+        helper.copy("scheduler_capacity")
+        helper.copy("scheduler_bulk_limit")
+        helper.copy("bulk_chunk_size")
+        helper.copy("webhook_capture_path")
+        helper.copy("item_catalog_ttl")
+        helper.copy("item_catalog_failure_ttl")
+        helper.copy("snapshot_interval")
+        helper.copy("snapshot_max_age")
+        helper.copy("health_check_ttl")
+        helper.copy("health_check_timeout")
 
 @dataclass(frozen=True)
 class FilterConditions:
-    item: str = None
-    variant: str = None
+    item: int = None
+    variant: int = None
+
+    def __post_init__(self):
+        # pretix IDs are ints, but arrive as strings from commands and older mapping files
+        object.__setattr__(self, "item", ticket_id(self.item))
+        object.__setattr__(self, "variant", ticket_id(self.variant))
 
     @classmethod
     def from_json(cls, json_data: dict):
         return cls(json_data.get("item"), json_data.get("variant"))
 
+    def to_json(self) -> dict:
+        return {"item": self.item, "variant": self.variant}
+
     def __str__(self):
         text = []
         if self.item is not None:
@@ -58,6 +128,8 @@ class Room:
     def from_json(cls, json_data: dict):
         return cls(json_data["matrix_id"], FilterConditions.from_json(json_data["condition"]))
 
+    def to_json(self) -> dict:
+        return {"matrix_id": self.matrix_id, "condition": self.condition.to_json()}
 
     @property
     def has_filter(self):
@@ -76,20 +148,6 @@ class Room:
         else:
             return False
 
-class RoomEncoder(JSONEncoder):
-    def default(self, o):
-        if isinstance(o, set):
-            return list(o)
-        
-        return o.__dict__
-
-def decode_hook(obj):
-    if isinstance(obj, dict):
-        if 'matrix_id' in obj.keys():
-            return Room.from_json(obj)
-    return obj
-        
-
 @dataclass
 class EventRooms:
     _mapping: dict = field(default_factory=lambda: {})
@@ -100,8 +158,12 @@ class EventRooms:
     def persistfile(self):
         return self.persist_path.joinpath(self.persist_filename)
 
-    def persist(self):        
-        self.persistfile.write_text(json.dumps(self._mapping, cls=RoomEncoder), encoding="utf8")
+    def persist(self):
+        data = {
+            organizer: {event: [room.to_json() for room in rooms] for event, rooms in events.items()}
+            for organizer, events in self._mapping.items()
+        }
+        self.persistfile.write_text(jsonutil.dumps(data), encoding="utf8")
     
     @classmethod
     def from_path(cls, persist_path=Path("."), persist_filename="event_rooms.json"):
@@ -112,16 +174,38 @@ class EventRooms:
         if not persistfile.exists():
             print("persist file doesnt exist, creating fresh room map")
             return cls(persist_filename=persist_filename, persist_path=persist_path)
-        data = persistfile.read_text(encoding="utf8")
+        data = jsonutil.loads(persistfile.read_bytes())
 
-        mapping = json.loads(data, object_hook=decode_hook)
+        mapping = {
+            organizer: {event: set(Room.from_json(room) for room in rooms) for event, rooms in events.items()}
+            for organizer, events in data.items()
+        }
 
-        for organizer, events in mapping.items():
-            for event, rooms in events.items():
-                mapping[organizer][event] = set(rooms)
-            
         return cls(mapping, persist_filename=persist_filename, persist_path=persist_path)
 
+    def entries(self) -> Set[Tuple[str, str, Room]]:
+        """every (organizer, event, room) of the mapping"""
+        return {
+            (organizer, event, room)
+            for organizer, events in self._mapping.items() for event, rooms in events.items() for room in rooms
+        }
+
+    def replace(self, entries:Iterable[Tuple[str, str, Room]]) -> bool:
+        """replace the whole mapping, e.g. with the one shared between replicas
+
+        Returns:
+            bool: whether the mapping changed. It is only written to disk if it did
+        """
+        entries = set(entries)
+        if entries == self.entries():
+            return False
+        mapping = {}
+        for organizer, event, room in entries:
+            mapping.setdefault(organizer, {}).setdefault(event, set()).add(room)
+        self._mapping = mapping
+        self.persist()
+        return True
+
     def rooms_by_event(self, organizer:str, event:str):
         if self._mapping.get(organizer) is None:
             return set()
@@ -131,10 +215,30 @@ class EventRooms:
         
         return self._mapping[organizer].get(event)
 
-    def rooms_by_ticket_variant(self, organizer:str, event:str, item_id:str, variant_id:str):
-        item_id = str(item_id)
-        variant_id = str(variant_id)
-        
+    def ticket_filter(self, organizer:str, event:str):
+        """return the item and variation that every room of an event is filtered on
+
+        Returns:
+            FilterConditions: the shared filter, or an empty filter if any room
+                accepts other tickets as well
+        """
+        conditions = set(r.condition for r in self.rooms_by_event(organizer, event))
+        if len(conditions) != 1:
+            return FilterConditions()
+        return conditions.pop()
+
+    def events(self):
+        """iterate over every (organizer, event) pair that has at least one room mapped to it"""
+        for organizer, events in self._mapping.items():
+            for event, rooms in events.items():
+                if len(rooms) > 0:
+                    yield (organizer, event)
+
+    def rooms(self):
+        """return the IDs (or aliases) of every mapped room"""
+        return {room.matrix_id for events in self._mapping.values() for rooms in events.values() for room in rooms}
+
+    def rooms_by_ticket_variant(self, organizer:str, event:str, item_id:int, variant_id:int):
         event_rooms = self.rooms_by_event(organizer, event)
 
         rooms_matching_filter = filter(lambda r: r.matches(item_id, variant_id), event_rooms)
@@ -164,11 +268,12 @@ class EventRooms:
     def room_is_mapped(self, room:str):
         return len(self.events_for_room(Room(room))) > 0
 
-    def events_for_room(self, room_to_find:Room):
+    def events_for_room(self, room_to_find:Room, catalog:ItemCatalog=None):
         """return a list of events that a room is mapped to in "organizer/event" format
 
         Args:
             room (str): the id of the room to return events for
+            catalog (ItemCatalog, Optional): cached ticket names to show next to the filter IDs
 
         Returns:
             List[str]: the list of events the room is part of
@@ -181,7 +286,10 @@ class EventRooms:
                         orgEventName = f"{organizer}/{event}"
                         if room.has_filter:
                             orgEventName += " "
-                            orgEventName += str(room.condition)
+                            if catalog is not None:
+                                orgEventName += catalog.describe(organizer, event, room.condition)
+                            else:
+                                orgEventName += str(room.condition)
                         events.append(orgEventName)
         return events
     
@@ -200,38 +308,311 @@ class EventManagement(Plugin):
         return Config
 
     async def start(self):
+        started = time.monotonic()
         self.config.load_and_update()
         self.room_methods = RoomMethods(api=self.client.api)
         self.event_methods = EventMethods(api=self.client.api)
-        self.matrix_utils = MatrixUtils(self.client.api, self.log)
+        self.matrix_utils = MatrixUtils(
+            self.client.api,
+            self.log,
+            state_cache_ttl=self.config["room_state_cache_ttl"],
+            log_sample_every=self.config["log_sample_every"],
+        )
+        self.build_components()
+        if self.config["loop_watchdog"]:
+            self.watchdog.start()
 
-        # if in container
-        maubot_base_location = Path("/data")
-        if not maubot_base_location.exists():
-            # Fedora dev environment
-            maubot_base_location = Path("/var/lib/maubot/")
-        
-        # if it still doesnt exist
-        if not maubot_base_location.exists():
-            # fall back to the default supplied by pretix class (current directory)
-            maubot_base_location = None
+        # register the webhook right away so plugin reloads dont wait for the mapping and tokens to load
+        self.webapp.add_route("POST", "/notify", self.handle_pretix_webhook)
+        self.log.info(f"Webhook URL is: {self.webapp_url}notify") 
+        self.webapp.add_route("GET", "/export", self.handle_export)
+        # export links are signed with this key. Without a configured secret they stop working on restart
+        self.export_key = (self.config["export_secret"] or secrets.token_hex(32)).encode()
+
+        # TODO: add /auth route
 
-        self.room_mapping = EventRooms.from_path(persist_path=maubot_base_location)
+        self._startup_task = asyncio.create_task(self._load())
+        self.log.info(f"startup: registered handlers in {time.monotonic() - started:.3f}s, loading state in the background")
 
+    def build_components(self):
+        """create the in-memory helpers of the bot from its configuration
 
-        self.pretix = Pretix(
-            self.config["pretix_client_id"],
-            self.config["pretix_client_secret"],
-            self.config["pretix_redirect_url"],
+        The state loaded from disk is connected later by wire_state. Called by start, and by
+        build_plugin (see standalone.py) for the replay tool and tests.
+        """
+        # messages logged once per attendee only let every n-th one through
+        self.attendee_log = SampledLogger(self.log, every=self.config["log_sample_every"])
+        self.metrics = Counter()
+        # identical requests in flight at the same time are only sent once
+        self.inflight = SingleFlight()
+        self.order_locks = KeyedLocks()
+        # item and variation names of each event, so commands dont have to ask pretix
+        self.catalog = ItemCatalog(self.log, ttl=self.config["item_catalog_ttl"], prepare=self.sync_pretix_token,
+                                   failure_ttl=self.config["item_catalog_failure_ttl"])
+        # results of the checks behind !status, so it can be asked often
+        self.health = HealthChecks(
+            self.log, ttl=self.config["health_check_ttl"], timeout=self.config["health_check_timeout"]
+        )
+        # live webhooks go before batch invites, reconciliation and retries
+        self.scheduler = PriorityScheduler(
+            capacity=self.config["scheduler_capacity"], bulk_limit=self.config["scheduler_bulk_limit"]
+        )
+        self.watchdog = LoopWatchdog(self.log, threshold=self.config["loop_stall_threshold"])
+
+        # everything below is loaded in the background, handlers wait for this
+        self.ready = asyncio.Event()
+        self.startup_error = None
+        self.room_mapping = None
+        self.pretix_pool = None
+        self.shared_state = None
+        self.reconciler = None
+        self.retry_scheduler = None
+        self.attendee_index = None
+        self.snapshot_writer = None
+
+    def wire_state(self, room_mapping:EventRooms, pretix_pool:PretixPool, attendee_index:AttendeeIndex,
+                   retry_queue:RetryQueue, shared_state:SharedState=None):
+        """connect the loaded state to the background jobs that use it, without starting them"""
+        self.room_mapping = room_mapping
+        self.pretix_pool = pretix_pool
+        self.attendee_index = attendee_index
+        self.shared_state = shared_state
+        if shared_state is not None:
+            for pretix in pretix_pool:
+                shared_state.share_tokens_of(pretix)
+        self.reconciler = Reconciler(
+            pretix_pool.for_organizer,
+            room_mapping,
+            self.invite_in_bulk,
+            self.log,
+            interval=self.config["reconcile_interval"],
+            jitter=self.config["reconcile_jitter"],
+            concurrency=self.config["reconcile_concurrency"],
+            shared_state=shared_state,
+            scheduler=self.scheduler,
+            rooms_for=self.rooms_for_attendee,
+            refresh_mapping=self.sync_room_mapping,
+        )
+        self.retry_scheduler = RetryScheduler(
+            retry_queue,
+            self.retry_invite,
             self.log,
-            token_storage_path=maubot_base_location,
-            instance_url=self.config["pretix_instance_url"],
+            on_success=self.retry_succeeded,
+            interval=self.config["retry_interval"],
+            base_delay=self.config["retry_base_delay"],
+            max_delay=self.config["retry_max_delay"],
+            max_attempts=self.config["retry_max_attempts"],
         )
 
-        self.webapp.add_route("POST", "/notify", self.handle_pretix_webhook)
-        self.log.info(f"Webhook URL is: {self.webapp_url}notify") 
+    async def _load(self):
+        """load the room mapping, pretix clients and background jobs, then mark the plugin as ready"""
+        started = time.monotonic()
+        phase_started = started
 
-        # TODO: add /auth route
+        def phase_done(phase):
+            nonlocal phase_started
+            now = time.monotonic()
+            self.log.info(f"startup: {phase} took {now - phase_started:.3f}s")
+            phase_started = now
+
+        try:
+            # if in container
+            maubot_base_location = Path("/data")
+            if not maubot_base_location.exists():
+                # Fedora dev environment
+                maubot_base_location = Path("/var/lib/maubot/")
+            
+            # if it still doesnt exist
+            if not maubot_base_location.exists():
+                # fall back to the default supplied by pretix class (current directory)
+                maubot_base_location = None
+
+            # reading and parsing files is kept off the event loop
+            loop = asyncio.get_running_loop()
+            room_mapping = await loop.run_in_executor(
+                None, partial(EventRooms.from_path, persist_path=maubot_base_location)
+            )
+            phase_done("loading the room mapping")
+
+            pretix_pool = await loop.run_in_executor(None, self._create_pretix_pool, maubot_base_location)
+            phase_done(f"loading {len(pretix_pool)} pretix clients")
+
+            shared_state = None
+            if self.config["shared_state_url"]:
+                shared_state = SharedState(
+                    Database.create(
+                        self.config["shared_state_url"],
+                        upgrade_table=shared_state_upgrade_table,
+                        log=self.log.getChild("shared_state"),
+                    ),
+                    self.log,
+                    owner=f"{self.id}-{uuid.uuid4().hex}",
+                )
+                await shared_state.start()
+                self.log.info("shared state mode is enabled")
+                phase_done("connecting to the shared state database")
+
+            attendee_index = await loop.run_in_executor(
+                None, self._load_instance_state, AttendeeIndex, maubot_base_location, "attendee_index.json"
+            )
+            retry_queue = await loop.run_in_executor(
+                None, self._load_instance_state, RetryQueue, maubot_base_location, "invite_retries.json"
+            )
+            self.wire_state(room_mapping, pretix_pool, attendee_index, retry_queue, shared_state)
+            if shared_state is not None:
+                if len(await shared_state.mapped_rooms()) == 0:
+                    # the first replica to use the shared state brings its room mapping along
+                    await self.share_room_mapping(set())
+                else:
+                    await self.sync_room_mapping()
+            phase_done("loading the attendee index and retry queue")
+
+            snapshot_filename = await loop.run_in_executor(
+                None, self._instance_filename, maubot_base_location, "cache_snapshot.json"
+            )
+            try:
+                snapshot = await loop.run_in_executor(None, partial(
+                    CacheSnapshot.from_path, persist_path=maubot_base_location, persist_filename=snapshot_filename
+                ))
+                self.restore_snapshot(snapshot)
+            except Exception as e:
+                # the caches are only a head start, the bot works fine without them
+                self.log.warning(f"could not restore the cache snapshot: {e}")
+            self.snapshot_writer = SnapshotWriter(
+                partial(self.take_snapshot, maubot_base_location, snapshot_filename),
+                self.log, interval=self.config["snapshot_interval"]
+            )
+            self.snapshot_writer.start()
+            phase_done("restoring the cache snapshot")
+
+            self.reconciler.start()
+            self.retry_scheduler.start()
+            phase_done("starting background jobs")
+        except Exception as e:
+            self.startup_error = e
+            self.log.exception(f"startup failed: {e}")
+        else:
+            self.log.info(f"startup: ready after {time.monotonic() - started:.3f}s")
+        finally:
+            self.ready.set()
+
+    def _instance_filename(self, persist_path:Path, filename:str) -> str:
+        """the name of a state file only this plugin instance writes to, e.g. attendee_index-<instance id>.json
+
+        Several instances of the plugin can share one data directory. A file written by an older
+        version, without the instance ID in its name, is taken over by the first instance that starts.
+        """
+        stem, suffix = filename.rsplit(".", 1)
+        name = f"{stem}-{re.sub(r'[^A-Za-z0-9._-]', '_', self.id)}.{suffix}"
+        persist_path = persist_path or Path(".")
+        legacy = persist_path.joinpath(filename)
+        if legacy.exists() and not persist_path.joinpath(name).exists():
+            os.replace(legacy, persist_path.joinpath(name))
+        return name
+
+    def _load_instance_state(self, cls, persist_path:Path, filename:str):
+        """read state that belongs to this plugin instance, see _instance_filename. This reads files"""
+        return cls.from_path(persist_path=persist_path, persist_filename=self._instance_filename(persist_path, filename))
+
+    def take_snapshot(self, persist_path:Path=None, persist_filename:str="cache_snapshot.json") -> CacheSnapshot:
+        """collect the caches worth keeping across a restart"""
+        aliases, members = self.matrix_utils.export_caches()
+        processed = {pretix.host: pretix.processed_codes() for pretix in self.pretix_pool}
+        rooms = {pretix.host: pretix.room_progress() for pretix in self.pretix_pool}
+        return CacheSnapshot(aliases, members, processed, rooms, self.reconciler.watermarks(),
+                             persist_path=persist_path or Path("."), persist_filename=persist_filename)
+
+    def restore_snapshot(self, snapshot:CacheSnapshot):
+        """restore the caches from a snapshot written before the last restart
+
+        Processed orders, the rooms of partly processed ones and the point each event was last
+        reconciled at are always restored. Aliases and room memberships only if the
+        snapshot is younger than `snapshot_max_age`, and they are checked again the first
+        time they are used.
+        """
+        for pretix in self.pretix_pool:
+            pretix.mark_codes_as_processed(snapshot.processed.get(pretix.host, []))
+            pretix.restore_room_progress(snapshot.rooms.get(pretix.host, {}))
+        # an old watermark only makes the next sweep fetch more orders than needed
+        self.reconciler.restore_watermarks(snapshot.reconciled)
+        if snapshot.age > self.config["snapshot_max_age"]:
+            self.log.info(f"cache snapshot is {int(snapshot.age)}s old, only restoring processed orders")
+            return
+        self.matrix_utils.restore_caches(snapshot.aliases, snapshot.members)
+        self.log.info(f"restored {len(snapshot.aliases)} aliases and {len(snapshot.members)} member lists "
+                      f"from the cache snapshot")
+
+    def _create_pretix_pool(self, maubot_base_location:Path) -> PretixPool:
+        """create the clients for every configured pretix instance. This reads their token files"""
+        pretix_pool = PretixPool(self.log)
+        instances = [{
+            "url": self.config["pretix_instance_url"],
+            "client_id": self.config["pretix_client_id"],
+            "client_secret": self.config["pretix_client_secret"],
+        }] + (self.config["pretix_instances"] or [])
+
+        for index, instance in enumerate(instances):
+            instance_url = instance["url"]
+            # the default instance keeps the original token file name
+            token_filename = "pretix-token.json"
+            if index > 0:
+                token_filename = f"pretix-token-{urlparse(instance_url).netloc.replace(':', '_')}.json"
+            client = Pretix(
+                instance["client_id"],
+                instance["client_secret"],
+                instance.get("redirect_url", self.config["pretix_redirect_url"]),
+                self.log,
+                token_storage_path=maubot_base_location,
+                token_storage_filename=token_filename,
+                instance_url=instance_url,
+                rate_limiter=get_rate_limiter(
+                    instance_url,
+                    rate=instance.get("rate_limit", self.config["pretix_rate_limit"]),
+                    burst=instance.get("rate_burst", self.config["pretix_rate_burst"]),
+                    max_retries=self.config["pretix_max_retries"],
+                    max_retry_after=self.config["pretix_max_retry_after"],
+                    failure_threshold=self.config["pretix_circuit_threshold"],
+                    reset_timeout=self.config["pretix_circuit_reset"],
+                ),
+                pool_size=self.config["pretix_pool_size"],
+            )
+            client.configure_questions(self.config["questions"], self.config["event_questions"])
+            pretix_pool.add(client, organizers=instance.get("organizers"))
+        return pretix_pool
+
+    async def wait_until_ready(self, evt: MessageEvent = None) -> bool:
+        """wait for the background part of the startup to finish
+
+        Args:
+            evt (MessageEvent, optional): a command to reply to if the startup failed
+
+        Returns:
+            bool: whether the plugin started successfully
+        """
+        await self.ready.wait()
+        if self.startup_error is not None and evt is not None:
+            await evt.reply(f"the bot failed to start ({self.startup_error}), please check its logs")
+        return self.startup_error is None
+
+    async def stop(self):
+        self._startup_task.cancel()
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.stop()
+            try:
+                await self.snapshot_writer.write()
+            except Exception as e:
+                self.log.warning(f"could not write the cache snapshot: {e}")
+        if self.attendee_index is not None:
+            await self.attendee_index.flush()
+        if self.retry_scheduler is not None:
+            await self.retry_scheduler.queue.flush()
+        if self.reconciler is not None:
+            self.reconciler.stop()
+        if self.retry_scheduler is not None:
+            self.retry_scheduler.stop()
+        self.watchdog.stop()
+        if self.shared_state is not None:
+            await self.shared_state.stop()
 
     def _get_handler_commands(self):
         for cmd, _ignore in chain(*self.client.event_handlers.values()):
@@ -243,71 +624,296 @@ class EventManagement(Plugin):
             yield cmd
 
     async def handle_pretix_webhook(self, request):
-        json = await request.json()
-        
+        self.watchdog.mark("webhook")
+        json = await request.json(loads=jsonutil.loads)
+        self.metrics["webhooks_received"] += 1
+        if self.config["webhook_capture_path"]:
+            await self.capture_webhook(request, json)
+
+        # drop notifications that cant lead to an invite before doing any network I/O
+        if json.get("action") not in WEBHOOK_ACTIONS:
+            self.metrics["webhooks_skipped_action"] += 1
+            self.log.debug("ignoring webhook %s with action %s", json.get("notification_id"), json.get("action"))
+            return Response()
+        if not await self.wait_until_ready():
+            # let pretix deliver the webhook again later
+            return Response(status=503)
+        # the event may have been mapped on another replica
+        await self.sync_room_mapping()
+        if len(self.room_mapping.rooms_by_event(json.get("organizer"), json.get("event"))) == 0:
+            self.metrics["webhooks_skipped_unmapped"] += 1
+            self.log.debug("ignoring webhook %s, no rooms are mapped to %s/%s",
+                           json.get("notification_id"), json.get("organizer"), json.get("event"))
+            return Response()
+
+        # webhooks dont say which instance they come from, so the instance can be
+        # given in the webhook URL (?instance=<host>), otherwise its looked up by organizer
+        pretix = self.pretix_pool.get(request.query.get("instance"))
+        if pretix is None:
+            pretix = self.pretix_pool.for_organizer(json.get("organizer"))
+
+        if self.shared_state is None:
+            await self._process_webhook(pretix, json)
+            return Response()
+
+        # with several replicas, only the one that claims a webhook processes it
+        job_key = f"{json.get('organizer')}/{json.get('event')}/{json.get('code')}/{json.get('action')}"
+        if not await self.shared_state.claim_job(job_key, self.config["shared_job_lease"]):
+            self.log.debug("webhook %s is handled by another replica", job_key)
+            return Response()
+        try:
+            await self.shared_state.sync_token(pretix)
+            if await self.shared_state.is_processed(json.get("organizer"), json.get("event"), json.get("code")):
+                pretix.mark_codes_as_processed([json.get("code")])
+            else:
+                # rooms another replica already finished for this order are skipped
+                pretix.restore_room_progress({json.get("code"): await self.shared_state.room_progress(
+                    json.get("organizer"), json.get("event"), json.get("code")
+                )})
+            await self._process_webhook(pretix, json)
+        except Exception:
+            # let pretix redeliver the webhook to any replica
+            await self.shared_state.release_job(job_key)
+            raise
+        await self.shared_state.complete_job(job_key)
+        # Pretix:  If you successfully received a webhook call, your endpoint
+        # should return a HTTP status code between 200 and 299.
+        # If any other status code is returned, we will assume you did not receive the call.
+        return Response()
+
+    async def sync_room_mapping(self):
+        """pick up rooms mapped (or unmapped) on other replicas. Without shared state this does nothing"""
+        if self.shared_state is None:
+            return
+        entries = {
+            (organizer, event, Room.from_json(jsonutil.loads(room)))
+            for organizer, event, room in await self.shared_state.mapped_rooms()
+        }
+        if self.room_mapping.replace(entries):
+            self.log.debug("picked up changes to the room mapping from other replicas")
+
+    async def share_room_mapping(self, before:Set[Tuple[str, str, Room]]):
+        """apply the changes made to the room mapping since `before` (see EventRooms.entries) to the shared mapping"""
+        if self.shared_state is None:
+            return
+        after = self.room_mapping.entries()
+        await self.shared_state.update_mapped_rooms(
+            added=[(o, e, jsonutil.dumps(room.to_json())) for o, e, room in after - before],
+            removed=[(o, e, jsonutil.dumps(room.to_json())) for o, e, room in before - after],
+        )
+
+    async def sync_pretix_token(self, pretix:Pretix):
+        """pick up (or refresh) the token shared between replicas before talking to pretix
+
+        In shared mode, clients do not refresh expired tokens by themselves, so every path
+        that talks to pretix calls this first. Without shared state this does nothing.
+        """
+        if self.shared_state is not None:
+            await self.shared_state.sync_token(pretix)
+
+    def rooms_for_attendee(self, organizer:str, event:str, attendee:AttendeeMatrixInformation) -> List[str]:
+        """find the rooms an attendee should be invited to, based on their ticket
+
+        Falls back to all rooms of the event if none of them match the ticket.
+
+        Returns:
+            List[str]: the IDs or aliases of the rooms
+        """
+        # the ticket of the order was fetched together with the answers
+        item_id = attendee.extra.get("Item ID")
+        variant_id = attendee.extra.get("Variation ID")
+
+        rms = self.room_mapping.rooms_by_ticket_variant(organizer, event, item_id, variant_id)
+        self.log.debug("rooms matching the ticket: %s", rms)
+
+        if len(rms) == 0:
+            self.log.debug("falling back to eventwide check")
+            rms = self.room_mapping.rooms_by_event(organizer, event)
+            self.log.debug("rooms of the event: %s", rms)
+        return [r.matrix_id for r in rms]
+
+    async def capture_webhook(self, request, json:dict):
+        """append a received webhook to the capture file, to be replayed with `python -m event_helper.replay`"""
+        line = jsonutil.dumps({"received_at": time.time(), "query": dict(request.query), "body": json}) + "\n"
+
+        def append():
+            with open(self.config["webhook_capture_path"], "a", encoding="utf8") as capture:
+                capture.write(line)
+
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, append)
+        except OSError as e:
+            self.log.warning("could not capture webhook: %s", e)
+
+    def _export_signature(self, host:str, organizer:str, event:str, expires:int) -> str:
+        message = f"{host}/{organizer}/{event}/{expires}".encode()
+        return hmac.new(self.export_key, message, hashlib.sha256).hexdigest()
+
+    def export_link(self, pretix:Pretix, organizer:str, event:str) -> str:
+        """create a signed, expiring link to the CSV export of an event"""
+        expires = int(time.time()) + self.config["export_link_ttl"]
+        query = urlencode({
+            "instance": pretix.host,
+            "organizer": organizer,
+            "event": event,
+            "expires": expires,
+            "signature": self._export_signature(pretix.host, organizer, event, expires),
+        })
+        return f"{self.webapp_url}export?{query}"
+
+    async def handle_export(self, request):
+        """stream the attendees of an event as CSV to the holder of a link created by !export"""
+        self.watchdog.mark("export")
+        query = request.query
+        host, organizer, event = query.get("instance", ""), query.get("organizer", ""), query.get("event", "")
+        try:
+            expires = int(query.get("expires", ""))
+        except ValueError:
+            return Response(status=400, text="invalid export link")
+        expected = self._export_signature(host, organizer, event, expires)
+        if not hmac.compare_digest(expected, query.get("signature", "")):
+            return Response(status=403, text="invalid export link")
+        if expires < time.time():
+            return Response(status=403, text="this export link has expired, please request a new one")
+        if not await self.wait_until_ready():
+            return Response(status=503)
+        pretix = self.pretix_pool.get(host)
+        if pretix is None:
+            return Response(status=404, text="unknown pretix instance")
+        await self.sync_pretix_token(pretix)
+
+        # mapped room -> room ID, filled while looking up memberships
+        room_ids = {}
+
+        async def membership_for(room):
+            room_ids[room] = await self.resolve_room(room)
+            return await self.matrix_utils.get_room_membership(room_ids[room])
+
+        def invited_before(matrix_id, room):
+            return self.attendee_index.is_invited(matrix_id, room_ids.get(room, room))
+
+        response = StreamResponse(headers={
+            "Content-Type": "text/csv; charset=utf-8",
+            "Content-Disposition": f'attachment; filename="{organizer}-{event}-attendees.csv"',
+        })
+        await response.prepare(request)
+        # the response has already started, so errors can only cut the export short
+        try:
+            async for chunk in export_attendees(
+                pretix, organizer, event,
+                lambda attendee: self.rooms_for_attendee(organizer, event, attendee),
+                membership_for,
+                self.retry_scheduler.queue,
+                self.log,
+                invited_before=invited_before,
+            ):
+                await response.write(chunk.encode("utf8"))
+        except Exception as e:
+            self.log.exception(f"export of {organizer}/{event} failed: {e}")
+        await response.write_eof()
+        return response
+
+    async def _process_webhook(self, pretix:Pretix, json:dict):
+        async with self.scheduler.slot(INTERACTIVE):
+            await self._fetch_and_invite(pretix, json)
+
+    async def _fetch_and_invite(self, pretix:Pretix, json:dict):
+        self.watchdog.mark("webhook: fetching the order from pretix")
+        code = json.get("code")
+        # redeliveries of an order that arrive at the same time share one request to pretix.
         # this checks whether the webhook type is correct
-        success, result_dict = self.pretix.handle_incoming_webhook(json)
+        loop = asyncio.get_running_loop()
+        success, result_dict = await self.inflight.do(
+            ("order", pretix.host, json.get("organizer"), json.get("event"), code),
+            lambda: loop.run_in_executor(None, pretix.handle_incoming_webhook, json),
+        )
 
         if not success:
-            self.log.info(result_dict.get("error"))
-            self.log.debug(result_dict.get("debug"))
+            self.log.info("%s", result_dict.get("error"))
+            self.log.debug("%s", result_dict.get("debug"))
+            return
 
         # this assumes we are only really processing one new attendee at a time
         organizer = result_dict.get("organizer")
         event = result_dict.get("event")
         attendees = result_dict.get("data")
-        # order may already be processed (because im messing with it), so this may be empty
+        if len(attendees) == 0:
+            self.log.info("webhook for order %s did not contain any attendees", code)
+            return
+
+        # one order is processed at a time, so two deliveries cant both invite its attendees
+        async with self.order_locks.hold((organizer, event, code)):
+            if pretix.is_processed(code):
+                self.log.debug("order %s was processed by another delivery of this webhook", code)
+                return
+            await self._invite_order(pretix, organizer, event, attendees)
+
+    async def _invite_order(self, pretix:Pretix, organizer:str, event:str, attendees:List[AttendeeMatrixInformation]):
         order_id = attendees[0].order_code
         matrix_id = attendees[0].matrix_id
-        order = self.pretix.fetch_orders(organizer, event, order_code=order_id)
-        room_ids = []
-        try:
-            position = order[0].get("positions")[0]
-            item_id = position.get("item")
-            variant_id = position.get("variation")
 
-            rms = self.room_mapping.rooms_by_ticket_variant(organizer, event, item_id, variant_id)
-            self.log.debug(rms)
-            room_ids = [r.matrix_id for r in rms]
-        except Exception as e:
-            self.log.error(f"failed to find room for event {event} from organizer {organizer} with order {order_id}: {e}\n\tTrying without ticket variant")
-            rms = self.room_mapping.rooms_by_event(organizer, event)
-            self.log.debug(rms)
-            room_ids = [r.matrix_id for r in rms]
+        # pick up tickets that were added to the event since its catalog was cached
+        self.catalog.refresh_if_needed(pretix, organizer, event, [a.extra.get("Item ID") for a in attendees])
 
-        if len(room_ids) == 0:
-            self.log.debug("falling back to eventwide check")
-            rms = self.room_mapping.rooms_by_event(organizer, event)
-            self.log.debug(rms)
-            room_ids = [r.matrix_id for r in rms]
+        room_ids = self.rooms_for_attendee(organizer, event, attendees[0])
         # if still zero, give up
         if len(room_ids) == 0:
-            self.log.debug(f"found no configured rooms for event {event} from organizer {organizer}."
-            f"Unable to add attendee from registration {order_id} received via webhook")
+            self.log.debug("found no configured rooms for event %s from organizer %s. "
+                           "Unable to add attendee from registration %s received via webhook", event, organizer, order_id)
         else:
-            self.log.debug(f"webhook found {len(room_ids)} rooms for event {event} from organizer {organizer}")
+            self.log.debug("webhook found %d rooms for event %s from organizer %s", len(room_ids), event, organizer)
 
 
-        for room in room_ids:
-            if room[0] == "#":
-                roomaliasinfo = await self.client.resolve_room_alias(room)
-                room_id = roomaliasinfo.room_id
-            else:
-                room_id = room
-        
-            self.log.debug(f"sending invite from webhook to {room_id}")
-            failed_invites = await self.invite_attendees(room_id, attendees)
+        # rooms a previous delivery of this webhook already finished are skipped
+        await self.route_order(pretix, organizer, event, order_id, room_ids)
+        done = pretix.processed_rooms(order_id)
+        pending = [room for room in room_ids if room not in done]
+
+        self.watchdog.mark("webhook: inviting")
+        # all rooms are invited to at once, so the webhook takes as long as the slowest room
+        outcomes = await asyncio.gather(
+            *(self.invite_to_room(room, attendees, organizer=organizer, event=event) for room in pending),
+            return_exceptions=True,
+        )
 
-            # this assumes we are only really processing one new attendee at a time
-            if len(failed_invites) == 0:
-                self.pretix.mark_as_processed(attendees)
+        errors = []
+        for room, outcome in zip(pending, outcomes):
+            if isinstance(outcome, Exception):
+                self.log.error("unable to invite member %s to %s: %s", matrix_id, room, outcome)
+                errors.append(outcome)
+            elif len(outcome) > 0:
+                # this assumes we are only really processing one new attendee at a time
+                self.log.error("unable to invite member %s to %s", matrix_id, room)
             else:
-                self.log.error(f"unable to invite member {matrix_id}")
+                self.log.debug("invited attendees of order %s to %s", order_id, room)
+                await self.mark_room_processed(pretix, organizer, event, order_id, room)
 
-        # Pretix:  If you successfully received a webhook call, your endpoint
-        # should return a HTTP status code between 200 and 299.
-        # If any other status code is returned, we will assume you did not receive the call.
-        return Response()
+        # the order is only done once every one of its rooms is
+        if pretix.order_rooms_done(order_id):
+            await self.mark_processed(pretix, organizer, event, attendees)
+        if len(errors) > 0:
+            # let the caller (and pretix, by redelivering the webhook) know something went wrong
+            raise errors[0]
+
+
+    async def route_order(self, pretix:Pretix, organizer:str, event:str, order_code:str, rooms:List[str]):
+        """note the rooms of an order, sharing them with other replicas if enabled"""
+        pretix.route_order(order_code, rooms)
+        if self.shared_state is not None:
+            await self.shared_state.route_order(organizer, event, order_code, rooms)
+
+    async def mark_room_processed(self, pretix:Pretix, organizer:str, event:str, order_code:str, room:str):
+        """mark one room of an order as done, sharing this with other replicas if enabled"""
+        pretix.mark_room_processed(order_code, room)
+        if self.shared_state is not None:
+            await self.shared_state.mark_room_processed(organizer, event, order_code, room)
+
+    async def mark_processed(self, pretix:Pretix, organizer:str, event:str, attendees:List[AttendeeMatrixInformation]):
+        """mark attendees as processed, sharing this with other replicas if enabled"""
+        pretix.mark_as_processed(attendees)
+        if self.shared_state is not None:
+            await self.shared_state.mark_processed(organizer, event, [a.order_code for a in attendees])
 
 
     @command.new(name="help", help="list commands")
@@ -346,78 +952,261 @@ class EventManagement(Plugin):
         await evt.respond(f"maubot-events version {self.loader.meta.version}")
 
 
-    async def invite_attendees(self, room_id:str, attendees:List[AttendeeMatrixInformation]):
+    async def invite_attendees(self, room:str, attendees:List[AttendeeMatrixInformation],
+                               organizer:str=None, event:str=None):
         """attempt to invite attendees
 
+        Attendees that were invited to the room before, i.e. through another order or event, are skipped
+        without asking the homeserver. Invites that fail for a temporary reason, including the room alias
+        or the room's members not being available, are queued to be retried later.
+
         Args:
-            room_id (str): the ID of the room to invite users to
+            room (str): the ID or alias of the room to invite users to
             attendees (List[AttendeeMatrixInformation]): the list of attendees to invite
+            organizer (str, optional): the pretix organizer the attendees belong to
+            event (str, optional): the pretix event the attendees belong to
 
         Returns:
-            List[AttendeeMatrixInformation]: the list of users with invalid matrix IDs.
-            If fully successful this will be an empty list
+            List[AttendeeMatrixInformation]: the list of users with invalid matrix IDs or failed invites,
+            including those queued for a retry. If fully successful this will be an empty list
         """
         valid_users = {} #users in Dict[str,UserInfo] format for the matrix APIs
         invalid_users = [] # list of AttendeeMatrixInformation
+        attendees_by_id = {} # one person can hold several orders
+        try:
+            room_id = await self.resolve_room(room)
+            resolve_error = None
+        except Exception as e:
+            self.log.warning("could not resolve room %s: %s", room, e)
+            room_id, resolve_error = room, e
         for matrix_attendee in attendees:
             matrix_id = matrix_attendee.matrix_id
             order_id = matrix_attendee.order_code
-            self.log.debug(f"received username `{matrix_id}` to invite from order {order_id}")
+            self.attendee_log.debug("received username `%s` to invite from order %s", matrix_id, order_id)
             # validate matrix id
             try:
-                validated_id = validate_matrix_id(matrix_id, fix_at_sign=True)
+                validated_id = normalize_matrix_id(matrix_id)
             except ValueError as e:
-                self.log.debug(f"matrix ID was invalid for the following reason: {e}")
+                self.attendee_log.debug("matrix ID of order %s was invalid for the following reason: %s", order_id, e)
                 invalid_users.append(matrix_attendee)
                 continue
-            else:
-                self.log.debug(f"matrix ID was valid")
-                valid_users[validated_id] = UserInfo()
+            if resolve_error is None and self.attendee_index.is_invited(validated_id, room_id):
+                self.attendee_log.debug("%s was already invited to %s, skipping", validated_id, room_id)
+                continue
+            valid_users[validated_id] = UserInfo(power_level=self.config["attendee_power_level"])
+            attendees_by_id.setdefault(validated_id, []).append(matrix_attendee)
 
         if len(valid_users) > 0:
-            await self.matrix_utils.ensure_room_invitees(room_id, valid_users)
+            if resolve_error is not None:
+                failures = {matrix_id: resolve_error for matrix_id in valid_users}
+            else:
+                failures = await self.matrix_utils.ensure_room_invitees(room_id, valid_users)
+            for matrix_id, error in failures.items():
+                # the attendee stays unprocessed until the retry goes through.
+                # retries are keyed by the room as it is mapped, the alias is resolved again when retrying
+                for attendee in attendees_by_id[matrix_id]:
+                    self.retry_scheduler.record_failure(
+                        room, matrix_id, attendee.order_code, error, organizer=organizer, event=event, persist=False
+                    )
+                invalid_users.extend(attendees_by_id[matrix_id])
+                del valid_users[matrix_id]
+            if len(failures) > 0:
+                # one write for the whole call rather than one per attendee
+                self.retry_scheduler.queue.persist_soon()
+            self.attendee_index.record(room_id, valid_users, organizer=organizer, event=event)
+            if self.config["attendee_power_level"] is not None and len(valid_users) > 0:
+                # one power levels event for all attendees, skipped if nothing changes
+                await self.matrix_utils.ensure_room_power_levels(room_id, valid_users)
         else:
-            self.log.debug(f"no users with valid Matrix IDs to invite")
+            self.log.debug("no users with valid Matrix IDs to invite")
 
         return invalid_users
 
 
+    async def plan_invites(self, room_id:str, attendees:List[AttendeeMatrixInformation]) -> Dict[str, List[AttendeeMatrixInformation]]:
+        """work out what inviting attendees to a room would do, without inviting anyone
+
+        The membership of the room is taken from the cache when possible. Matrix IDs are validated
+        and people the bot invited to the room before are skipped, the same way invite_attendees does.
+
+        Args:
+            room_id (str): the ID of the room the attendees would be invited to
+            attendees (List[AttendeeMatrixInformation]): the attendees to plan for
+
+        Returns:
+            Dict[str, List[AttendeeMatrixInformation]]: the attendees that would be invited ("invite"),
+            are already joined ("joined") or invited ("invited"), and those with an invalid matrix ID ("invalid")
+        """
+        members, invitees = await self.matrix_utils.get_room_membership(room_id)
+        plan = {"invite": [], "joined": [], "invited": [], "invalid": []}
+        for attendee in attendees:
+            try:
+                matrix_id = normalize_matrix_id(attendee.matrix_id)
+            except ValueError:
+                plan["invalid"].append(attendee)
+                continue
+            if matrix_id in members:
+                plan["joined"].append(attendee)
+            elif matrix_id in invitees or self.attendee_index.is_invited(matrix_id, room_id):
+                plan["invited"].append(attendee)
+            else:
+                plan["invite"].append(attendee)
+        return plan
+
+    async def resolve_room(self, room:str) -> str:
+        """turn a room alias into a room ID, room IDs are returned as they are"""
+        if room[0] == "#":
+            return await self.matrix_utils.resolve_alias(room)
+        return room
+
+    async def invite_to_room(self, room:str, attendees:List[AttendeeMatrixInformation],
+                             organizer:str=None, event:str=None):
+        """resolve a room alias if needed and invite attendees to the room
+
+        Args:
+            room (str): the ID or alias of the room to invite users to
+            attendees (List[AttendeeMatrixInformation]): the list of attendees to invite
+            organizer (str, optional): the pretix organizer the attendees belong to
+            event (str, optional): the pretix event the attendees belong to
+
+        Returns:
+            List[AttendeeMatrixInformation]: the list of users with invalid matrix IDs.
+        """
+        return await self.invite_attendees(room, attendees, organizer=organizer, event=event)
+
+    async def invite_in_bulk(self, room:str, attendees:List[AttendeeMatrixInformation],
+                             organizer:str=None, event:str=None):
+        """like invite_to_room, but at bulk priority and in chunks so live webhooks can go in between
+
+        Returns:
+            List[AttendeeMatrixInformation]: the attendees that could not be invited, see invite_attendees
+        """
+        failed = []
+        size = max(1, self.config["bulk_chunk_size"])
+        for start in range(0, len(attendees), size):
+            async with self.scheduler.slot(BULK):
+                failed.extend(await self.invite_to_room(
+                    room, attendees[start:start + size], organizer=organizer, event=event
+                ))
+        return failed
+
+    async def retry_invite(self, room:str, matrix_id:str):
+        """retry a single failed invite, raising if it fails again"""
+        # retries are background work and should not hold up live webhooks
+        async with self.scheduler.slot(BULK):
+            room_id = await self.resolve_room(room)
+            failures = await self.matrix_utils.ensure_room_invitees(
+                room_id, {matrix_id: UserInfo(power_level=self.config["attendee_power_level"])}
+            )
+            if matrix_id in failures:
+                raise failures[matrix_id]
+            if self.config["attendee_power_level"] is not None:
+                await self.matrix_utils.ensure_room_power_levels(
+                    room_id, {matrix_id: UserInfo(power_level=self.config["attendee_power_level"])}
+                )
+
+    async def retry_succeeded(self, entry:RetryEntry):
+        room_id = await self.resolve_room(entry.room_id)
+        self.attendee_index.record(room_id, [entry.matrix_id], organizer=entry.organizer, event=entry.event)
+        if entry.organizer is None or entry.event is None:
+            # the next reconciliation run will mark the order as processed
+            return
+        pretix = self.pretix_pool.for_organizer(entry.organizer)
+        # retries are keyed by the room as it is mapped, like the rooms of an order
+        await self.mark_room_processed(pretix, entry.organizer, entry.event, entry.order_code, entry.room_id)
+        if self.shared_state is not None:
+            pretix.restore_room_progress({entry.order_code: await self.shared_state.room_progress(
+                entry.organizer, entry.event, entry.order_code
+            )})
+        if not pretix.order_rooms_done(entry.order_code):
+            # other rooms of the order are still queued or failed, or its rooms are not
+            # known (e.g. it was batch invited) and it is left to the next reconciliation run
+            return
+        await self.mark_processed(
+            pretix, entry.organizer, entry.event, [AttendeeMatrixInformation(entry.order_code, entry.matrix_id)]
+        )
+
     @command.new(name="batchinvite", help="invite attendees from pretix")
     @command.argument("pretix_url", pass_raw=True, required=True)
     async def batchinvite(self, evt: MessageEvent, pretix_url: str) -> None:
+        """
+        Invite the attendees of a pretix event to the current room
+
+        Usage: `!batchinvite <pretix url> [--dry-run]`. With `--dry-run`, nothing is sent and the bot
+        replies with how many attendees would be invited, are already in or invited to the room, or have an invalid matrix ID
+        """
         # permission check
         if evt.sender not in self.config["allowlist"]:
             await evt.reply(f"{evt.sender} is not allowed to execute this command")
             return
+        if not await self.wait_until_ready(evt):
+            return
+        self.watchdog.mark("!batchinvite")
 
         #TODO: check if pretix URL is blank and reply with warning or use the stored events for the current room
 
         room_id = evt.room_id
 
-        if not self.pretix.has_token:
-            await evt.reply(f"Error when testing authentication. This is may be due to a lack of authorization to access the configured pretix instance to query event registrations. Please run the `!authorize` command to authorize access")
+        args = pretix_url.split()
+        dry_run = "--dry-run" in args
+        args = [arg for arg in args if arg != "--dry-run"]
+        if len(args) == 0:
+            await evt.reply("Please provide the pretix URL of the event")
             return
-        
+
         # TODO: allow this url to be optional if a room is mapped
         try:
-            organizer, event = Pretix.parse_invite_url(pretix_url)
+            pretix, organizer, event = self.pretix_pool.for_url(args[0])
         except ValueError as e:
             await evt.reply(e)
-            # await evt.reply(f"Invalid input - please enter")
+            return
+
+        await self.sync_pretix_token(pretix)
+        if self.shared_state is not None:
+            pretix.mark_codes_as_processed(await self.shared_state.processed_codes(organizer, event))
+
+        if not pretix.has_token:
+            await evt.reply(f"Error when testing authentication. This is may be due to a lack of authorization to access the configured pretix instance to query event registrations. Please run the `!authorize` command to authorize access")
+            return
 
         self.log.debug(f"organizer: {organizer}")
         self.log.debug(f"event: {event}")
 
-        data = self.pretix.fetch_data(organizer, event)
-        data = self.pretix.extract_answers(data, filter_processed=True)
+        # only ask pretix for the tickets this room is filtered on, if any
+        condition = FilterConditions()
+        for rm in self.room_mapping.rooms_by_event(organizer, event):
+            if rm.matrix_id == room_id:
+                condition = rm.condition
+                break
 
-        failed_invites = await self.invite_attendees(room_id, data)
+        async with self.scheduler.slot(BULK):
+            # the pretix client is synchronous, keep it off the event loop
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(None, partial(
+                pretix.fetch_data, organizer, event, item=condition.item, variation=condition.variant
+            ))
+        data = pretix.extract_answers(data, filter_processed=True, plan=pretix.plan_for(organizer, event))
+
+        if dry_run:
+            plan = await self.plan_invites(room_id, data)
+            lines = [
+                f"Dry run for {len(data)} unprocessed attendees of {organizer}/{event}, no invites were sent:",
+                f"* would invite: {len(plan['invite'])}",
+                f"* already joined: {len(plan['joined'])}",
+                f"* already invited: {len(plan['invited'])}",
+                f"* invalid matrix ID: {len(plan['invalid'])}",
+            ]
+            if len(plan["invalid"]) > 0:
+                codes = [a.order_code for a in plan["invalid"]]
+                more = f" and {len(codes) - 20} more" if len(codes) > 20 else ""
+                lines.append(f"Orders with invalid matrix IDs: {', '.join(codes[:20])}{more}")
+            await evt.reply(NL.join(lines))
+            return
+
+        failed_invites = await self.invite_in_bulk(room_id, data, organizer=organizer, event=event)
         # TODO: mark successful ones as processed?
 
-        self.log.debug(f"failed invites {failed_invites}")
-                
-        # Ensure users have correct power levels
-        # await self.matrix_utils.ensure_room_power_levels(room_id, all_users)
+        self.log.debug("failed invites %s", failed_invites)
 
     @command.new(name="setroom", help="associate the current matrix room with a specified pretix event")
     @command.argument("pretix_url", pass_raw=False, required=True)
@@ -428,23 +1217,114 @@ class EventManagement(Plugin):
         if evt.sender not in self.config["allowlist"]:
             await evt.reply(f"{evt.sender} is not allowed to execute this command")
             return
+        if not await self.wait_until_ready(evt):
+            return
+        self.watchdog.mark("!setroom")
 
 
-        # TODO: check domain
         try:
-            organizer, event = Pretix.parse_invite_url(pretix_url)
+            pretix, organizer, event = self.pretix_pool.for_url(pretix_url)
         except ValueError as e:
             await evt.reply(e)
+            return
         
+        condition = FilterConditions(item_id, variant_id)
+        if condition.item is not None or condition.variant is not None:
+            try:
+                catalog = await self.catalog.get(pretix, organizer, event)
+            except Exception as e:
+                await evt.reply(f"Could not fetch the items of {organizer}/{event} from pretix to check the filter: {e}")
+                return
+            problem = catalog.validate(condition.item, condition.variant)
+            if problem is not None:
+                available = ", ".join(f"{item_id} ({name})" for item_id, name in catalog.items.items())
+                await evt.reply(f"Invalid filter: {problem}. Items of this event: {available or 'none'}")
+                return
+
         # store the association
         room_id = evt.room_id
 
-        rm = Room(room_id, condition=FilterConditions(item_id, variant_id))
+        rm = Room(room_id, condition=condition)
         #TODO: add room from object
+        await self.sync_room_mapping()
+        before = self.room_mapping.entries()
         self.room_mapping.add_object(organizer, event, rm)
-        await evt.reply("room associated successfully")
+        await self.share_room_mapping(before)
+        if rm.has_filter:
+            await evt.reply(f"room associated successfully {self.catalog.describe(organizer, event, condition)}")
+        else:
+            await evt.reply("room associated successfully")
 
     
+    @command.new(name="provision", help="create and map a room for each ticket type of a pretix event")
+    @command.argument("args", pass_raw=True, required=True)
+    async def provision(self, evt: MessageEvent, args: str) -> None:
+        """
+        Create (or reuse) a room for every item and item variation of a pretix event,
+        and associate each room with the event, filtered on its ticket
+
+        Usage: `!provision <pretix url> [item id...]`. Without item IDs, rooms are provisioned for all active items
+        """
+        # permission check
+        if evt.sender not in self.config["allowlist"]:
+            await evt.reply(f"{evt.sender} is not allowed to execute this command")
+            return
+        if not await self.wait_until_ready(evt):
+            return
+        self.watchdog.mark("!provision")
+
+        args = args.split()
+        if len(args) == 0:
+            await evt.reply("Please provide the pretix URL of the event")
+            return
+        try:
+            pretix, organizer, event = self.pretix_pool.for_url(args[0])
+        except ValueError as e:
+            await evt.reply(e)
+            return
+
+        await self.sync_pretix_token(pretix)
+        if not pretix.has_token:
+            await evt.reply("The bot is not authorized to access this pretix instance. Please run the `!authorize` command first")
+            return
+
+        loop = asyncio.get_running_loop()
+        try:
+            items = await loop.run_in_executor(None, pretix.fetch_items, organizer, event)
+        except Exception as e:
+            await evt.reply(f"Could not fetch the items of {organizer}/{event} from pretix: {e}")
+            return
+        self.catalog.put(organizer, event, items)
+        server = self.client.mxid.split(":", 1)[1]
+        specs = plan_rooms(event, items, server, item_ids=args[1:])
+        if len(specs) == 0:
+            await evt.reply("No matching items found for this event")
+            return
+
+        results = await provision_rooms(
+            self.matrix_utils,
+            specs,
+            self.config["provision_visibility"],
+            concurrency=self.config["provision_concurrency"],
+        )
+
+        lines = []
+        await self.sync_room_mapping()
+        before = self.room_mapping.entries()
+        for result in results:
+            if result.ok:
+                self.room_mapping.add_object(
+                    organizer, event,
+                    Room(result.room_id, FilterConditions(result.spec.item, result.spec.variant)),
+                )
+                lines.append(f"* {result.spec.alias} ({result.spec.name})")
+            else:
+                lines.append(f"* {result.spec.alias} failed: {result.error}")
+
+        await self.share_room_mapping(before)
+        succeeded = len([r for r in results if r.ok])
+        await evt.reply(f"Provisioned {succeeded} of {len(results)} rooms for {organizer}/{event}:{NL}" + NL.join(lines))
+
     @command.new(name="unsetroom", help="de-associate the current matrix room with a specified pretix event or remove this room from all events")
     @command.argument("pretix_url", pass_raw=True, required=False)
     async def unsetroom(self, evt: MessageEvent, pretix_url: str) -> None:
@@ -452,25 +1332,33 @@ class EventManagement(Plugin):
         if evt.sender not in self.config["allowlist"]:
             await evt.reply(f"{evt.sender} is not allowed to execute this command")
             return
+        if not await self.wait_until_ready(evt):
+            return
+        self.watchdog.mark("!unsetroom")
 
         room_id = evt.room_id
+        await self.sync_room_mapping()
+        before = self.room_mapping.entries()
 
         if pretix_url is not None and pretix_url != "":
             try:
-                organizer, event = Pretix.parse_invite_url(pretix_url)
+                pretix, organizer, event = self.pretix_pool.for_url(pretix_url)
             except ValueError as e:
                 await evt.reply(e)
+                return
             
             # remove the association
             if self.room_mapping.rooms_by_event(organizer, event) == set():
                 await evt.reply("room was not part of the specified event")
                 return
             self.room_mapping.remove(organizer, event, room_id)
+            await self.share_room_mapping(before)
             await evt.reply("room deassociated from event successfully")
 
         else:
             # TODO: fix me - this is surprising to users and may not be desired
             self.room_mapping.purge_room(room_id)
+            await self.share_room_mapping(before)
             await evt.reply("room deassociated from all events successfully")
 
 
@@ -481,18 +1369,40 @@ class EventManagement(Plugin):
         if evt.sender not in self.config["allowlist"]:
             await evt.reply(f"{evt.sender} is not allowed to execute this command")
             return
+        if not await self.wait_until_ready(evt):
+            return
+        self.watchdog.mark("!authorize")
 
+        # the pretix client is synchronous, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        pretix_clients = list(self.pretix_pool)
         if auth_url is not None and auth_url != "":
-            self.pretix.set_token_from_auth_callback(auth_url)
+            parsed_url = urlparse(auth_url)
+            if "code" in parse_qs(parsed_url.query):
+                # this is the URL the user was redirected to after authorizing
+                pretix = self.pretix_pool.for_auth_callback(auth_url)
+                await loop.run_in_executor(None, pretix.set_token_from_auth_callback, auth_url)
+            else:
+                # the URL of the pretix instance to authorize
+                pretix = self.pretix_pool.get(parsed_url.netloc)
+                if pretix is None:
+                    await evt.reply(f"No pretix instance is configured for {parsed_url.netloc}")
+                    return
+            pretix_clients = [pretix]
         
         # check if we have a valid refresh token
         # if yes, refresh the token
         # if no, provide the auth URL
-        
-        if not self.pretix.test_auth()[0]:
-            auth_url = self.pretix.get_auth_url()
+        for pretix in pretix_clients:
+            await self.sync_pretix_token(pretix)
+
+        unauthorized = [
+            pretix for pretix in pretix_clients if not (await loop.run_in_executor(None, pretix.test_auth))[0]
+        ]
+        if len(unauthorized) > 0:
+            auth_urls = [pretix.get_auth_url() for pretix in unauthorized]
             # inform user to visit the url and run the !token command with the response
-            await evt.reply(f"Please visit {auth_url} and re-run the `!authorize` command again with the URL you are redirected to in order to authorize.")
+            await evt.reply(f"Please visit {' and '.join(auth_urls)} and re-run the `!authorize` command again with the URL you are redirected to in order to authorize.")
             return
         
         await evt.reply(f"Authorization successful")
@@ -500,23 +1410,133 @@ class EventManagement(Plugin):
     # TODO: reauth command?
     # TODO: deauth command
 
+    @command.new(name="export", help="get a link to download the attendees of a pretix event and their invite state as CSV")
+    @command.argument("pretix_url", pass_raw=True, required=True)
+    async def export(self, evt: MessageEvent, pretix_url: str) -> None:
+        """
+        Reply with a link to a CSV file listing every paid attendee of the event with their order code, matrix ID,
+        whether the matrix ID is valid, the rooms they are routed to and their invite state in each of those rooms
+
+        The link stops working after `export_link_ttl` seconds
+        """
+        # permission check
+        if evt.sender not in self.config["allowlist"]:
+            await evt.reply(f"{evt.sender} is not allowed to execute this command")
+            return
+        if not await self.wait_until_ready(evt):
+            return
+        self.watchdog.mark("!export")
+
+        try:
+            pretix, organizer, event = self.pretix_pool.for_url(pretix_url.strip())
+        except ValueError as e:
+            await evt.reply(e)
+            return
+        if not pretix.has_token:
+            await evt.reply("The bot is not authorized to access this pretix instance. Please run the `!authorize` command first")
+            return
+
+        minutes = self.config["export_link_ttl"] // 60
+        await evt.reply(f"Download the attendees of {organizer}/{event} within the next {minutes} minutes: {self.export_link(pretix, organizer, event)}")
+
+    @command.new(name="whereis", help="list the rooms the bot has invited a matrix user to")
+    @command.argument("matrix_id", pass_raw=True, required=True)
+    async def whereis(self, evt: MessageEvent, matrix_id: str) -> None:
+        """
+        List the rooms the bot has invited a matrix user to (or found them in), and for which pretix event.
+        This is answered from the bot's own records without asking the homeserver
+        """
+        # permission check
+        if evt.sender not in self.config["allowlist"]:
+            await evt.reply(f"{evt.sender} is not allowed to execute this command")
+            return
+        if not await self.wait_until_ready(evt):
+            return
+        self.watchdog.mark("!whereis")
+
+        try:
+            matrix_id = normalize_matrix_id(matrix_id)
+        except ValueError as e:
+            await evt.reply(f"{matrix_id} is not a valid matrix ID: {e}")
+            return
+
+        records = self.attendee_index.rooms_of(matrix_id)
+        if len(records) == 0:
+            await evt.reply(f"{matrix_id} has not been invited to any rooms by this bot")
+            return
+        lines = [f"{matrix_id} was invited to:"]
+        for record in sorted(records, key=lambda r: r.updated_at):
+            since = datetime.fromtimestamp(record.updated_at, tz=timezone.utc).isoformat(timespec="seconds")
+            lines.append(f"* {record.room_id} ({record.state} for {record.organizer}/{record.event} since {since})")
+        await evt.reply(NL.join(lines))
+
+    def health_probes(self):
+        """the checks shown in !status: pretix authorization, whether each mapped event can be
+        reached and whether the bot may invite (and set power levels) in each mapped room"""
+        probes = {}
+        for pretix in self.pretix_pool:
+            async def probe(pretix=pretix):
+                await self.sync_pretix_token(pretix)
+                return await probe_pretix_auth(pretix)
+            probes[("pretix", pretix.host)] = probe
+        for organizer, event in self.room_mapping.events():
+            async def probe(organizer=organizer, event=event):
+                pretix = self.pretix_pool.for_organizer(organizer)
+                await self.sync_pretix_token(pretix)
+                return await probe_event(pretix, organizer, event)
+            probes[("event", f"{organizer}/{event}")] = probe
+        set_power_levels = self.config["attendee_power_level"] is not None
+
+        for room in self.room_mapping.rooms():
+            async def probe(room=room):
+                return await probe_room_permissions(
+                    self.matrix_utils, await self.resolve_room(room), self.client.mxid, set_power_levels
+                )
+            probes[("room", room)] = probe
+        return probes
+
     @command.new(name="status", help="check the status of the various configuration options for this bot")  
     async def status(self, evt: MessageEvent) -> None:
         # permission check
         if evt.sender not in self.config["allowlist"]:
             await evt.reply(f"{evt.sender} is not allowed to execute this command")
             return
-        
-        room_id = evt.room_id
-        # TODO: check permissions and make sure we can access organizers and events (maybe by listing them)
-        test_result, details = self.pretix.test_auth()
-        pretix_auth_status = "authorized" if test_result else "not authorized"
-        room_associated = "is" if self.room_mapping.room_is_mapped(room_id) else "is not"
+        if not await self.wait_until_ready(evt):
+            return
+        self.watchdog.mark("!status")
+        await self.sync_room_mapping()
 
-        statustext = [
-            f"Pretix status: {pretix_auth_status}",
+        room_id = evt.room_id
+        room_events = self.room_mapping.events_for_room(Room(room_id), self.catalog)
+        room_associated = "is" if len(room_events) > 0 else "is not"
+
+        results = await self.health.check_all(self.health_probes())
+
+        statustext = []
+        for pretix in self.pretix_pool:
+            circuit_state = pretix.circuit_state
+            if circuit_state != "closed":
+                circuit_state += f" (retrying in {int(pretix.rate_limiter.breaker.retry_in)}s)"
+
+            statustext.append(f"Pretix status ({pretix.host}): {results[('pretix', pretix.host)].detail}")
+            statustext.append(f"Pretix connection ({pretix.host}): {circuit_state}")
+
+        for kind, label in (("event", "Events reachable"), ("room", "Rooms the bot can invite to")):
+            checked = {key: result for key, result in results.items() if key[0] == kind}
+            ok = len([result for result in checked.values() if result.ok])
+            statustext.append(f"{label}: {ok}/{len(checked)}")
+            statustext += [f"* {key[1]}: {result.detail}" for key, result in checked.items() if not result.ok]
+
+        oldest = max((result.age for result in results.values()), default=0)
+        statustext += [
+            f"Webhooks: {self.metrics['webhooks_received']} received, "
+            f"{self.metrics['webhooks_skipped_unmapped']} skipped for unmapped events, "
+            f"{self.metrics['webhooks_skipped_action']} skipped for other actions",
+            f"Invite retries: {len(self.retry_scheduler.queue)} queued",
+            f"Scheduler: {self.scheduler.status()}",
             f"Room Status: the current room {room_associated} assigned to an event",
-            f"Events: {','.join(self.room_mapping.events_for_room(Room(room_id)))}"
-        ]
+            f"Events: {','.join(room_events)}",
+            f"Checks are cached for {self.health.ttl}s, the oldest result shown is {int(oldest)}s old",
+        ] + self.watchdog.status()
         await evt.reply(NL.join(statustext))
         
@@ -0,0 +1,115 @@
+import time
+from dataclasses import dataclass, field, asdict
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from . import jsonutil
+from .matrix_utils import validate_matrix_id
+from .persist import DelayedWriter
+
+
+@lru_cache(maxsize=4096)
+def normalize_matrix_id(possible_matrix_id: str) -> str:
+    """validate a matrix ID given in pretix and bring it into the form used for inviting
+
+    Results are cached since the same people show up in many orders and webhooks.
+
+    Raises:
+        ValueError: if the matrix ID is invalid, see validate_matrix_id
+    """
+    if possible_matrix_id is not None:
+        possible_matrix_id = possible_matrix_id.strip()
+    return validate_matrix_id(possible_matrix_id, fix_at_sign=True)
+
+
+@dataclass
+class RoomRecord:
+    room_id: str
+    organizer: Optional[str] = None
+    event: Optional[str] = None
+    state: str = "invited"
+    updated_at: float = field(default_factory=time.time)
+
+    @classmethod
+    def from_json(cls, json_data: dict):
+        return cls(**json_data)
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class AttendeeIndex:
+    """which rooms each attendee has been invited to, across all events
+
+    Keyed by normalized matrix ID, so a person holding several orders or tickets for
+    several events is only invited to a room once.
+
+    The index can grow to many megabytes, so changes are written to disk off the event
+    loop, at most once every `persist_delay` seconds. Call flush before shutting down.
+    """
+    _index: Dict[str, Dict[str, RoomRecord]] = field(default_factory=lambda: {})
+    persist_path: Path = field(default_factory=Path, kw_only=True)
+    persist_filename: str = field(default="attendee_index.json", kw_only=True)
+    persist_delay: float = field(default=5, kw_only=True)
+    _writer: DelayedWriter = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # only the outer containers are copied on the loop, the slow part runs in the executor
+        self._writer = DelayedWriter(
+            lambda: {matrix_id: list(rooms.values()) for matrix_id, rooms in self._index.items()},
+            lambda index: self._write(index),
+            self.persist_delay,
+        )
+
+    @property
+    def persistfile(self):
+        return self.persist_path.joinpath(self.persist_filename)
+
+    def persist(self):
+        self._write({matrix_id: list(rooms.values()) for matrix_id, rooms in self._index.items()})
+
+    def _write(self, index: Dict[str, List[RoomRecord]]):
+        # records are replaced rather than changed, so this can run in another thread
+        data = {matrix_id: [record.to_json() for record in records] for matrix_id, records in index.items()}
+        self.persistfile.write_text(jsonutil.dumps(data), encoding="utf8")
+
+    def persist_soon(self):
+        """write the index in the background after persist_delay seconds, together with any other changes made until then"""
+        self._writer.schedule()
+
+    async def flush(self):
+        """write pending changes right away"""
+        await self._writer.flush()
+
+    @classmethod
+    def from_path(cls, persist_path=Path("."), persist_filename="attendee_index.json"):
+        if persist_path is None:
+            persist_path = Path(".")
+        persistfile = persist_path.joinpath(persist_filename)
+        if not persistfile.exists():
+            return cls(persist_filename=persist_filename, persist_path=persist_path)
+        data = jsonutil.loads(persistfile.read_bytes())
+        index = {
+            matrix_id: {r["room_id"]: RoomRecord.from_json(r) for r in records}
+            for matrix_id, records in data.items()
+        }
+        return cls(index, persist_filename=persist_filename, persist_path=persist_path)
+
+    def __len__(self):
+        return len(self._index)
+
+    def rooms_of(self, matrix_id: str) -> List[RoomRecord]:
+        return list(self._index.get(matrix_id, {}).values())
+
+    def is_invited(self, matrix_id: str, room_id: str) -> bool:
+        return room_id in self._index.get(matrix_id, {})
+
+    def record(self, room_id: str, matrix_ids: Iterable[str], organizer: str = None, event: str = None,
+               state: str = "invited", persist: bool = True):
+        """remember that users were invited to (or are already in) a room"""
+        for matrix_id in matrix_ids:
+            self._index.setdefault(matrix_id, {})[room_id] = RoomRecord(room_id, organizer, event, state)
+        if persist:
+            self.persist_soon()
@@ -2,6 +2,8 @@ import json
 from dataclasses import dataclass, asdict
 from datetime import datetime, timedelta, timezone
 
+from . import jsonutil
+
 @dataclass
 class Token:
     """Stores a token in memory along with the time that its updated 
@@ -16,7 +18,7 @@ class Token:
 
     @classmethod
     def from_str(cls, string):
-        return cls.from_json(json.loads(string))
+        return cls.from_json(jsonutil.loads(string))
 
     @classmethod
     def from_json(cls, json):
@@ -0,0 +1,161 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set, Tuple
+
+from mautrix.util.logging import TraceLogger
+
+from .pretix import Pretix, localized
+from .singleflight import SingleFlight
+
+
+def ticket_id(value):
+    """bring an item or variation ID into the form pretix uses, an int
+
+    IDs typed into commands or stored by older versions of the bot are strings.
+    Values that are not numeric are returned unchanged.
+    """
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    return value
+
+
+@dataclass
+class EventCatalog:
+    """the items (ticket types) of an event and their variations, by ID"""
+    items: Dict[int, str] = field(default_factory=lambda: {})
+    variations: Dict[int, Dict[int, str]] = field(default_factory=lambda: {})
+    fetched_at: float = field(default_factory=time.monotonic)
+
+    @classmethod
+    def from_items(cls, items: list):
+        """build a catalog from the raw item data returned by Pretix.fetch_items"""
+        catalog = cls()
+        for item in items:
+            catalog.items[item["id"]] = localized(item.get("name"))
+            catalog.variations[item["id"]] = {
+                variation["id"]: localized(variation.get("value")) for variation in item.get("variations") or []
+            }
+        return catalog
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+    def validate(self, item, variant) -> Optional[str]:
+        """check that a room filter refers to a ticket of this event
+
+        Returns:
+            Optional[str]: what is wrong with the filter, or None if it is fine
+        """
+        if item is None:
+            return None if variant is None else "a variation can only be given together with an item"
+        if item not in self.items:
+            return f"item {item} does not exist in this event"
+        if variant is not None and variant not in self.variations[item]:
+            return f"item {item} ({self.items[item]}) has no variation {variant}"
+        return None
+
+    def describe(self, item, variant) -> str:
+        """a room filter in the same format as str(FilterConditions), with the ticket names added"""
+        text = []
+        if item is not None:
+            name = self.items.get(item)
+            text.append(f"item={item}" + (f" {name}" if name else ""))
+        if variant is not None:
+            name = self.variations.get(item, {}).get(variant)
+            text.append(f"variant={variant}" + (f" {name}" if name else ""))
+        return f"({', '.join(text)})"
+
+
+class ItemCatalog:
+    """Caches the items and variations of each event for `ttl` seconds
+
+    Commands and status output only read the cache. It is filled when a filter is
+    set or rooms are provisioned, and refreshed in the background when a webhook
+    finds the cached copy expired or sees a ticket it does not know. After a failed
+    fetch, webhooks leave the event alone for `failure_ttl` seconds.
+    """
+
+    def __init__(self, log: TraceLogger, ttl: float = 3600,
+                 prepare: Optional[Callable[[Pretix], Awaitable[None]]] = None, failure_ttl: float = 60):
+        self.log = log
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        # awaited before every fetch, e.g. to pick up the token shared between replicas
+        self.prepare = prepare
+        self._catalogs: Dict[Tuple[str, str], EventCatalog] = {}
+        # (organizer, event) -> time of the last failed fetch
+        self._failed: Dict[Tuple[str, str], float] = {}
+        self._inflight = SingleFlight()
+        # keeps background refreshes from being garbage collected while they run
+        self._refreshes: Set[asyncio.Task] = set()
+
+    def __len__(self):
+        return len(self._catalogs)
+
+    def cached(self, organizer: str, event: str) -> Optional[EventCatalog]:
+        """the cached catalog of an event, even if it has expired, without contacting pretix"""
+        return self._catalogs.get((organizer, event))
+
+    def is_fresh(self, organizer: str, event: str) -> bool:
+        catalog = self.cached(organizer, event)
+        return catalog is not None and catalog.age < self.ttl
+
+    def recently_failed(self, organizer: str, event: str) -> bool:
+        """whether fetching the catalog of an event failed less than `failure_ttl` seconds ago"""
+        failed_at = self._failed.get((organizer, event))
+        return failed_at is not None and time.monotonic() - failed_at < self.failure_ttl
+
+    def put(self, organizer: str, event: str, items: list) -> EventCatalog:
+        """cache item data that was fetched elsewhere, e.g. by !provision"""
+        catalog = EventCatalog.from_items(items)
+        self._catalogs[(organizer, event)] = catalog
+        self._failed.pop((organizer, event), None)
+        return catalog
+
+    async def get(self, pretix: Pretix, organizer: str, event: str, refresh: bool = False) -> EventCatalog:
+        """return the catalog of an event, fetching it from pretix if it is not cached or has expired"""
+        if not refresh and self.is_fresh(organizer, event):
+            return self.cached(organizer, event)
+
+        async def fetch():
+            if self.prepare is not None:
+                await self.prepare(pretix)
+            loop = asyncio.get_running_loop()
+            try:
+                items = await loop.run_in_executor(None, pretix.fetch_items, organizer, event)
+            except Exception:
+                self._failed[(organizer, event)] = time.monotonic()
+                raise
+            self.log.debug("fetched %d items of %s/%s", len(items), organizer, event)
+            return self.put(organizer, event, items)
+
+        return await self._inflight.do((organizer, event), fetch)
+
+    def refresh_if_needed(self, pretix: Pretix, organizer: str, event: str, item_ids: Iterable = ()):
+        """refresh an event's catalog in the background if it expired or lacks one of `item_ids`"""
+        catalog = self.cached(organizer, event)
+        unknown = catalog is not None and any(
+            item_id is not None and item_id not in catalog.items for item_id in item_ids
+        )
+        if catalog is not None and catalog.age < self.ttl and not unknown:
+            return
+        if self.recently_failed(organizer, event):
+            return
+        task = asyncio.create_task(self._refresh(pretix, organizer, event))
+        self._refreshes.add(task)
+        task.add_done_callback(self._refreshes.discard)
+
+    async def _refresh(self, pretix: Pretix, organizer: str, event: str):
+        try:
+            await self.get(pretix, organizer, event, refresh=True)
+        except Exception as e:
+            self.log.warning("could not refresh the items of %s/%s: %s", organizer, event, e)
+
+    def describe(self, organizer: str, event: str, condition) -> str:
+        """describe a room filter with ticket names, if the event's catalog is cached"""
+        catalog = self.cached(organizer, event)
+        if catalog is None:
+            return str(condition)
+        return catalog.describe(condition.item, condition.variant)
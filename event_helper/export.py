@@ -0,0 +1,113 @@
+import asyncio
+import csv
+import io
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from mautrix.util.logging import TraceLogger
+
+from .attendee_index import normalize_matrix_id
+from .pretix import Pretix, AttendeeMatrixInformation
+
+EXPORT_HEADERS = ["Order code", "Matrix ID", "Validation", "Rooms", "Invite state"]
+
+# joined and invited users of a room, or None if they could not be looked up
+Membership = Optional[Tuple[Set[str], Set[str]]]
+
+
+# whether the bot invited a matrix ID to a room before, see AttendeeIndex
+InvitedBefore = Callable[[str, str], bool]
+
+# spreadsheets run cells starting with one of these as formulas
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def csv_safe(value: str) -> str:
+    """keep spreadsheets from running a cell as a formula by prefixing it with a quote.
+    Attendees choose their answers, including what they enter as matrix ID"""
+    if value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def invite_state(matrix_id: str, room: str, membership: Membership, queued,
+                 invited_before: InvitedBefore = None) -> str:
+    """describe where an attendee stands in one room"""
+    if membership is None:
+        return "unknown"
+    members, invitees = membership
+    if matrix_id in members:
+        return "joined"
+    # people the bot invited before are not invited again, even if they declined
+    if matrix_id in invitees or (invited_before is not None and invited_before(matrix_id, room)):
+        return "invited"
+    if (room, matrix_id) in queued:
+        return "retrying"
+    return "not invited"
+
+
+def attendee_rows(attendees: Iterable[AttendeeMatrixInformation], rooms_for: Callable[[AttendeeMatrixInformation], List[str]],
+                  memberships: Dict[str, Membership], queued, invited_before: InvitedBefore = None) -> Iterator[list]:
+    """yield one CSV row per attendee
+
+    Matrix IDs are validated and normalized the same way as when inviting. Cells that a
+    spreadsheet would read as a formula, which includes every matrix ID, start with a quote.
+
+    Args:
+        attendees (Iterable[AttendeeMatrixInformation]): the attendees to export
+        rooms_for (Callable): returns the rooms an attendee is routed to
+        memberships (Dict[str, Membership]): the membership of every room the attendees are routed to
+        queued: (room, matrix ID) pairs of invites waiting to be retried
+        invited_before (Callable, optional): whether the bot invited a matrix ID to a room before
+    """
+    for attendee in attendees:
+        rooms = rooms_for(attendee)
+        try:
+            matrix_id = normalize_matrix_id(attendee.matrix_id)
+        except ValueError as e:
+            validation = f"invalid: {e}"
+            states = ["invalid" for _ in rooms]
+        else:
+            validation = "valid"
+            states = [invite_state(matrix_id, room, memberships.get(room), queued, invited_before) for room in rooms]
+        row = [attendee.order_code, attendee.matrix_id or "", validation, " ".join(rooms), " ".join(states)]
+        yield [csv_safe(cell) for cell in row]
+
+
+def to_csv(rows: Iterable[list]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+async def export_attendees(pretix: Pretix, organizer: str, event: str,
+                           rooms_for: Callable[[AttendeeMatrixInformation], List[str]],
+                           membership_for: Callable[[str], Awaitable[Membership]],
+                           queued, log: TraceLogger, invited_before: InvitedBefore = None) -> AsyncIterator[str]:
+    """stream the attendees of an event and their invite state as CSV, one chunk per page of orders
+
+    Only one page of orders is held in memory at a time. The membership of each room is
+    looked up once, the first time an attendee is routed to it.
+    """
+    loop = asyncio.get_running_loop()
+    plan = pretix.plan_for(organizer, event)
+    pages = pretix.iter_order_pages(organizer, event)
+    memberships: Dict[str, Membership] = {}
+
+    yield to_csv([EXPORT_HEADERS])
+    exported = 0
+    while True:
+        # the pretix client is synchronous, keep it off the event loop
+        page = await loop.run_in_executor(None, next, pages, None)
+        if page is None:
+            break
+        attendees = pretix.extract_answers(page, plan=plan)
+        for room in {room for attendee in attendees for room in rooms_for(attendee)}:
+            if room not in memberships:
+                try:
+                    memberships[room] = await membership_for(room)
+                except Exception as e:
+                    log.warning(f"could not look up the members of {room} for the export: {e}")
+                    memberships[room] = None
+        yield to_csv(attendee_rows(attendees, rooms_for, memberships, queued, invited_before))
+        exported += len(attendees)
+    log.debug(f"exported {exported} attendees of {organizer}/{event}")
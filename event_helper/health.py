@@ -0,0 +1,99 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from mautrix.types import EventType, UserID
+from mautrix.util.logging import TraceLogger
+
+from .matrix_utils import MatrixUtils
+from .pretix import Pretix, localized
+from .singleflight import SingleFlight
+
+Probe = Callable[[], Awaitable[Tuple[bool, str]]]
+
+
+@dataclass
+class ProbeResult:
+    ok: bool
+    detail: str
+    checked_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.checked_at
+
+
+class HealthChecks:
+    """Runs the probes behind !status concurrently and caches their results for `ttl` seconds
+
+    Asking for the status again while the results are fresh answers from the cache without
+    contacting pretix or the homeserver, and concurrent requests for a probe share one run.
+    A probe that takes longer than `timeout` seconds or raises counts as failed.
+    """
+
+    def __init__(self, log: TraceLogger, ttl: float = 30, timeout: float = 5):
+        self.log = log
+        self.ttl = ttl
+        self.timeout = timeout
+        self._results: Dict[Hashable, ProbeResult] = {}
+        self._inflight = SingleFlight()
+
+    def cached(self, key: Hashable) -> Optional[ProbeResult]:
+        result = self._results.get(key)
+        if result is None or result.age >= self.ttl:
+            return None
+        return result
+
+    async def check(self, key: Hashable, probe: Probe) -> ProbeResult:
+        result = self.cached(key)
+        if result is not None:
+            return result
+        return await self._inflight.do(key, lambda: self._run(key, probe))
+
+    async def _run(self, key: Hashable, probe: Probe) -> ProbeResult:
+        try:
+            ok, detail = await asyncio.wait_for(probe(), self.timeout)
+        except asyncio.TimeoutError:
+            ok, detail = False, f"no answer within {self.timeout}s"
+        except Exception as e:
+            self.log.debug("health check %s failed: %s", key, e)
+            ok, detail = False, f"{type(e).__name__}: {e}"
+        result = ProbeResult(ok, detail)
+        self._results[key] = result
+        return result
+
+    async def check_all(self, probes: Dict[Hashable, Probe]) -> Dict[Hashable, ProbeResult]:
+        """run (or look up) several probes at once"""
+        results = await asyncio.gather(*(self.check(key, probe) for key, probe in probes.items()))
+        return dict(zip(probes, results))
+
+
+async def probe_pretix_auth(pretix: Pretix) -> Tuple[bool, str]:
+    loop = asyncio.get_running_loop()
+    authorized, _ = await loop.run_in_executor(None, pretix.test_auth)
+    return authorized, "authorized" if authorized else "not authorized"
+
+
+async def probe_event(pretix: Pretix, organizer: str, event: str) -> Tuple[bool, str]:
+    if not pretix.has_token:
+        return False, "not authorized"
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, pretix.fetch_event, organizer, event)
+    return True, f"reachable ({localized(data.get('name'))})"
+
+
+async def probe_room_permissions(matrix_utils: MatrixUtils, room_id: str, bot: UserID,
+                                 set_power_levels: bool = False) -> Tuple[bool, str]:
+    """check that the bot may invite to a room, and change power levels there if it has to"""
+    power_levels = await matrix_utils.get_room_state(room_id, EventType.ROOM_POWER_LEVELS)
+    if power_levels is None:
+        return False, "no power levels (is the bot in the room?)"
+    level = power_levels.get_user_level(bot)
+    if level < power_levels.invite:
+        return False, f"power level {level} is below the {power_levels.invite} needed to invite"
+    if set_power_levels:
+        needed = power_levels.get_event_level(EventType.ROOM_POWER_LEVELS)
+        if level < needed:
+            return False, f"power level {level} is below the {needed} needed to set attendee power levels"
+    return True, f"power level {level}"
@@ -0,0 +1,25 @@
+"""JSON helpers that use orjson when it is installed and fall back to the standard library
+
+orjson is an optional dependency, install it alongside the bot to speed up decoding
+pretix responses and reading and writing the files the bot persists.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def loads(data):
+    """decode JSON from a str or bytes object"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj) -> str:
+    """encode an object made of plain JSON types (dict, list, str, int, float, bool, None) into a str"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj)
@@ -0,0 +1,23 @@
+import itertools
+import logging
+
+
+class SampledLogger:
+    """Passes only every `every`-th debug message on to a logger
+
+    Meant for messages logged once per attendee, which would otherwise flood the log
+    during bulk invites. Arguments are formatted lazily by the logging module, and
+    nothing is counted or formatted while debug logging is disabled.
+    """
+
+    def __init__(self, logger: logging.Logger, every: int = 1):
+        self.logger = logger
+        self.every = max(1, every)
+        self._counter = itertools.count()
+
+    def debug(self, msg: str, *args):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if self.every > 1 and next(self._counter) % self.every != 0:
+            return
+        self.logger.debug(msg, *args)
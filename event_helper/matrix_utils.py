@@ -1,6 +1,8 @@
-from typing import Mapping, Optional, TypedDict
+from typing import Awaitable, Callable, Dict, Hashable, List, Mapping, Optional, Set, Tuple, TypedDict
 
+import asyncio
 import string
+import time
 from collections import Counter
 import validators
 
@@ -21,6 +23,9 @@ from mautrix.types import (
 )
 from mautrix.util.logging import TraceLogger
 
+from .logutil import SampledLogger
+from .singleflight import KeyedLocks, SingleFlight
+
 class UserInfo(TypedDict):
     power_level: Optional[int]
 
@@ -86,32 +91,136 @@ class MatrixUtils:
     room_methods = None
     event_methods = None
     logger = None
+    # up to this many users are checked through their own member events instead of the member list
+    single_lookup_limit = 5
+    # room aliases rarely change, so they are kept for longer than room state
+    alias_cache_ttl = 600
 
-    def __init__(self, mautrix_api: HTTPAPI, log: TraceLogger):
+    def __init__(self, mautrix_api: HTTPAPI, log: TraceLogger, state_cache_ttl: float = 60, log_sample_every: int = 1):
         self.room_methods = RoomMethods(api=mautrix_api)
         self.event_methods = EventMethods(api=mautrix_api)
         self.logger = log
+        # for messages logged once per invited user
+        self.user_log = SampledLogger(log, every=log_sample_every)
+        self.state_cache_ttl = state_cache_ttl
+        # (room id, key) -> (expiry, value). key is an event type, "directory_visibility" or "members"
+        self._state_cache: Dict[Tuple[RoomID, str], Tuple[float, object]] = {}
+        # alias -> (expiry, room id)
+        self._aliases: Dict[str, Tuple[float, RoomID]] = {}
+        # concurrent lookups of the same membership share one request
+        self._inflight = SingleFlight()
+        # writers of state that is read, changed and sent back (power levels) go one at a time per room
+        self._room_locks = KeyedLocks()
+        # cache entries restored from a snapshot, checked again the first time they are used
+        self._unverified: Set[Hashable] = set()
+        self._revalidations: Set[asyncio.Task] = set()
+
+    def _cached(self, room_id: RoomID, key: str):
+        entry = self._state_cache.get((room_id, key))
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry
+
+    def _cache(self, room_id: RoomID, key: str, value):
+        self._state_cache[(room_id, key)] = (time.monotonic() + self.state_cache_ttl, value)
+
+    def _revalidate_if_restored(self, key: Hashable, fetch: Callable[[], Awaitable]):
+        """refresh a cache entry restored from a snapshot in the background, the first time it is used"""
+        if key not in self._unverified:
+            return
+        self._unverified.discard(key)
+
+        async def revalidate():
+            try:
+                await self._inflight.do(key, fetch)
+            except Exception as e:
+                self.logger.debug("dropping restored cache entry %s: %s", key, e)
+                if key[0] == "alias":
+                    self._aliases.pop(key[1], None)
+                else:
+                    self._state_cache.pop((key[1], key[0]), None)
+
+        task = asyncio.create_task(revalidate())
+        self._revalidations.add(task)
+        task.add_done_callback(self._revalidations.discard)
+
+    def export_caches(self) -> Tuple[Dict[str, str], Dict[str, List[List[str]]]]:
+        """the unexpired room aliases and room memberships, for a snapshot
+
+        Returns:
+            Tuple[Dict[str, str], Dict[str, List[List[str]]]]: alias -> room id, and
+                room id -> [joined users, invited users]
+        """
+        now = time.monotonic()
+        aliases = {alias: room_id for alias, (expiry, room_id) in self._aliases.items() if expiry >= now}
+        members = {
+            room_id: [sorted(value[0]), sorted(value[1])]
+            for (room_id, key), (expiry, value) in self._state_cache.items()
+            if key == "members" and expiry >= now
+        }
+        return aliases, members
+
+    def restore_caches(self, aliases: Dict[str, str], members: Dict[str, List[List[str]]]):
+        """fill the caches from a snapshot. Each entry is used right away, but fetched again in the
+        background the first time it is used, in case it changed while the bot was not running"""
+        expiry = time.monotonic() + self.alias_cache_ttl
+        for alias, room_id in aliases.items():
+            self._aliases[alias] = (expiry, RoomID(room_id))
+            self._unverified.add(("alias", alias))
+        for room_id, (joined, invited) in members.items():
+            self._cache(RoomID(room_id), "members", (set(joined), set(invited)))
+            self._unverified.add(("members", room_id))
+
+    def invalidate_room_state(self, room_id: RoomID):
+        """forget the cached state of a room, i.e. when it may have been changed by someone else"""
+        for key in [k for k in self._state_cache if k[0] == room_id]:
+            del self._state_cache[key]
+
+    async def get_room_state(self, room_id: RoomID, event_type: EventType):
+        """fetch the content of a state event, using the cache when possible
+
+        Returns:
+            the content of the state event, or None if the room doesnt have one
+        """
+        entry = self._cached(room_id, str(event_type))
+        if entry is not None:
+            return entry[1]
+        return await self._fetch_room_state(room_id, event_type)
+
+    async def _fetch_room_state(self, room_id: RoomID, event_type: EventType):
+        """like get_room_state, but always asks the homeserver"""
+        try:
+            content = await self.room_methods.get_state_event(room_id, event_type)
+        except MNotFound:
+            content = None
+        self._cache(room_id, str(event_type), content)
+        return content
+
+    async def set_room_state(self, room_id: RoomID, event_type: EventType, content):
+        await self.event_methods.send_state_event(room_id, event_type, content)
+        self._cache(room_id, str(event_type), content)
 
     async def ensure_room_visibility(self, room_id: RoomID, visibility: str):
         self.logger.debug(f"Ensuring visibility for {room_id}...")
-        current_visibility = await self.room_methods.get_room_directory_visibility(
-            room_id
-        )
-        if current_visibility != visibility:
+        entry = self._cached(room_id, "directory_visibility")
+        if entry is not None:
+            current_visibility = entry[1]
+        else:
+            current_visibility = await self.room_methods.get_room_directory_visibility(
+                room_id
+            )
+        if current_visibility != RoomDirectoryVisibility(visibility):
             await self.room_methods.set_room_directory_visibility(
                 room_id, RoomDirectoryVisibility(visibility)
             )
+        self._cache(room_id, "directory_visibility", RoomDirectoryVisibility(visibility))
 
     async def ensure_room_name(self, room_id: RoomID, name: str) -> None:
-        try:
-            current_name = (
-                await self.room_methods.get_state_event(room_id, EventType.ROOM_NAME)
-            )["name"]
-        except MNotFound:
-            current_name = ""
+        current_state = await self.get_room_state(room_id, EventType.ROOM_NAME)
+        current_name = current_state["name"] if current_state is not None else ""
         if not current_name == name:
             self.logger.debug(f"Setting name '{name}' for room {room_id}")
-            await self.event_methods.send_state_event(
+            await self.set_room_state(
                 room_id, EventType.ROOM_NAME, RoomNameStateEventContent(name)
             )
 
@@ -122,6 +231,19 @@ class MatrixUtils:
         self.logger.debug(f"Created room: {new_room_id}")
         return new_room_id
 
+    async def resolve_alias(self, alias: str) -> RoomID:
+        """look up the room an alias points to, using the cache when possible"""
+        entry = self._aliases.get(alias)
+        if entry is not None and entry[0] >= time.monotonic():
+            self._revalidate_if_restored(("alias", alias), lambda: self._fetch_alias(alias))
+            return entry[1]
+        return await self._inflight.do(("alias", alias), lambda: self._fetch_alias(alias))
+
+    async def _fetch_alias(self, alias: str) -> RoomID:
+        info = await self.room_methods.get_room_alias(alias)
+        self._aliases[alias] = (time.monotonic() + self.alias_cache_ttl, info.room_id)
+        return info.room_id
+
     async def ensure_room_with_alias(self, alias) -> RoomID:
         self.logger.debug(f"Ensuring {alias} exists...")
         try:
@@ -153,34 +275,153 @@ class MatrixUtils:
                 invite_mxids.append(event.state_key)
         return member_mxids, invite_mxids
 
-    async def ensure_room_invitees(self, room_id: RoomID, user_info_map: UserInfoMap):
-        room_member_events = await self.event_methods.get_members(room_id)
-        room_members, room_invitees = self.state_events_to_member_list(
-            room_member_events
+    async def get_room_membership(
+        self, room_id: RoomID, use_cache: bool = True
+    ) -> Tuple[Set[str], Set[str]]:
+        """fetch the joined and invited users of a room
+
+        Args:
+            room_id (RoomID): the room to look up
+            use_cache (bool, optional): whether a cached member list may be returned. Defaults to True
+
+        Returns:
+            Tuple[Set[str], Set[str]]: the joined users and the invited users
+        """
+        if use_cache:
+            entry = self._cached(room_id, "members")
+            if entry is not None:
+                self._revalidate_if_restored(("members", room_id), lambda: self._fetch_room_membership(room_id))
+                return entry[1]
+        return await self._inflight.do(
+            ("members", room_id), lambda: self._fetch_room_membership(room_id)
         )
-        self.logger.debug(f"Room {room_id} has members:{str(room_members)}")
-        self.logger.debug(f"Room {room_id} has invitees:{str(room_invitees)}")
+
+    async def _fetch_room_membership(self, room_id: RoomID) -> Tuple[Set[str], Set[str]]:
+        # joined_members only returns user IDs and display names, and the member list
+        # filtered to invites is usually tiny, so neither transfers the room's full member state
+        joined = await self.event_methods.get_joined_members(room_id)
+        invite_events = await self.event_methods.get_members(
+            room_id, membership=Membership.INVITE
+        )
+        membership = (set(joined), {event.state_key for event in invite_events})
+        self._cache(room_id, "members", membership)
+        return membership
+
+    async def get_user_membership(
+        self, room_id: RoomID, user_id: UserID
+    ) -> Optional[Membership]:
+        """fetch the membership of one user in a room from their member state event
+
+        Returns:
+            Optional[Membership]: the user's membership, or None if they never had one
+        """
+        async def fetch():
+            try:
+                content = await self.room_methods.get_state_event(
+                    room_id, EventType.ROOM_MEMBER, state_key=user_id
+                )
+            except MNotFound:
+                return None
+            return content.membership
+
+        return await self._inflight.do(("member", room_id, user_id), fetch)
+
+    async def _get_membership_of(
+        self, room_id: RoomID, user_ids
+    ) -> Tuple[Set[str], Set[str]]:
+        """like get_room_membership, but only looks up the given users when there are few of them"""
+        if len(user_ids) > self.single_lookup_limit:
+            return await self.get_room_membership(room_id, use_cache=False)
+        members, invitees = set(), set()
+        for user_id in user_ids:
+            membership = await self.get_user_membership(room_id, user_id)
+            if membership == Membership.JOIN:
+                members.add(user_id)
+            elif membership == Membership.INVITE:
+                invitees.add(user_id)
+        return members, invitees
+
+    def _remember_invite(self, room_id: RoomID, user_id: UserID):
+        entry = self._cached(room_id, "members")
+        if entry is not None:
+            entry[1][1].add(user_id)
+
+    async def ensure_room_invitees(
+        self, room_id: RoomID, user_info_map: UserInfoMap
+    ) -> Dict[str, Exception]:
+        """invite every user in the map that is neither joined nor invited yet
+
+        A failed invite does not stop the remaining users from being invited. If the membership
+        of the room cant be looked up (i.e. while the homeserver is down), every user is reported
+        as failed with that error.
+
+        Returns:
+            Dict[str, Exception]: the users that could not be invited and the error for each.
+            If fully successful this will be empty
+        """
+        try:
+            room_members, room_invitees = await self._get_membership_of(
+                room_id, list(user_info_map)
+            )
+        except Exception as e:
+            self.logger.warning("Could not look up the members of %s: %s", room_id, e)
+            return {mxid: e for mxid in user_info_map}
+        self.logger.debug(
+            "Room %s has %d relevant members and %d invitees", room_id, len(room_members), len(room_invitees)
+        )
+        failures = {}
         for mxid in user_info_map:
             if mxid not in room_members and mxid not in room_invitees:
-                self.logger.debug(
-                    f"User {mxid} not invited or in the room, inviting..."
-                )
-                await self.room_methods.invite_user(room_id, mxid)
-        self.logger.debug(f"Successfully ensured invitees for {room_id}")
+                self.user_log.debug("User %s not invited or in the room, inviting...", mxid)
+                try:
+                    await self.room_methods.invite_user(room_id, mxid)
+                except Exception as e:
+                    self.logger.warning("Could not invite %s to %s: %s", mxid, room_id, e)
+                    failures[mxid] = e
+                else:
+                    self._remember_invite(room_id, mxid)
+        if len(failures) == 0:
+            self.logger.debug("Successfully ensured invitees for %s", room_id)
+        return failures
 
     async def ensure_room_power_levels(
         self, room_id: RoomID, user_info_map: UserInfoMap
     ):
-        current_state = await self.room_methods.get_state_event(
-            room_id, EventType.ROOM_POWER_LEVELS
-        )
-        current_power_levels: dict[UserID, int] = current_state["users"]
-        self.logger.debug(f"Current power levels: {str(current_power_levels)}")
-        for mxid in user_info_map:
-            current_power_levels[UserID(mxid)] = user_info_map[mxid]["power_level"]
-        await self.room_methods.send_state_event(
-            room_id,
-            EventType.ROOM_POWER_LEVELS,
-            PowerLevelStateEventContent(users=current_power_levels),
-        )
-        self.logger.debug(f"Successfully ensured power levels")
+        """make sure users have the given power levels, sending at most one power levels event
+
+        Users without a power level in the map are left alone. All other fields of the power
+        levels event are kept, and nothing is sent if every user already has the right level.
+
+        The cache only decides whether a change is needed. The change itself is applied to
+        power levels read fresh from the homeserver, one writer per room at a time, so
+        concurrent calls and changes made by room admins are not overwritten.
+        """
+        def changes_to(state) -> Dict[UserID, int]:
+            if state is None:
+                state = PowerLevelStateEventContent()
+            return {
+                UserID(mxid): info["power_level"]
+                for mxid, info in user_info_map.items()
+                if info.get("power_level") is not None
+                and state.get_user_level(UserID(mxid)) != info["power_level"]
+            }
+
+        if len(changes_to(await self.get_room_state(room_id, EventType.ROOM_POWER_LEVELS))) == 0:
+            self.logger.debug("Power levels in %s are already up to date", room_id)
+            return
+
+        async with self._room_locks.hold(("power_levels", room_id)):
+            current_state = await self._fetch_room_state(room_id, EventType.ROOM_POWER_LEVELS)
+            changes = changes_to(current_state)
+            if len(changes) == 0:
+                self.logger.debug("Power levels in %s were updated in the meantime", room_id)
+                return
+            if current_state is None:
+                current_state = PowerLevelStateEventContent()
+
+            # copy the fetched content rather than changing the cached object in place
+            new_state = PowerLevelStateEventContent.deserialize(current_state.serialize())
+            new_state.users.update(changes)
+            self.logger.debug("Updating power levels of %d users in %s", len(changes), room_id)
+            await self.set_room_state(room_id, EventType.ROOM_POWER_LEVELS, new_state)
+        self.logger.debug("Successfully ensured power levels")
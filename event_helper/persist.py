@@ -0,0 +1,56 @@
+import asyncio
+from typing import Callable, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class DelayedWriter(Generic[T]):
+    """Writes a file off the event loop, batching the changes made within `delay` seconds
+
+    `collect` runs on the event loop and should only copy what `write` needs, so the
+    data cant change while `write` runs in the executor.
+    """
+
+    def __init__(self, collect: Callable[[], T], write: Callable[[T], None], delay: float = 5):
+        self.collect = collect
+        self.write = write
+        self.delay = delay
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+        self._flush: Optional[asyncio.Event] = None
+
+    def schedule(self):
+        """write after `delay` seconds, together with any other changes made until then"""
+        self._dirty = True
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # not running in the bot, i.e. a script
+            self._dirty = False
+            self.write(self.collect())
+            return
+        if self._task is None or self._task.done():
+            self._flush = asyncio.Event()
+            self._task = asyncio.create_task(self._write_later(self._flush))
+
+    async def _write_later(self, flush: asyncio.Event):
+        try:
+            await asyncio.wait_for(flush.wait(), self.delay)
+        except asyncio.TimeoutError:
+            pass
+        await self._write_changes()
+
+    async def _write_changes(self):
+        loop = asyncio.get_running_loop()
+        while self._dirty:
+            self._dirty = False
+            await loop.run_in_executor(None, self.write, self.collect())
+
+    async def flush(self):
+        """write pending changes right away"""
+        if self._task is not None and not self._task.done():
+            # the writer is woken up rather than cancelled, so two writes never overlap
+            self._flush.set()
+            await self._task
+        else:
+            await self._write_changes()
@@ -1,7 +1,7 @@
 import requests
+from requests.adapters import HTTPAdapter
 import csv
-import json
-from typing import List, Dict, NewType
+from typing import Iterator, List, Dict, NewType, Set
 from functools import reduce
 from oauthlib.oauth2 import BackendApplicationClient
 from mautrix.util.logging import TraceLogger
@@ -9,22 +9,68 @@ from pathlib import Path
 from base64 import b64encode
 
 from requests_oauthlib import OAuth2Session
+from . import jsonutil
 from .auth import Token 
+from .ratelimit import RateLimiter, CircuitOpenError, get_rate_limiter
 
 from urllib.parse import urlparse, parse_qs
 from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+import time
 
 CSVData = NewType('CSVData', list[Dict[str, dict]])
 
 
-# TODO: make this stuff configurable.
+# webhook actions that can lead to an invite
+WEBHOOK_ACTIONS = {"pretix.event.order.paid"}
+
+# the only parts of an order the bot uses, everything else is left out of pretix responses
+ORDER_FIELDS = [
+    "code",
+    "status",
+    "email",
+    "datetime",
+    "positions.order",
+    "positions.item",
+    "positions.variation",
+    "positions.pseudonymization_id",
+    "positions.answers",
+]
+
+# headers of the attendee fields the bot knows about. Other fields are stored under their own name
+FIELD_HEADERS = {
+    "matrix": "Matrix ID",
+    "fas": "Fedora Account Services (FAS)",
+}
+
+# attendee field -> internal identifier of the pretix question that holds it
+DEFAULT_QUESTIONS = {
+    "matrix": "matrix",
+    "fas": "fas",
+}
+
+@dataclass(frozen=True)
+class AnswerPlan:
+    """a precompiled lookup from pretix question identifiers to the attendee fields their answers are stored in"""
+    headers: Dict[str, str]
+
+    @classmethod
+    def compile(cls, questions: Dict[str, str]):
+        """build a plan from a mapping of attendee field to pretix question identifier
+
+        The matrix field is always part of the plan since every attendee needs one.
+        """
+        questions = {"matrix": DEFAULT_QUESTIONS["matrix"], **questions}
+        return cls({identifier: FIELD_HEADERS.get(name, name) for name, identifier in questions.items()})
+
+    @property
+    def empty_answers(self) -> Dict[str, str]:
+        return {header: '' for header in self.headers.values()}
+
+DEFAULT_PLAN = AnswerPlan.compile(DEFAULT_QUESTIONS)
+
 def question_id_to_header(question_id:str):
-    if question_id == "fas":
-        return "Fedora Account Services (FAS)"
-    elif question_id == "matrix":
-        return "Matrix ID"
-    
-    return ""
+    return DEFAULT_PLAN.headers.get(question_id, "")
 
 @dataclass
 class AttendeeMatrixInformation:
@@ -45,20 +91,45 @@ class AttendeeMatrixInformation:
         # explicitly make a copy so mutations dont leak outside this function
         json_data = json_data.copy()
         order_code = json_data['Order code']
-        matrix_id = json_data[question_id_to_header("matrix")]
+        matrix_id = json_data[FIELD_HEADERS["matrix"]]
         del json_data['Order code']
-        del json_data[question_id_to_header("matrix")]
+        del json_data[FIELD_HEADERS["matrix"]]
 
         return cls(order_code, matrix_id, json_data if include_all_data else {})
 
+def localized(value, locale="en") -> str:
+    """pick a single string out of a pretix multi-language string"""
+    if isinstance(value, dict):
+        if locale in value:
+            return value[locale]
+        return next(iter(value.values()), "")
+    return value or ""
+
 class Pretix:
 
-    def __init__(self, client_id, client_secret, redirect_uri, log:TraceLogger, token_storage_path: Path = Path("."), token_storage_filename="pretix-token.json", instance_url="https://pretix.eu"):
+    def __init__(self, client_id, client_secret, redirect_uri, log:TraceLogger, token_storage_path: Path = Path("."), token_storage_filename="pretix-token.json", instance_url="https://pretix.eu", rate_limiter:RateLimiter=None, pool_size=10):
         self._instance_url = instance_url
+        self._pool_size = pool_size
+        self._auth_state = None
+        self.rate_limiter = rate_limiter if rate_limiter is not None else get_rate_limiter(instance_url)
         self._client_secret = client_secret
         self._processed_rows = []
+        # order code -> rooms its attendees were invited to, for orders not fully processed yet
+        self._processed_rooms: Dict[str, Set[str]] = {}
+        # order code -> rooms its attendees are routed to, for orders not fully processed yet
+        self._order_rooms: Dict[str, Set[str]] = {}
         self._client_id = client_id
         self.logger = log
+        self.answer_plan = DEFAULT_PLAN
+        # "organizer/event" -> AnswerPlan
+        self.event_answer_plans: Dict[str, AnswerPlan] = {}
+        # called with (token, updated_at) whenever a new token is received
+        self.token_listeners = []
+        # time the current token was received, in milliseconds. 0 if it was loaded from a file
+        self.token_updated_at = 0
+        # whether the session refreshes an expired token by itself. Turned off when replicas share
+        # the token, so only the replica holding the refresh lease refreshes it
+        self.auto_refresh = True
 
         if token_storage_path is None:
             token_storage_path = Path(".")
@@ -67,8 +138,8 @@ class Pretix:
 
         # if token storage file exists, save it
         if self.token_storage_file.exists():
-            data = self.token_storage_file.read_text()
-            self._token = Token.from_json(json.loads(data))
+            data = self.token_storage_file.read_bytes()
+            self._token = Token.from_json(jsonutil.loads(data))
             self.logger.debug("token loaded from file")
             # TODO: check this token to see if its still valid
 
@@ -85,7 +156,7 @@ class Pretix:
                 token=self._token.to_dict(),
                 scope=["read"],
                 redirect_uri=redirect_uri,
-                auto_refresh_url=self.token_url,
+                auto_refresh_url=self._auto_refresh_url,
                 token_updater=self._update_token
             )
         else:
@@ -94,6 +165,17 @@ class Pretix:
                 scope=["read"],
                 redirect_uri=redirect_uri
             )
+        self._mount_adapter()
+
+    def _mount_adapter(self):
+        """keep a pool of connections to the pretix instance open so requests can reuse them"""
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+        self.oauth.mount("https://", adapter)
+        self.oauth.mount("http://", adapter)
+
+    @property
+    def host(self):
+        return urlparse(self._instance_url).netloc
 
     
     @staticmethod
@@ -121,12 +203,25 @@ class Pretix:
         # test the auth
         if not self.has_token:
             return False, None
-        r = self.oauth.get(self.test_url, client_id=self._client_id, client_secret=self._client_secret)
+        try:
+            r = self._get(self.test_url)
+        except CircuitOpenError:
+            return False, None
         if r.status_code >= 200 and r.status_code < 300:
             return True, None
         else:
             return False, r
 
+    def _get(self, url, **kwargs):
+        """send a GET request to pretix through the shared rate limiter"""
+        return self.rate_limiter.request(
+            lambda: self.oauth.get(url, client_id=self._client_id, client_secret=self._client_secret, **kwargs)
+        )
+
+    @property
+    def circuit_state(self):
+        return self.rate_limiter.breaker.state
+
     @property
     def has_token(self):
         return self.oauth.authorized
@@ -148,6 +243,15 @@ class Pretix:
     def token_url(self):
         return self.base_url + "/oauth/token"
 
+    @property
+    def _auto_refresh_url(self):
+        return self.token_url if self.auto_refresh else None
+
+    def disable_auto_refresh(self):
+        """stop the session from refreshing expired tokens, see refresh_access_token"""
+        self.auto_refresh = False
+        self.oauth.auto_refresh_url = None
+
     @property
     def test_url(self):
         return self.base_url + "/me"
@@ -161,7 +265,45 @@ class Pretix:
             token (json): the token to store
         """
         self._token = Token.from_json(token)
-        self.token_storage_file.write_text(json.dumps(token), 'utf-8')
+        self.token_updated_at = time.time_ns() // 1_000_000
+        self.token_storage_file.write_text(jsonutil.dumps(token), 'utf-8')
+        for listener in self.token_listeners:
+            listener(token, self.token_updated_at)
+
+    @property
+    def token(self):
+        if getattr(self, '_token', None) is None:
+            return None
+        return self._token.to_dict()
+
+    def set_token(self, token:dict, updated_at:int):
+        """use a token that was received elsewhere (i.e. by another replica of the bot)
+
+        Args:
+            token (dict): the token to use
+            updated_at (int): the time the token was received, in milliseconds
+        """
+        self._token = Token.from_json(token)
+        self.token_updated_at = updated_at
+        self.oauth.token = self._token.to_dict()
+        self.oauth.auto_refresh_url = self._auto_refresh_url
+        self.oauth.token_updater = self._update_token
+        self.token_storage_file.write_text(jsonutil.dumps(token), 'utf-8')
+
+    def token_expires_within(self, seconds:float) -> bool:
+        if getattr(self, '_token', None) is None:
+            return False
+        return self._token.expires_at - datetime.now(tz=timezone.utc) < timedelta(seconds=seconds)
+
+    def refresh_access_token(self):
+        """refresh the access token now rather than waiting for a request to find it expired"""
+        token = self.oauth.refresh_token(
+            self.token_url,
+            client_id=self._client_id,
+            client_secret=self._client_secret,
+        )
+        self._update_token(token)
+        return token
 
     def handle_incoming_webhook(self, jsondata:dict) -> (bool, dict):
         """ handle the minimal data returned by a pretix webhook and fetch additional data
@@ -185,20 +327,20 @@ class Pretix:
 
         # verify some things:
         # is this for a valid action
-        if action != "pretix.event.order.paid":
+        if action not in WEBHOOK_ACTIONS:
             return (False, {"error": f"could not process webhook for notification {notification_id}", "debug": "action did not match the expected value"})
             
         # is this for the expected event and organizer
         # this info is not stored and cant be checked easily as currently implemented
 
         # have we processed this order already?
-        if code in self._processed_rows:
+        if self.is_processed(code):
             return (False, {"error": f"could not process webhook for notification {notification_id}", "debug": f"order {code} has already been processed"})
 
         # if not, fetch the full data and return it
        
         data = self.fetch_data(organizer, event, order_code=code)
-        data = self.extract_answers(data)
+        data = self.extract_answers(data, plan=self.plan_for(organizer, event))
         # embed organizer and event data so the matrix bot can look up what to do
         result = {}
         result["organizer"] = organizer
@@ -212,6 +354,7 @@ class Pretix:
         authorization_url, state = self.oauth.authorization_url(
             self.base_url + "/oauth/authorize"
         )
+        self._auth_state = state
         # client_id
         # response_type
         # scope
@@ -238,9 +381,10 @@ class Pretix:
             self._client_id,
             state=querystring.get("state")[0],
             # token=token,
-            auto_refresh_url=self.token_url,
+            auto_refresh_url=self._auto_refresh_url,
             token_updater=self._update_token
         )
+        self._mount_adapter()
         token = self.oauth.fetch_token(
             self.token_url,
             authorization_response=authorization_response,
@@ -250,6 +394,11 @@ class Pretix:
         return
 
 
+    def issued_auth_state(self, authorization_response:str) -> bool:
+        """check whether an auth callback URL belongs to an auth URL handed out by this client"""
+        state = parse_qs(urlparse(authorization_response).query).get("state")
+        return state is not None and self._auth_state is not None and state[0] == self._auth_state
+
     def revoke_access_token(self):
         """attempt to revoke the access token if it is suspected to have bene compromized or is no longer needed
         """
@@ -258,7 +407,7 @@ class Pretix:
             "token": self._token.access_token
         }
 
-        r = self.oauth.post(url)
+        r = self.rate_limiter.request(lambda: self.oauth.post(url))
         r.raise_for_status()
     
     @property
@@ -276,7 +425,26 @@ class Pretix:
         return self.fetch_data(organizer, event, order_code=order_code)
 
         
-    def fetch_data(self, organizer, event, order_code=None) -> dict:
+    def fetch_data(self, organizer, event, order_code=None, modified_since:datetime=None, item=None, variation=None, paid_only=True) -> dict:
+        """fetch one or all orders of an event
+
+        When fetching all orders, filtering is done by pretix so only the orders that
+        could lead to an invite are transferred, and only the fields listed in
+        ORDER_FIELDS are requested.
+
+        Args:
+            organizer (str): the pretix organizer slug
+            event (str): the pretix event slug
+            order_code (str, Optional): fetch only the order with this code. Defaults to None (all orders)
+            modified_since (datetime, Optional): only fetch orders that changed after this point in time.
+                Ignored when an order code is given. Defaults to None
+            item (str, Optional): only fetch orders containing this item. Defaults to None
+            variation (str, Optional): only fetch orders containing this item variation. Defaults to None
+            paid_only (bool, Optional): only fetch paid orders. Defaults to True
+
+        Returns:
+            list: the raw order data returned by pretix
+        """
         order_code = f"{order_code}/" if order_code is not None else ""
         url = self.base_url + f"/organizers/{organizer}/events/{event}/orders/" + order_code
 
@@ -284,22 +452,96 @@ class Pretix:
 
         if order_code == "":
             # many orders are being requested.
-            while url:
-                response = self.oauth.get(url, client_id=self._client_id, client_secret=self._client_secret)
-                response.raise_for_status()
-                json_response = response.json()
-                data.extend(json_response.get('results', []))
-                url = json_response.get('next')
+            for page in self.iter_order_pages(organizer, event, modified_since, item, variation, paid_only):
+                data.extend(page)
         else:
             # one order is requested
-            response = self.oauth.get(url, client_id=self._client_id, client_secret=self._client_secret)
+            response = self._get(url, params={"include": ORDER_FIELDS})
             response.raise_for_status()
-            json_response = response.json()
+            json_response = jsonutil.loads(response.content)
             data.append(json_response)
 
         return data
 
-    def extract_answers(self, schema: dict, filter_processed=False) -> List[AttendeeMatrixInformation]:
+    def iter_order_pages(self, organizer, event, modified_since:datetime=None, item=None, variation=None, paid_only=True) -> Iterator[list]:
+        """fetch the orders of an event one page at a time, see fetch_data for the arguments
+
+        Each page is only requested once the previous one has been consumed,
+        so large events never have to be held in memory at once.
+
+        Yields:
+            list: the raw order data of one page
+        """
+        url = self.base_url + f"/organizers/{organizer}/events/{event}/orders/"
+        params = {"testmode": "false", "include": ORDER_FIELDS}
+        if paid_only:
+            params["status"] = "p"
+        if modified_since is not None:
+            params["modified_since"] = modified_since.isoformat()
+        if item is not None:
+            params["item"] = item
+        if variation is not None:
+            params["variation"] = variation
+        while url:
+            # the "next" links returned by pretix already carry the query string
+            response = self._get(url, params=params)
+            params = {}
+            response.raise_for_status()
+            json_response = jsonutil.loads(response.content)
+            yield json_response.get('results', [])
+            url = json_response.get('next')
+
+    def configure_questions(self, questions: Dict[str, str], event_questions: Dict[str, Dict[str, str]] = None):
+        """compile the question mappings from the config into answer plans
+
+        Args:
+            questions (Dict[str, str]): attendee field -> pretix question identifier used for all events
+            event_questions (Dict[str, Dict[str, str]], Optional): per event overrides keyed by "organizer/event"
+        """
+        questions = questions or DEFAULT_QUESTIONS
+        self.answer_plan = AnswerPlan.compile(questions)
+        self.event_answer_plans = {
+            key: AnswerPlan.compile({**questions, **overrides})
+            for key, overrides in (event_questions or {}).items()
+        }
+
+    def plan_for(self, organizer, event) -> AnswerPlan:
+        return self.event_answer_plans.get(f"{organizer}/{event}", self.answer_plan)
+
+    def fetch_items(self, organizer, event) -> list:
+        """fetch the items (ticket types) of an event, including their variations
+
+        Returns:
+            list: the raw item data returned by pretix
+        """
+        url = self.base_url + f"/organizers/{organizer}/events/{event}/items/"
+        params = {"active": "true"}
+        data = []
+        while url:
+            response = self._get(url, params=params)
+            params = {}
+            response.raise_for_status()
+            json_response = jsonutil.loads(response.content)
+            data.extend(json_response.get('results', []))
+            url = json_response.get('next')
+        return data
+
+    def fetch_event(self, organizer, event) -> dict:
+        """fetch the details of an event, i.e. to check that it can be reached
+
+        Returns:
+            dict: the raw event data returned by pretix
+        """
+        response = self._get(self.base_url + f"/organizers/{organizer}/events/{event}/")
+        response.raise_for_status()
+        return jsonutil.loads(response.content)
+
+    def extract_answers(self, schema: dict, filter_processed=False, plan:AnswerPlan=None) -> List[AttendeeMatrixInformation]:
+        if plan is None:
+            plan = self.answer_plan
+        headers = plan.headers
+        empty_answers = plan.empty_answers
+
         def reducer(entries: Dict[str, dict], result: dict) -> Dict[str, dict]:
             for position in result.get('positions', []):
                 ticket_id = position['order']
@@ -310,13 +552,15 @@ class Pretix:
                         'Email': result.get('email', ''),
                         "Order datetime": result.get("datetime", ''),
                         "Pseudonymization ID": position.get("pseudonymization_id", ''),
-                        "Fedora Account Services (FAS)": '',
-                        "Matrix ID": '',
+                        "Item ID": position.get("item"),
+                        "Variation ID": position.get("variation"),
+                        **empty_answers,
                         # "Invoice address name": result.get('invoice_address', {}).get('name', ''),
                     }
                 for answer in position.get('answers', []):
-                    if answer['question_identifier'] in {'matrix', 'fas'}:
-                        entries[ticket_id][question_id_to_header(answer['question_identifier'])] = answer['answer']  # noqa: E501
+                    header = headers.get(answer['question_identifier'])
+                    if header is not None:
+                        entries[ticket_id][header] = answer['answer']
             return entries
 
         reduced_results = reduce(reducer, schema, {})
@@ -335,12 +579,66 @@ class Pretix:
         Args:
             rows (List[AttendeeMatrixInformation]): a List of attendee data to mark as processed
         """
-        processed_order_ids = [d.order_code for d in rows]
+        self.mark_codes_as_processed([d.order_code for d in rows], replace=replace)
 
+    def is_processed(self, order_code:str) -> bool:
+        return order_code in self._processed_rows
+
+    def mark_codes_as_processed(self, processed_order_ids: List[str], replace=False):
+        """add order codes to the processed dataset, see mark_as_processed"""
         if replace:
             self._processed_rows = processed_order_ids
         else:
             self._processed_rows = list(set(self._processed_rows).union(set(processed_order_ids)))
+        for order_id in processed_order_ids:
+            self._processed_rooms.pop(order_id, None)
+            self._order_rooms.pop(order_id, None)
+
+    def route_order(self, order_code:str, rooms):
+        """note which rooms the attendees of an order are to be invited to, see order_rooms_done"""
+        self._order_rooms.setdefault(order_code, set()).update(rooms)
+
+    def mark_room_processed(self, order_code:str, room:str):
+        """note that the attendees of an order were invited to one of its rooms"""
+        self._processed_rooms.setdefault(order_code, set()).add(room)
+
+    def processed_rooms(self, order_code:str) -> Set[str]:
+        """the rooms the attendees of an order were invited to, until the whole order is processed"""
+        return set(self._processed_rooms.get(order_code, ()))
+
+    def order_rooms_done(self, order_code:str) -> bool:
+        """whether the attendees of an order were invited to every room it is routed to.
+        False if the rooms of the order are not known"""
+        routed = self._order_rooms.get(order_code)
+        return bool(routed) and self.processed_rooms(order_code).issuperset(routed)
+
+    def room_progress(self) -> Dict[str, Dict[str, List[str]]]:
+        """the rooms of every order that is not fully processed yet, to be restored with restore_room_progress
+
+        Returns:
+            Dict[str, Dict[str, List[str]]]: order code -> {"routed": rooms, "processed": rooms}
+        """
+        return {
+            code: {
+                "routed": sorted(self._order_rooms.get(code, ())),
+                "processed": sorted(self._processed_rooms.get(code, ())),
+            }
+            for code in self._order_rooms.keys() | self._processed_rooms.keys()
+        }
+
+    def restore_room_progress(self, progress: Dict[str, Dict[str, List[str]]]):
+        """merge the rooms of orders saved by room_progress (or by another replica). Processed orders are skipped"""
+        for code, rooms in progress.items():
+            if self.is_processed(code):
+                continue
+            if len(rooms.get("routed", [])) > 0:
+                self.route_order(code, rooms["routed"])
+            for room in rooms.get("processed", []):
+                self.mark_room_processed(code, room)
+
+    def processed_codes(self) -> List[str]:
+        """the order codes marked as processed, see mark_as_processed"""
+        return list(self._processed_rows)
 
 
     def filter_dict(self, old_dict: dict, your_keys: list[str]) -> dict:
@@ -363,3 +661,78 @@ class Pretix:
         """
         # return a list of records from the full data as long as they are not in the list of processed records
         return list(filter(lambda d: d.order_code not in processed_ids, data))
+
+
+class PretixPool:
+    """The pretix clients the bot can use, keyed by the host of their instance
+
+    Each client has its own token file, connection pool and rate limiter. The first
+    instance added is the default, which is used when nothing else identifies an instance.
+    """
+
+    def __init__(self, log:TraceLogger):
+        self.logger = log
+        self.clients: Dict[str, Pretix] = {}
+        self._default = None
+        # organizer slug -> instance host
+        self._organizers: Dict[str, str] = {}
+
+    def add(self, client:Pretix, organizers:List[str]=None):
+        self.clients[client.host] = client
+        if self._default is None:
+            self._default = client
+        for organizer in organizers or []:
+            self._organizers[organizer] = client.host
+
+    @property
+    def default(self) -> Pretix:
+        return self._default
+
+    def __iter__(self):
+        return iter(self.clients.values())
+
+    def __len__(self):
+        return len(self.clients)
+
+    def get(self, host:str) -> Pretix:
+        return self.clients.get(host)
+
+    def remember(self, organizer:str, client:Pretix):
+        """note which instance an organizer lives on so webhooks and background jobs can find it"""
+        self._organizers[organizer] = client.host
+
+    def for_organizer(self, organizer:str) -> Pretix:
+        host = self._organizers.get(organizer)
+        if host is not None and host in self.clients:
+            return self.clients[host]
+        return self._default
+
+    def for_url(self, pretix_url:str):
+        """pick the client for a pretix event URL
+
+        Args:
+            pretix_url (str): the pretix invitation URL of the event
+
+        Raises:
+            ValueError: if the URL is invalid or points to an instance that is not configured
+
+        Returns:
+            tuple: the client, the organizer and the event
+        """
+        organizer, event = Pretix.parse_invite_url(pretix_url)
+        host = urlparse(pretix_url).netloc
+        if host == "":
+            client = self.for_organizer(organizer)
+        else:
+            client = self.clients.get(host)
+            if client is None:
+                raise ValueError(f"No pretix instance is configured for {host}")
+        self.remember(organizer, client)
+        return (client, organizer, event)
+
+    def for_auth_callback(self, authorization_response:str) -> Pretix:
+        """find the client that issued the auth URL an auth callback belongs to, falling back to the default"""
+        for client in self:
+            if client.issued_auth_state(authorization_response):
+                return client
+        return self._default
@@ -0,0 +1,90 @@
+import asyncio
+import re
+from dataclasses import dataclass
+from typing import List, Optional
+
+from .matrix_utils import MatrixUtils
+from .pretix import localized
+
+
+def slugify(text: str) -> str:
+    """turn a ticket name into something usable as part of a room alias"""
+    slug = re.sub(r"[^a-z0-9._=-]+", "-", text.lower())
+    return slug.strip("-")
+
+
+@dataclass(frozen=True)
+class RoomSpec:
+    """a room to provision for one item or item variation of an event"""
+    alias: str
+    name: str
+    item: str
+    variant: Optional[str] = None
+
+
+@dataclass
+class ProvisionResult:
+    spec: RoomSpec
+    room_id: Optional[str] = None
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def plan_rooms(event: str, items: list, server: str, item_ids: List[str] = None) -> List[RoomSpec]:
+    """decide which rooms to create for the items of an event
+
+    Items with variations get a room per variation, other items get one room each.
+
+    Args:
+        event (str): the pretix event slug, used as alias prefix
+        items (list): the raw item data from pretix
+        server (str): the homeserver the aliases live on
+        item_ids (List[str], Optional): only plan rooms for these items. Defaults to all items
+
+    Returns:
+        List[RoomSpec]: the rooms to provision
+    """
+    specs = []
+    for item in items:
+        item_id = str(item["id"])
+        if item_ids and item_id not in item_ids:
+            continue
+        item_name = localized(item.get("name"))
+        variations = item.get("variations") or []
+        if len(variations) == 0:
+            specs.append(RoomSpec(f"#{slugify(event)}-{slugify(item_name)}:{server}", item_name, item_id))
+            continue
+        for variation in variations:
+            variation_name = localized(variation.get("value"))
+            specs.append(RoomSpec(
+                f"#{slugify(event)}-{slugify(item_name)}-{slugify(variation_name)}:{server}",
+                f"{item_name} - {variation_name}",
+                item_id,
+                str(variation["id"]),
+            ))
+    return specs
+
+
+async def provision_rooms(matrix_utils: MatrixUtils, specs: List[RoomSpec], visibility: str,
+                          concurrency: int = 4) -> List[ProvisionResult]:
+    """make sure a room with the right alias, name and visibility exists for every spec
+
+    At most `concurrency` rooms are worked on at once. Failures are returned rather than raised
+    so one broken room doesnt stop the others.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def provision(spec: RoomSpec) -> ProvisionResult:
+        async with semaphore:
+            try:
+                room_id = await matrix_utils.ensure_room_with_alias(spec.alias)
+                await matrix_utils.ensure_room_name(room_id, spec.name)
+                await matrix_utils.ensure_room_visibility(room_id, visibility)
+            except Exception as e:
+                return ProvisionResult(spec, error=e)
+            return ProvisionResult(spec, room_id=room_id)
+
+    return list(await asyncio.gather(*(provision(spec) for spec in specs)))
@@ -0,0 +1,257 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict
+
+import requests
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """raised instead of sending a request while the circuit breaker considers pretix to be down"""
+
+
+class TokenBucket:
+    """A thread safe token bucket. Requests to pretix are synchronous and may be sent
+    from executor threads, so this blocks the calling thread rather than awaiting.
+    """
+
+    def __init__(self, rate: float, capacity: int, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """take one token out of the bucket, waiting for it to refill if needed"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+
+
+class CircuitBreaker:
+    """Stops sending requests for `reset_timeout` seconds after `failure_threshold`
+    consecutive failures. After that a single trial request is let through (half-open)
+    and its outcome decides whether the circuit closes again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        # whether the trial request of the half-open state has been sent and not come back yet
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    @property
+    def retry_in(self) -> float:
+        """seconds until the next trial request will be allowed through"""
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(0, self.reset_timeout - (self._clock() - self._opened_at))
+
+    def before_request(self) -> bool:
+        """check whether a request may be sent
+
+        Raises:
+            CircuitOpenError: if the circuit is open, or half-open with the trial request still in flight
+
+        Returns:
+            bool: whether this request is the trial request of the half-open state
+        """
+        with self._lock:
+            state = self._state()
+            if state == self.OPEN or (state == self.HALF_OPEN and self._trial_in_flight):
+                raise CircuitOpenError("pretix appears to be unavailable, not sending request")
+            if state == self.HALF_OPEN:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def release_trial(self):
+        """let another request be the trial, when the trial ended without telling whether pretix is up"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state() == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+
+
+def parse_retry_after(value: str):
+    """parse a Retry-After header, which may be a number of seconds or an HTTP date
+
+    Returns:
+        float: the number of seconds to wait, or None if the header could not be parsed
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(tz=timezone.utc)).total_seconds())
+
+
+class RateLimiter:
+    """Combines a token bucket, retries and a circuit breaker around requests to one pretix instance
+
+    - 429 responses are retried after waiting for `Retry-After` (or the backoff if it is missing).
+      If pretix asks to wait longer than `max_retry_after` seconds, the 429 is returned right away
+    - 5xx responses and connection errors are retried with exponential backoff and jitter
+      and count as failures for the circuit breaker
+    """
+
+    def __init__(self, rate: float = 5, burst: int = 10, max_retries: int = 4, backoff_base: float = 0.5,
+                 backoff_max: float = 30, failure_threshold: int = 5, reset_timeout: float = 60,
+                 max_retry_after: float = 120, clock=time.monotonic, sleep=time.sleep):
+        self.bucket = TokenBucket(rate, burst, clock=clock, sleep=sleep)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout, clock=clock)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self._sleep = sleep
+
+    def configure(self, rate: float = None, burst: int = None, max_retries: int = None,
+                  failure_threshold: int = None, reset_timeout: float = None, max_retry_after: float = None):
+        """update the settings of an existing limiter without resetting its state"""
+        if rate is not None:
+            self.bucket.rate = rate
+        if burst is not None:
+            self.bucket.capacity = burst
+        if max_retries is not None:
+            self.max_retries = max_retries
+        if failure_threshold is not None:
+            self.breaker.failure_threshold = failure_threshold
+        if reset_timeout is not None:
+            self.breaker.reset_timeout = reset_timeout
+        if max_retry_after is not None:
+            self.max_retry_after = max_retry_after
+
+    def backoff(self, attempt: int) -> float:
+        """exponential backoff with full jitter"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def request(self, send: Callable[[], requests.Response]) -> requests.Response:
+        """send a request through the limiter, retrying it if pretix asks us to
+
+        Args:
+            send (Callable[[], requests.Response]): a function that sends the request
+
+        Raises:
+            CircuitOpenError: if pretix has been failing and the circuit breaker is open
+
+        Returns:
+            requests.Response: the last response received. It is up to the caller to check its status
+        """
+        attempt = 0
+        while True:
+            trial = self.breaker.before_request()
+            try:
+                self.bucket.acquire()
+                response = send()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise
+                self._sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            except BaseException:
+                if trial:
+                    self.breaker.release_trial()
+                raise
+
+            if response.status_code == 429:
+                if trial:
+                    self.breaker.release_trial()
+                if attempt >= self.max_retries:
+                    return response
+                wait = parse_retry_after(response.headers.get("Retry-After"))
+                if wait is not None and wait > self.max_retry_after:
+                    # holding the request (and an executor thread) that long is worse than failing it
+                    return response
+                self._sleep(wait if wait is not None else self.backoff(attempt))
+            elif response.status_code >= 500:
+                self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    return response
+                self._sleep(self.backoff(attempt))
+            else:
+                self.breaker.record_success()
+                return response
+            attempt += 1
+
+
+# limiters are shared by every pretix client talking to the same instance within this process
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(instance_url: str, **settings) -> RateLimiter:
+    """return the process-wide rate limiter for a pretix instance, creating it if needed
+
+    Args:
+        instance_url (str): the URL of the pretix instance
+        **settings: settings passed to RateLimiter.configure
+
+    Returns:
+        RateLimiter: the shared limiter for this instance
+    """
+    key = instance_url.rstrip("/")
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter()
+    limiter.configure(**settings)
+    return limiter
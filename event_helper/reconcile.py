@@ -0,0 +1,180 @@
+import asyncio
+import random
+from datetime import datetime, timezone
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from mautrix.util.logging import TraceLogger
+
+from .pretix import Pretix, AttendeeMatrixInformation
+from .scheduler import BULK
+
+# invite callback: takes a room id or alias, the attendees to invite there and
+# the organizer and event they belong to as keyword arguments, and returns the attendees that could not be invited (see EventManagement.invite_attendees)
+InviteCallback = Callable[..., Awaitable[List[AttendeeMatrixInformation]]]
+# routing callback: takes the organizer, event and an attendee and returns the IDs or aliases of
+# the rooms the attendee belongs in (see EventManagement.rooms_for_attendee)
+RoomsCallback = Callable[[str, str, AttendeeMatrixInformation], List[str]]
+
+
+class Reconciler:
+    """Periodically walks every mapped event and invites attendees that were missed,
+    for example because a webhook was never delivered while the bot was down.
+
+    Only orders that changed since the last successful run of an event are fetched
+    from pretix, and at most `concurrency` events are processed at the same time so
+    a sweep never crowds out live webhook traffic.
+    """
+
+    def __init__(self, pretix_for: Callable[[str], Pretix], room_mapping, invite: InviteCallback, log: TraceLogger,
+                 interval: float = 3600, jitter: float = 0, concurrency: int = 1, shared_state=None, scheduler=None,
+                 rooms_for: RoomsCallback = None, refresh_mapping: Callable[[], Awaitable[None]] = None):
+        # returns the pretix client for an organizer
+        self.pretix_for = pretix_for
+        self.room_mapping = room_mapping
+        self.invite = invite
+        # attendees are routed the same way as by webhooks when given, by their ticket alone otherwise
+        self.rooms_for = rooms_for if rooms_for is not None else self._rooms_by_ticket
+        # awaited before each sweep, e.g. to pick up rooms mapped on other replicas
+        self.refresh_mapping = refresh_mapping
+        self.logger = log
+        self.interval = interval
+        self.jitter = jitter
+        self.concurrency = max(1, concurrency)
+        # (organizer, event) -> start time of the last run that fully succeeded
+        self._last_run: Dict[Tuple[str, str], datetime] = {}
+        self._task = None
+        # when running several replicas, events are reconciled by one replica at a time
+        self.shared_state = shared_state
+        # fetches run at bulk priority when a PriorityScheduler is given
+        self.scheduler = scheduler
+
+    def start(self):
+        if self.interval <= 0:
+            self.logger.info("periodic reconciliation is disabled")
+            return
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval + random.uniform(0, self.jitter))
+            try:
+                await self.sweep()
+            except Exception as e:
+                self.logger.exception(f"reconciliation sweep failed: {e}")
+
+    async def sweep(self):
+        """reconcile every (organizer, event) pair that has at least one mapped room"""
+        if self.refresh_mapping is not None:
+            await self.refresh_mapping()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def guarded(organizer, event):
+            async with semaphore:
+                await self.reconcile_event(organizer, event)
+
+        events = []
+        for organizer, event in self.room_mapping.events():
+            if not self.pretix_for(organizer).has_token:
+                self.logger.debug("skipping reconciliation of %s/%s, pretix is not authorized", organizer, event)
+                continue
+            events.append((organizer, event))
+        results = await asyncio.gather(*(guarded(o, e) for o, e in events), return_exceptions=True)
+        for (organizer, event), result in zip(events, results):
+            if isinstance(result, Exception):
+                self.logger.error(f"failed to reconcile event {event} from organizer {organizer}: {result}")
+
+    def watermarks(self) -> Dict[str, str]:
+        """the start time of the last successful run of every event, to be restored with restore_watermarks
+
+        Returns:
+            Dict[str, str]: "organizer/event" -> ISO 8601 timestamp
+        """
+        return {f"{organizer}/{event}": started.isoformat() for (organizer, event), started in self._last_run.items()}
+
+    def restore_watermarks(self, watermarks: Dict[str, str]):
+        """continue from the runs recorded before a restart, see watermarks. Newer runs are kept"""
+        for key, started in watermarks.items():
+            organizer, event = key.split("/", 1)
+            started = datetime.fromisoformat(started)
+            current = self._last_run.get((organizer, event))
+            if current is None or started > current:
+                self._last_run[(organizer, event)] = started
+
+    def _rooms_by_ticket(self, organizer: str, event: str, attendee: AttendeeMatrixInformation) -> List[str]:
+        rooms = self.room_mapping.rooms_by_ticket_variant(
+            organizer, event, attendee.extra.get("Item ID"), attendee.extra.get("Variation ID")
+        )
+        return [room.matrix_id for room in rooms]
+
+    async def reconcile_event(self, organizer: str, event: str):
+        """fetch the orders of an event changed since the last run and invite anyone missing
+
+        Args:
+            organizer (str): the pretix organizer slug
+            event (str): the pretix event slug
+        """
+        pretix = self.pretix_for(organizer)
+        started = datetime.now(tz=timezone.utc)
+        since = self._last_run.get((organizer, event))
+
+        if self.shared_state is not None:
+            # the lease is left to expire so other replicas skip this event until the next sweep
+            if not await self.shared_state.acquire_lease(f"reconcile:{organizer}/{event}", self.interval):
+                self.logger.debug("%s/%s is being reconciled by another replica", organizer, event)
+                return
+            await self.shared_state.sync_token(pretix)
+            pretix.mark_codes_as_processed(await self.shared_state.processed_codes(organizer, event))
+
+        condition = self.room_mapping.ticket_filter(organizer, event)
+
+        # the pretix client is synchronous, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        fetch = partial(
+            pretix.fetch_data, organizer, event, modified_since=since,
+            item=condition.item, variation=condition.variant
+        )
+        if self.scheduler is not None:
+            async with self.scheduler.slot(BULK):
+                data = await loop.run_in_executor(None, fetch)
+        else:
+            data = await loop.run_in_executor(None, fetch)
+        attendees = pretix.extract_answers(data, filter_processed=True, plan=pretix.plan_for(organizer, event))
+
+        by_room: Dict[str, List[AttendeeMatrixInformation]] = {}
+        routed = []
+        for attendee in attendees:
+            rooms = self.rooms_for(organizer, event, attendee)
+            for room in rooms:
+                by_room.setdefault(room, []).append(attendee)
+            if len(rooms) > 0:
+                routed.append(attendee)
+
+        failed = set()
+        complete = True
+        for room, room_attendees in by_room.items():
+            try:
+                invalid = await self.invite(room, room_attendees, organizer=organizer, event=event)
+            except Exception as e:
+                self.logger.error(f"reconciliation could not invite attendees of {organizer}/{event} to {room}: {e}")
+                failed.update(a.order_code for a in room_attendees)
+                complete = False
+                continue
+            failed.update(a.order_code for a in invalid)
+
+        processed = [a for a in routed if a.order_code not in failed]
+        pretix.mark_as_processed(processed)
+        if self.shared_state is not None:
+            await self.shared_state.mark_processed(organizer, event, [a.order_code for a in processed])
+
+        # invalid matrix IDs will only change together with the order, but transient
+        # errors should be picked up again by the next run
+        if complete:
+            self._last_run[(organizer, event)] = started
+
+        self.logger.debug("reconciled %d attendees for event %s from organizer %s", len(attendees), event, organizer)
@@ -0,0 +1,277 @@
+"""Replay captured pretix webhooks against local stand-ins for pretix and the homeserver
+
+Capture webhooks by setting `webhook_capture_path` in the bot's configuration, then run
+
+    python -m event_helper.replay capture.jsonl --speed 10
+
+to feed them into the webhook handler at ten times the original pace (or `--speed max`
+to send them as fast as possible) and get a report of throughput, latency and errors.
+Only the HTTP session of the pretix client is replaced, so order lookups still pass
+through the rate limiter, the JSON decoding and the answer extraction of the bot.
+"""
+import argparse
+import asyncio
+import logging
+import math
+import tempfile
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from mautrix.api import HTTPAPI
+from mautrix.errors import MNotFound
+
+from . import EventManagement, EventRooms
+from . import jsonutil
+from .matrix_utils import MatrixUtils
+from .pretix import Pretix, PretixPool
+from .ratelimit import RateLimiter
+from .standalone import build_plugin, default_config
+
+
+def load_capture(path: Path) -> List[dict]:
+    """read a capture file, oldest webhook first"""
+    with open(path, "rb") as capture:
+        entries = [jsonutil.loads(line) for line in capture if line.strip()]
+    return sorted(entries, key=lambda entry: entry["received_at"])
+
+
+def percentile(values: List[float], p: float) -> float:
+    """the p-th percentile (0-100) of some values, using the nearest rank"""
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(p / 100 * len(ordered))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+def stand_in_order(code: str) -> dict:
+    """an order as pretix returns it, with one position whose attendee gave a matrix ID"""
+    return {
+        "code": code,
+        "status": "p",
+        "email": f"{code.lower()}@example.org",
+        "datetime": "2024-01-01T00:00:00Z",
+        "positions": [{
+            "order": code,
+            "item": 1,
+            "variation": None,
+            "pseudonymization_id": code,
+            "answers": [{"question_identifier": "matrix", "answer": f"@{code.lower()}:example.org"}],
+        }],
+    }
+
+
+class StandInSession:
+    """takes the place of the HTTP session of a Pretix client and answers with canned pretix
+    responses after a fixed delay. Every order looked up exists and has one attendee"""
+    authorized = True
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.order_fetches = 0
+        self._lock = threading.Lock()
+
+    def get(self, url, params=None, **kwargs) -> requests.Response:
+        # runs in an executor thread like the real session
+        time.sleep(self.latency)
+        path = [part for part in urlparse(url).path.split("/") if part]
+        if len(path) >= 2 and path[-2] == "orders":
+            with self._lock:
+                self.order_fetches += 1
+            return self.respond(200, stand_in_order(path[-1]))
+        if path and path[-1] in ("orders", "items"):
+            return self.respond(200, {"count": 0, "next": None, "previous": None, "results": []})
+        return self.respond(404, {"detail": "Not found."})
+
+    @staticmethod
+    def respond(status: int, body: dict) -> requests.Response:
+        response = requests.Response()
+        response.status_code = status
+        response.headers["Content-Type"] = "application/json"
+        response._content = jsonutil.dumps(body).encode("utf-8")
+        return response
+
+
+class StandInPretix(Pretix):
+    """a real pretix client talking to a StandInSession, so webhooks go through the same
+    lookups, rate limiting and decoding as in the bot"""
+
+    def __init__(self, log: logging.Logger, workdir: Path, latency: float = 0.05, rate_limiter: RateLimiter = None):
+        super().__init__("stand-in", "stand-in", "https://pretix.stand-in/redirect", log,
+                         token_storage_path=workdir, instance_url="https://pretix.stand-in",
+                         rate_limiter=rate_limiter if rate_limiter is not None else RateLimiter())
+        self.oauth = StandInSession(latency)
+
+    @property
+    def fetches(self) -> int:
+        return self.oauth.order_fetches
+
+
+class StandInHomeserver:
+    """an empty homeserver that accepts every invite after a fixed delay"""
+
+    def __init__(self, latency: float = 0.02):
+        self.latency = latency
+        self.invites = 0
+
+    async def get_joined_members(self, room_id):
+        await asyncio.sleep(self.latency)
+        return {}
+
+    async def get_members(self, room_id, membership=None, not_membership=None):
+        await asyncio.sleep(self.latency)
+        return []
+
+    async def get_state_event(self, room_id, event_type, state_key=""):
+        await asyncio.sleep(self.latency)
+        raise MNotFound(404, "not a member")
+
+    async def invite_user(self, room_id, user_id):
+        await asyncio.sleep(self.latency)
+        self.invites += 1
+
+
+class ReplayRequest:
+    def __init__(self, entry: dict):
+        self.body = entry["body"]
+        self.query = entry.get("query", {})
+
+    async def json(self, loads=None):
+        return self.body
+
+
+@dataclass
+class ReplayReport:
+    sent: int = 0
+    duration: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+    errors: Counter = field(default_factory=Counter)
+    pretix_fetches: int = 0
+    invites: int = 0
+
+    @property
+    def throughput(self) -> float:
+        return self.sent / self.duration if self.duration > 0 else 0.0
+
+    def lines(self) -> List[str]:
+        lines = [
+            f"replayed {self.sent} webhooks in {self.duration:.2f}s ({self.throughput:.1f}/s)",
+            "latency: " + ", ".join(
+                f"p{p} {percentile(self.latencies, p) * 1000:.1f}ms" for p in (50, 90, 99)
+            ) + f", max {max(self.latencies, default=0) * 1000:.1f}ms",
+            f"pretix order fetches: {self.pretix_fetches}, invites sent: {self.invites}",
+            f"errors: {sum(self.errors.values())}",
+        ]
+        lines += [f"* {count}x {error}" for error, count in self.errors.most_common()]
+        return lines
+
+
+def build_replay_plugin(entries: List[dict], pretix: StandInPretix, homeserver: StandInHomeserver,
+                        workdir: Path, log: logging.Logger, config: Optional[Dict] = None) -> EventManagement:
+    """set up the plugin with build_plugin, against the stand-ins
+
+    Every event seen in the capture is mapped to a room of its own.
+    """
+    # a real HTTPAPI so MatrixUtils is built as usual, but every call goes to the stand-in
+    matrix_api = HTTPAPI("https://homeserver.stand-in")
+    matrix_utils = MatrixUtils(matrix_api, log)
+    matrix_utils.room_methods = homeserver
+    matrix_utils.event_methods = homeserver
+
+    pretix_pool = PretixPool(log)
+    pretix_pool.add(pretix)
+    room_mapping = EventRooms(persist_path=workdir)
+    for entry in entries:
+        organizer, event = entry["body"].get("organizer"), entry["body"].get("event")
+        if len(room_mapping.rooms_by_event(organizer, event)) == 0:
+            room_mapping.add(organizer, event, f"!{organizer}-{event}:stand-in")
+
+    plugin = build_plugin(log, config, matrix_utils=matrix_utils, room_mapping=room_mapping,
+                          pretix_pool=pretix_pool, workdir=workdir)
+    plugin.matrix_api = matrix_api
+    return plugin
+
+
+async def replay(entries: List[dict], speed: Optional[float] = 1.0, pretix_latency: float = 0.05,
+                 matrix_latency: float = 0.02, log: logging.Logger = None) -> ReplayReport:
+    """feed captured webhooks into the webhook handler, keeping their original spacing divided by `speed`
+
+    Args:
+        entries (List[dict]): the captured webhooks, see load_capture
+        speed (float, optional): how much faster than recorded to replay. None replays as fast as possible
+        pretix_latency (float, optional): seconds the pretix stand-in takes to answer
+        matrix_latency (float, optional): seconds the homeserver stand-in takes to answer
+
+    Returns:
+        ReplayReport: throughput, latencies and errors of the replay
+    """
+    log = log or logging.getLogger("replay")
+    homeserver = StandInHomeserver(matrix_latency)
+    report = ReplayReport()
+    config = default_config()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # limited like the bot limits a pretix instance, but not shared with any other client
+        rate_limiter = RateLimiter(
+            rate=config["pretix_rate_limit"],
+            burst=config["pretix_rate_burst"],
+            max_retries=config["pretix_max_retries"],
+            max_retry_after=config["pretix_max_retry_after"],
+            failure_threshold=config["pretix_circuit_threshold"],
+            reset_timeout=config["pretix_circuit_reset"],
+        )
+        pretix = StandInPretix(log, Path(workdir), pretix_latency, rate_limiter)
+        plugin = build_replay_plugin(entries, pretix, homeserver, Path(workdir), log)
+
+        async def send(entry: dict, delay: float):
+            await asyncio.sleep(delay)
+            started = time.monotonic()
+            try:
+                response = await plugin.handle_pretix_webhook(ReplayRequest(entry))
+            except Exception as e:
+                report.errors[f"{type(e).__name__}: {e}"] += 1
+            else:
+                if response.status >= 300:
+                    report.errors[f"HTTP {response.status}"] += 1
+            report.latencies.append(time.monotonic() - started)
+
+        try:
+            first = entries[0]["received_at"] if entries else 0
+            started = time.monotonic()
+            await asyncio.gather(*(
+                send(entry, (entry["received_at"] - first) / speed if speed else 0) for entry in entries
+            ))
+            report.duration = time.monotonic() - started
+        finally:
+            await plugin.matrix_api.session.close()
+
+    report.sent = len(entries)
+    report.pretix_fetches = pretix.fetches
+    report.invites = homeserver.invites
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay captured pretix webhooks against local stand-ins")
+    parser.add_argument("capture", type=Path, help="a file written by the webhook_capture_path option")
+    parser.add_argument("--speed", default="1",
+                        help="how much faster than recorded to replay, e.g. 1 or 10, or 'max' (default: 1)")
+    parser.add_argument("--pretix-latency", type=float, default=0.05, help="seconds per pretix request")
+    parser.add_argument("--matrix-latency", type=float, default=0.02, help="seconds per homeserver request")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's log messages")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    speed = None if args.speed == "max" else float(args.speed)
+    report = asyncio.run(replay(load_capture(args.capture), speed, args.pretix_latency, args.matrix_latency))
+    print("\n".join(report.lines()))
+
+
+if __name__ == "__main__":
+    main()
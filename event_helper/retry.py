@@ -0,0 +1,224 @@
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from mautrix.errors import (
+    MatrixStandardRequestError,
+    MBadJSON,
+    MForbidden,
+    MInvalidParam,
+    MInvalidUsername,
+    MLimitExceeded,
+    MNotFound,
+    MNotJSON,
+    MUserDeactivated,
+)
+from mautrix.util.logging import TraceLogger
+
+from . import jsonutil
+from .persist import DelayedWriter
+
+# errors that will not go away by trying again, like inviting a user that doesnt exist
+PERMANENT_ERRORS = (ValueError, MForbidden, MInvalidParam, MInvalidUsername, MBadJSON, MNotJSON,
+                    MNotFound, MUserDeactivated)
+
+
+def is_permanent(error: Exception) -> bool:
+    """decide whether a failed invite is worth retrying"""
+    if isinstance(error, PERMANENT_ERRORS):
+        return True
+    if isinstance(error, MLimitExceeded):
+        return False
+    if isinstance(error, MatrixStandardRequestError):
+        # other client errors are the request's fault, server errors are temporary
+        return 400 <= error.http_status < 500
+    # connection problems, timeouts, rate limits and anything else we dont know about
+    return False
+
+
+@dataclass
+class RetryEntry:
+    room_id: str
+    matrix_id: str
+    order_code: str
+    organizer: Optional[str] = None
+    event: Optional[str] = None
+    error: str = ""
+    attempts: int = 0
+    next_attempt: float = field(default_factory=time.time)
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return (self.room_id, self.matrix_id)
+
+    @classmethod
+    def from_json(cls, json_data: dict):
+        return cls(**json_data)
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class RetryQueue:
+    """failed invites waiting to be retried, persisted to a file so they survive restarts
+
+    A homeserver outage can fail thousands of invites in a row, so changes are written off
+    the event loop, at most once every `persist_delay` seconds. Call flush before shutting down.
+    """
+    _entries: Dict[Tuple[str, str], RetryEntry] = field(default_factory=lambda: {})
+    persist_path: Path = field(default_factory=Path, kw_only=True)
+    persist_filename: str = field(default="invite_retries.json", kw_only=True)
+    persist_delay: float = field(default=5, kw_only=True)
+    _writer: DelayedWriter = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # entries are changed in place by the scheduler, so they are copied on the loop
+        self._writer = DelayedWriter(
+            lambda: [entry.to_json() for entry in self._entries.values()],
+            lambda data: self._write(data),
+            self.persist_delay,
+        )
+
+    @property
+    def persistfile(self):
+        return self.persist_path.joinpath(self.persist_filename)
+
+    def persist(self):
+        self._write([entry.to_json() for entry in self._entries.values()])
+
+    def _write(self, data: List[dict]):
+        self.persistfile.write_text(jsonutil.dumps(data), encoding="utf8")
+
+    def persist_soon(self):
+        """write the queue in the background after persist_delay seconds, together with any other changes made until then"""
+        self._writer.schedule()
+
+    async def flush(self):
+        """write pending changes right away"""
+        await self._writer.flush()
+
+    @classmethod
+    def from_path(cls, persist_path=Path("."), persist_filename="invite_retries.json"):
+        if persist_path is None:
+            persist_path = Path(".")
+        persistfile = persist_path.joinpath(persist_filename)
+        if not persistfile.exists():
+            return cls(persist_filename=persist_filename, persist_path=persist_path)
+        entries = [RetryEntry.from_json(e) for e in jsonutil.loads(persistfile.read_bytes())]
+        return cls({e.key: e for e in entries}, persist_filename=persist_filename, persist_path=persist_path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Tuple[str, str]):
+        return key in self._entries
+
+    def add(self, entry: RetryEntry, persist: bool = True):
+        existing = self._entries.get(entry.key)
+        if existing is not None:
+            # keep the attempt count of an invite that was already failing
+            entry.attempts = max(entry.attempts, existing.attempts)
+        self._entries[entry.key] = entry
+        if persist:
+            self.persist_soon()
+
+    def remove(self, entry: RetryEntry, persist: bool = True):
+        if self._entries.pop(entry.key, None) is not None and persist:
+            self.persist_soon()
+
+    def due(self, now: float = None) -> List[RetryEntry]:
+        now = time.time() if now is None else now
+        return [e for e in self._entries.values() if e.next_attempt <= now]
+
+
+class RetryScheduler:
+    """periodically retries the invites in a RetryQueue with exponential backoff
+
+    `invite` is called with the room ID and matrix ID of an entry and should raise on failure.
+    `on_success` is called with an entry once its invite went through.
+    """
+
+    def __init__(self, queue: RetryQueue, invite: Callable[[str, str], Awaitable[None]],
+                 log: TraceLogger, on_success: Callable[[RetryEntry], Awaitable[None]] = None,
+                 interval: float = 30, base_delay: float = 30, max_delay: float = 3600, max_attempts: int = 10):
+        self.queue = queue
+        self.invite = invite
+        self.on_success = on_success
+        self.logger = log
+        self.interval = interval
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._task = None
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** max(0, attempts - 1)))
+        # spread retries out a little so they dont all hit the homeserver at once
+        return delay * random.uniform(0.8, 1.2)
+
+    def record_failure(self, room_id: str, matrix_id: str, order_code: str, error: Exception,
+                       organizer: str = None, event: str = None, persist: bool = True) -> bool:
+        """queue a failed invite for retrying, unless the error is permanent
+
+        Pass persist=False when recording many failures at once and call queue.persist_soon afterwards.
+
+        Returns:
+            bool: whether the invite was queued
+        """
+        if is_permanent(error):
+            self.logger.info("not retrying invite of %s to %s: %s: %s", matrix_id, room_id, type(error).__name__, error)
+            return False
+        entry = RetryEntry(room_id, matrix_id, order_code, organizer, event, error=type(error).__name__)
+        if entry.key in self.queue:
+            return True
+        entry.next_attempt = time.time() + self.backoff(1)
+        entry.attempts = 1
+        self.queue.add(entry, persist=persist)
+        return True
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.retry_due()
+            except Exception as e:
+                self.logger.exception(f"retrying failed invites failed: {e}")
+
+    async def retry_due(self):
+        try:
+            await self._retry_due()
+        finally:
+            # one write for the whole pass
+            self.queue.persist_soon()
+
+    async def _retry_due(self):
+        for entry in self.queue.due():
+            try:
+                await self.invite(entry.room_id, entry.matrix_id)
+            except Exception as e:
+                entry.error = type(e).__name__
+                entry.attempts += 1
+                if is_permanent(e) or entry.attempts > self.max_attempts:
+                    self.logger.error("giving up on inviting %s to %s after %d attempts: %s: %s",
+                                      entry.matrix_id, entry.room_id, entry.attempts, type(e).__name__, e)
+                    self.queue.remove(entry, persist=False)
+                    continue
+                entry.next_attempt = time.time() + self.backoff(entry.attempts)
+                continue
+
+            self.logger.debug("retried invite of %s to %s succeeded", entry.matrix_id, entry.room_id)
+            self.queue.remove(entry, persist=False)
+            if self.on_success is not None:
+                await self.on_success(entry)
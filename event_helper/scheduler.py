@@ -0,0 +1,61 @@
+import asyncio
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Dict
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+
+class PriorityScheduler:
+    """Shares the bot's capacity for pretix and homeserver work between priority classes
+
+    Interactive work (live webhooks) may use all of the capacity. Bulk work (batch
+    invites, reconciliation, retries) is limited to `bulk_limit` slots and only gets a
+    slot while no interactive work is waiting, so a long bulk job never makes a person
+    who just bought a ticket wait for it to finish.
+
+    Bulk jobs should do their work in small pieces, each in its own slot, so they give
+    way to interactive work mid-run. Slots must not be nested.
+    """
+
+    def __init__(self, capacity: int = 8, bulk_limit: int = 2):
+        self.capacity = max(1, capacity)
+        self.limits: Dict[str, int] = {INTERACTIVE: self.capacity, BULK: max(1, min(bulk_limit, self.capacity))}
+        self.running = Counter()
+        self.waiting = Counter()
+        self._condition = asyncio.Condition()
+
+    def _can_run(self, priority: str) -> bool:
+        if self.running[priority] >= self.limits[priority]:
+            return False
+        if sum(self.running.values()) >= self.capacity:
+            return False
+        return priority == INTERACTIVE or self.waiting[INTERACTIVE] == 0
+
+    async def _acquire(self, priority: str):
+        self.waiting[priority] += 1
+        try:
+            await self._condition.wait_for(lambda: self._can_run(priority))
+        finally:
+            self.waiting[priority] -= 1
+            if priority == INTERACTIVE:
+                # bulk work held back for this task may be able to run next to it
+                self._condition.notify_all()
+        self.running[priority] += 1
+
+    @asynccontextmanager
+    async def slot(self, priority: str):
+        """wait for a slot of the given priority class and hold it for the duration of the block"""
+        async with self._condition:
+            await self._acquire(priority)
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.running[priority] -= 1
+                self._condition.notify_all()
+
+    def status(self) -> str:
+        return (f"{self.running[INTERACTIVE]} interactive and {self.running[BULK]} bulk jobs running, "
+                f"{self.waiting[INTERACTIVE]} interactive and {self.waiting[BULK]} bulk jobs waiting")
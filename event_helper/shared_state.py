@@ -0,0 +1,278 @@
+import asyncio
+import time
+import uuid
+from typing import Dict, Iterable, List, Set, Tuple
+
+from mautrix.util.async_db import Connection, Database, UpgradeTable
+from mautrix.util.logging import TraceLogger
+
+from . import jsonutil
+from .pretix import Pretix
+
+upgrade_table = UpgradeTable()
+
+
+@upgrade_table.register(description="Initial revision")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE webhook_job (
+            job_key    TEXT PRIMARY KEY,
+            owner      TEXT NOT NULL,
+            claimed_at BIGINT NOT NULL,
+            done       BOOLEAN NOT NULL DEFAULT false
+        )"""
+    )
+    await conn.execute(
+        """CREATE TABLE processed_order (
+            organizer  TEXT NOT NULL,
+            event      TEXT NOT NULL,
+            order_code TEXT NOT NULL,
+            PRIMARY KEY (organizer, event, order_code)
+        )"""
+    )
+    await conn.execute(
+        """CREATE TABLE lease (
+            name       TEXT PRIMARY KEY,
+            owner      TEXT NOT NULL,
+            expires_at BIGINT NOT NULL
+        )"""
+    )
+    await conn.execute(
+        """CREATE TABLE pretix_token (
+            instance   TEXT PRIMARY KEY,
+            token      TEXT NOT NULL,
+            updated_at BIGINT NOT NULL
+        )"""
+    )
+
+
+@upgrade_table.register(description="Track the rooms of orders that are not fully processed")
+async def upgrade_v2(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE order_room (
+            organizer  TEXT NOT NULL,
+            event      TEXT NOT NULL,
+            order_code TEXT NOT NULL,
+            room       TEXT NOT NULL,
+            routed     BOOLEAN NOT NULL DEFAULT false,
+            processed  BOOLEAN NOT NULL DEFAULT false,
+            PRIMARY KEY (organizer, event, order_code, room)
+        )"""
+    )
+
+
+@upgrade_table.register(description="Share the room mapping")
+async def upgrade_v3(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE event_room (
+            organizer  TEXT NOT NULL,
+            event      TEXT NOT NULL,
+            room       TEXT NOT NULL,
+            PRIMARY KEY (organizer, event, room)
+        )"""
+    )
+
+
+def _now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+class SharedState:
+    """State shared between several replicas of the bot through one database
+
+    - webhook jobs are claimed by exactly one replica
+    - orders marked as processed by one replica are seen by all of them, and so are
+      the rooms of orders that are only partly done
+    - rooms mapped to an event on one replica are mapped on all of them
+    - the pretix token is stored in the database and only refreshed by the replica
+      holding the refresh lease
+    """
+
+    def __init__(self, db: Database, log: TraceLogger, owner: str = None):
+        self.db = db
+        self.logger = log
+        # identifies this replica in claims and leases
+        self.owner = owner or uuid.uuid4().hex
+        self._loop = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        await self.db.start()
+
+    async def stop(self):
+        await self.db.stop()
+
+    async def claim_job(self, job_key: str, lease_seconds: float) -> bool:
+        """try to become the replica that handles a job
+
+        Jobs claimed by a replica that did not finish them within `lease_seconds` can be claimed again.
+
+        Returns:
+            bool: whether this replica now owns the job
+        """
+        now = _now_ms()
+        q = """
+            INSERT INTO webhook_job (job_key, owner, claimed_at, done) VALUES ($1, $2, $3, false)
+            ON CONFLICT (job_key) DO UPDATE SET owner=excluded.owner, claimed_at=excluded.claimed_at
+            WHERE webhook_job.done=false AND webhook_job.claimed_at < $4
+        """
+        await self.db.execute(q, job_key, self.owner, now, now - int(lease_seconds * 1000))
+        row = await self.db.fetchrow("SELECT owner, claimed_at FROM webhook_job WHERE job_key=$1", job_key)
+        return row is not None and row["owner"] == self.owner and row["claimed_at"] == now
+
+    async def complete_job(self, job_key: str):
+        await self.db.execute("UPDATE webhook_job SET done=true WHERE job_key=$1 AND owner=$2", job_key, self.owner)
+
+    async def release_job(self, job_key: str):
+        """give up a job so a redelivery of it can be claimed by any replica"""
+        await self.db.execute("DELETE FROM webhook_job WHERE job_key=$1 AND owner=$2", job_key, self.owner)
+
+    async def processed_codes(self, organizer: str, event: str) -> Set[str]:
+        rows = await self.db.fetch(
+            "SELECT order_code FROM processed_order WHERE organizer=$1 AND event=$2", organizer, event
+        )
+        return {row["order_code"] for row in rows}
+
+    async def is_processed(self, organizer: str, event: str, order_code: str) -> bool:
+        row = await self.db.fetchrow(
+            "SELECT 1 FROM processed_order WHERE organizer=$1 AND event=$2 AND order_code=$3",
+            organizer, event, order_code,
+        )
+        return row is not None
+
+    async def mark_processed(self, organizer: str, event: str, order_codes: Iterable[str]):
+        q = """
+            INSERT INTO processed_order (organizer, event, order_code) VALUES ($1, $2, $3)
+            ON CONFLICT (organizer, event, order_code) DO NOTHING
+        """
+        order_codes = list(order_codes)
+        await self.db.executemany(q, [(organizer, event, code) for code in order_codes])
+        # their rooms dont need to be tracked any longer
+        await self.db.executemany(
+            "DELETE FROM order_room WHERE organizer=$1 AND event=$2 AND order_code=$3",
+            [(organizer, event, code) for code in order_codes],
+        )
+
+    async def route_order(self, organizer: str, event: str, order_code: str, rooms: Iterable[str]):
+        """note which rooms the attendees of an order are to be invited to, see Pretix.route_order"""
+        q = """
+            INSERT INTO order_room (organizer, event, order_code, room, routed) VALUES ($1, $2, $3, $4, true)
+            ON CONFLICT (organizer, event, order_code, room) DO UPDATE SET routed=true
+        """
+        await self.db.executemany(q, [(organizer, event, order_code, room) for room in rooms])
+
+    async def mark_room_processed(self, organizer: str, event: str, order_code: str, room: str):
+        q = """
+            INSERT INTO order_room (organizer, event, order_code, room, processed) VALUES ($1, $2, $3, $4, true)
+            ON CONFLICT (organizer, event, order_code, room) DO UPDATE SET processed=true
+        """
+        await self.db.execute(q, organizer, event, order_code, room)
+
+    async def room_progress(self, organizer: str, event: str, order_code: str) -> Dict[str, List[str]]:
+        """the rooms an order is routed to and the ones already done, in the form of Pretix.room_progress"""
+        rows = await self.db.fetch(
+            "SELECT room, routed, processed FROM order_room WHERE organizer=$1 AND event=$2 AND order_code=$3",
+            organizer, event, order_code,
+        )
+        return {
+            "routed": sorted(row["room"] for row in rows if row["routed"]),
+            "processed": sorted(row["room"] for row in rows if row["processed"]),
+        }
+
+    async def mapped_rooms(self) -> Set[Tuple[str, str, str]]:
+        """every (organizer, event, room) of the shared room mapping. Rooms are stored as JSON, see Room.to_json"""
+        rows = await self.db.fetch("SELECT organizer, event, room FROM event_room")
+        return {(row["organizer"], row["event"], row["room"]) for row in rows}
+
+    async def update_mapped_rooms(self, added: Iterable[Tuple[str, str, str]] = (),
+                                  removed: Iterable[Tuple[str, str, str]] = ()):
+        """apply changes made to the room mapping of this replica to the shared one"""
+        await self.db.executemany(
+            "INSERT INTO event_room (organizer, event, room) VALUES ($1, $2, $3) "
+            "ON CONFLICT (organizer, event, room) DO NOTHING",
+            list(added),
+        )
+        await self.db.executemany(
+            "DELETE FROM event_room WHERE organizer=$1 AND event=$2 AND room=$3", list(removed)
+        )
+
+    async def acquire_lease(self, name: str, ttl_seconds: float) -> bool:
+        """take (or extend) a named lease, unless another replica holds it and it hasnt expired"""
+        now = _now_ms()
+        q = """
+            INSERT INTO lease (name, owner, expires_at) VALUES ($1, $2, $3)
+            ON CONFLICT (name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at
+            WHERE lease.expires_at < $4 OR lease.owner = $2
+        """
+        await self.db.execute(q, name, self.owner, now + int(ttl_seconds * 1000), now)
+        owner = await self.db.fetchval("SELECT owner FROM lease WHERE name=$1", name)
+        return owner == self.owner
+
+    async def release_lease(self, name: str):
+        await self.db.execute("DELETE FROM lease WHERE name=$1 AND owner=$2", name, self.owner)
+
+    async def store_token(self, instance: str, token: dict, updated_at: int):
+        q = """
+            INSERT INTO pretix_token (instance, token, updated_at) VALUES ($1, $2, $3)
+            ON CONFLICT (instance) DO UPDATE SET token=excluded.token, updated_at=excluded.updated_at
+            WHERE pretix_token.updated_at < excluded.updated_at
+        """
+        await self.db.execute(q, instance, jsonutil.dumps(token), updated_at)
+
+    async def load_token(self, instance: str):
+        row = await self.db.fetchrow("SELECT token, updated_at FROM pretix_token WHERE instance=$1", instance)
+        if row is None:
+            return None, 0
+        return jsonutil.loads(row["token"]), row["updated_at"]
+
+    def share_tokens_of(self, pretix: Pretix):
+        """store every token the client receives (through auth or a refresh) in the database
+
+        The client stops refreshing expired tokens by itself: every replica would otherwise
+        refresh on its own, invalidating the refresh token the others hold. Code using the
+        client has to call sync_token before talking to pretix instead.
+        """
+        def on_token_update(token: dict, updated_at: int):
+            # token updates may happen in executor threads
+            asyncio.run_coroutine_threadsafe(self.store_token(pretix.host, token, updated_at), self._loop)
+
+        pretix.disable_auto_refresh()
+        pretix.token_listeners.append(on_token_update)
+
+    async def sync_token(self, pretix: Pretix, refresh_margin: float = 120):
+        """make sure the client uses the newest shared token, refreshing it if it is about to expire
+
+        Only the replica holding the refresh lease of an instance refreshes its token,
+        the others wait for the new token to show up in the database.
+        """
+        token, updated_at = await self.load_token(pretix.host)
+        if token is not None and updated_at > pretix.token_updated_at:
+            pretix.set_token(token, updated_at)
+
+        if not pretix.token_expires_within(refresh_margin):
+            return
+
+        lease = f"token-refresh:{pretix.host}"
+        if await self.acquire_lease(lease, 30):
+            try:
+                # another replica may have refreshed the token right before we got the lease
+                token, updated_at = await self.load_token(pretix.host)
+                if token is not None and updated_at > pretix.token_updated_at:
+                    pretix.set_token(token, updated_at)
+                    if not pretix.token_expires_within(refresh_margin):
+                        return
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, pretix.refresh_access_token)
+                await self.store_token(pretix.host, pretix.token, pretix.token_updated_at)
+            finally:
+                await self.release_lease(lease)
+            return
+
+        # another replica is refreshing the token
+        for _ in range(10):
+            await asyncio.sleep(0.5)
+            token, updated_at = await self.load_token(pretix.host)
+            if token is not None and updated_at > pretix.token_updated_at:
+                pretix.set_token(token, updated_at)
+                return
+        self.logger.warning(f"timed out waiting for another replica to refresh the token for {pretix.host}")
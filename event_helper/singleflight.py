@@ -0,0 +1,55 @@
+import asyncio
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Coalesces identical concurrent requests
+
+    While a request for a key is in flight, every other caller asking for the same
+    key waits for that request instead of sending its own, and gets the same result
+    (or exception). Nothing is cached once the request has finished.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self):
+        return len(self._inflight)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """run `func`, or join the call already running for `key`"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # a cancelled caller must not cancel the request for everyone else
+        return await asyncio.shield(task)
+
+
+class KeyedLocks:
+    """One asyncio lock per key, created on demand and dropped when nobody holds or waits for it"""
+
+    def __init__(self):
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._users = Counter()
+
+    def __len__(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._users[key] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._users[key] -= 1
+            if self._users[key] == 0:
+                del self._users[key]
+                del self._locks[key]
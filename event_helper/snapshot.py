@@ -0,0 +1,111 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from mautrix.util.logging import TraceLogger
+
+from . import jsonutil
+
+
+@dataclass
+class CacheSnapshot:
+    """the bot's runtime caches, kept on disk so they survive a restart
+
+    Restoring them means the first webhooks after a restart dont have to look up every
+    alias and member list again, and orders that were already processed stay processed.
+    """
+    # alias -> room id
+    aliases: Dict[str, str] = field(default_factory=lambda: {})
+    # room id -> [joined users, invited users]
+    members: Dict[str, List[List[str]]] = field(default_factory=lambda: {})
+    # pretix host -> processed order codes
+    processed: Dict[str, List[str]] = field(default_factory=lambda: {})
+    # pretix host -> order code -> rooms it is routed to and rooms already done, see Pretix.room_progress
+    rooms: Dict[str, Dict[str, Dict[str, List[str]]]] = field(default_factory=lambda: {})
+    # "organizer/event" -> start of the last successful reconciliation, see Reconciler.watermarks
+    reconciled: Dict[str, str] = field(default_factory=lambda: {})
+    written_at: float = field(default_factory=time.time)
+    persist_path: Path = field(default_factory=Path, kw_only=True)
+    persist_filename: str = field(default="cache_snapshot.json", kw_only=True)
+
+    @property
+    def persistfile(self):
+        return self.persist_path.joinpath(self.persist_filename)
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.written_at
+
+    def to_json(self) -> dict:
+        return {
+            "aliases": self.aliases,
+            "members": self.members,
+            "processed": self.processed,
+            "rooms": self.rooms,
+            "reconciled": self.reconciled,
+            "written_at": self.written_at,
+        }
+
+    def persist(self):
+        # written next to the old snapshot and swapped in, so a crash mid-write cant leave a broken file
+        tmpfile = self.persistfile.with_name(self.persist_filename + ".tmp")
+        tmpfile.write_text(jsonutil.dumps(self.to_json()), encoding="utf8")
+        os.replace(tmpfile, self.persistfile)
+
+    @classmethod
+    def from_path(cls, persist_path=Path("."), persist_filename="cache_snapshot.json"):
+        if persist_path is None:
+            persist_path = Path(".")
+        persistfile = persist_path.joinpath(persist_filename)
+        if not persistfile.exists():
+            return cls(persist_filename=persist_filename, persist_path=persist_path)
+        data = jsonutil.loads(persistfile.read_bytes())
+        return cls(
+            data.get("aliases", {}),
+            data.get("members", {}),
+            data.get("processed", {}),
+            data.get("rooms", {}),
+            data.get("reconciled", {}),
+            data.get("written_at", 0),
+            persist_filename=persist_filename,
+            persist_path=persist_path,
+        )
+
+
+class SnapshotWriter:
+    """writes a snapshot of the caches every `interval` seconds, and once more when the bot stops"""
+
+    def __init__(self, collect: Callable[[], CacheSnapshot], log: TraceLogger, interval: float = 300):
+        self.collect = collect
+        self.logger = log
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.write()
+            except Exception as e:
+                self.logger.exception(f"writing the cache snapshot failed: {e}")
+
+    async def write(self):
+        snapshot = self.collect()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, snapshot.persist)
+        self.logger.debug(
+            "wrote cache snapshot with %d aliases, %d member lists and %d processed orders",
+            len(snapshot.aliases), len(snapshot.members), sum(len(c) for c in snapshot.processed.values()),
+        )
@@ -0,0 +1,57 @@
+"""Set up the plugin without a running maubot, for the replay tool and the tests
+
+maubot creates plugins with a client, a database and a web app. build_plugin skips all of
+that and wires the plugin the same way EventManagement.start does, with whatever stand-ins
+the caller passes for the homeserver and the loaded state.
+"""
+import logging
+from pathlib import Path
+from typing import Dict, Optional
+
+from ruamel.yaml import YAML
+
+from . import EventManagement, EventRooms
+from .attendee_index import AttendeeIndex
+from .pretix import PretixPool
+from .retry import RetryQueue
+
+BASE_CONFIG = Path(__file__).parent.parent.joinpath("base-config.yaml")
+
+
+def default_config() -> Dict:
+    """the defaults from base-config.yaml, as a plain dict"""
+    with open(BASE_CONFIG, encoding="utf8") as config:
+        return YAML(typ="safe").load(config)
+
+
+def build_plugin(log: logging.Logger, config: Optional[Dict] = None, matrix_utils=None,
+                 room_mapping: EventRooms = None, pretix_pool: PretixPool = None,
+                 attendee_index: AttendeeIndex = None, retry_queue: RetryQueue = None,
+                 shared_state=None, workdir: Path = Path(".")) -> EventManagement:
+    """create a plugin that is ready to handle webhooks and commands, without starting its background jobs
+
+    Args:
+        log (logging.Logger): the logger of the plugin
+        config (Dict, optional): settings that differ from base-config.yaml
+        matrix_utils (optional): the MatrixUtils (or a stand-in) used to talk to the homeserver
+        room_mapping, pretix_pool, attendee_index, retry_queue (optional): the state start loads
+            from disk. Empty ones kept in `workdir` are used for those not given
+        shared_state (SharedState, optional): the state shared with other replicas
+
+    Returns:
+        EventManagement: the plugin
+    """
+    plugin = EventManagement.__new__(EventManagement)
+    plugin.log = log
+    plugin.config = {**default_config(), **(config or {})}
+    plugin.build_components()
+    plugin.matrix_utils = matrix_utils
+    plugin.wire_state(
+        room_mapping if room_mapping is not None else EventRooms(persist_path=workdir),
+        pretix_pool if pretix_pool is not None else PretixPool(log),
+        attendee_index if attendee_index is not None else AttendeeIndex(persist_path=workdir),
+        retry_queue if retry_queue is not None else RetryQueue(persist_path=workdir),
+        shared_state,
+    )
+    plugin.ready.set()
+    return plugin
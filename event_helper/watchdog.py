@@ -0,0 +1,127 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from mautrix.util.logging import TraceLogger
+
+
+@dataclass
+class Stall:
+    at: datetime
+    lag: float
+    stage: str
+    stack: str
+
+
+class LoopWatchdog:
+    """Detects blocking work on the event loop
+
+    A task on the loop records a heartbeat every `interval` seconds. A separate thread
+    notices when the heartbeat is late by more than `threshold` seconds and samples the
+    stack of the loop's thread while it is still blocked. Once the loop runs again the
+    stall is logged together with the stage the blocked task was in.
+
+    Handlers mark their stage with `mark`, tasks without a stage are reported by the
+    name of their coroutine.
+    """
+
+    def __init__(self, log: TraceLogger, threshold: float = 0.5, keep: int = 5):
+        self.logger = log
+        self.threshold = threshold
+        self.interval = threshold / 2
+        self.max_lag = 0.0
+        self.stall_count = 0
+        self.stalls = deque(maxlen=keep)
+        self._stages: Dict[asyncio.Task, str] = {}
+        self._loop = None
+        self._loop_thread = None
+        self._last_beat = time.monotonic()
+        self._sampled_beat = None
+        self._sample = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def mark(self, stage: str):
+        """record what the current task is doing, until it finishes or marks another stage"""
+        task = asyncio.current_task()
+        if task is None:
+            return
+        if task not in self._stages:
+            task.add_done_callback(lambda t: self._stages.pop(t, None))
+        self._stages[task] = stage
+
+    def stage_of(self, task: Optional[asyncio.Task]) -> str:
+        if task is None:
+            return "no task (loop callbacks)"
+        stage = self._stages.get(task)
+        if stage is not None:
+            return stage
+        return getattr(task.get_coro(), "__qualname__", task.get_name())
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._last_beat = time.monotonic()
+        self._task = asyncio.create_task(self._beat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        self.logger.info(f"event loop watchdog started, reporting stalls over {self.threshold}s")
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _beat(self):
+        while True:
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self._last_beat - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self._record(lag)
+
+    def _record(self, lag: float):
+        sample = self._sample
+        self._sample = None
+        stage, stack = sample if sample is not None else ("unknown", "")
+        self.stall_count += 1
+        self.stalls.append(Stall(datetime.now(tz=timezone.utc), lag, stage, stack))
+        self.logger.warning(f"event loop was blocked for {lag:.3f}s during {stage}" + (f":\n{stack}" if stack else ""))
+
+    def _watch(self):
+        """runs in its own thread, takes a stack sample of the loop's thread when it is blocked"""
+        while not self._stop.wait(self.interval / 2):
+            beat = self._last_beat
+            if time.monotonic() - beat - self.interval < self.threshold or beat == self._sampled_beat:
+                continue
+            # only sample each stall once
+            self._sampled_beat = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            self._sample = (self.stage_of(asyncio.current_task(self._loop)), stack)
+
+    def status(self) -> List[str]:
+        """lines for the status command"""
+        if not self.running:
+            return ["Event loop watchdog: disabled"]
+        lines = [
+            f"Event loop watchdog: max lag {self.max_lag * 1000:.0f}ms, "
+            f"{self.stall_count} stalls over {self.threshold * 1000:.0f}ms"
+        ]
+        for stall in self.stalls:
+            lines.append(f"* {stall.at.isoformat(timespec='seconds')}: {stall.lag * 1000:.0f}ms during {stall.stage}")
+        return lines
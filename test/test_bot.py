@@ -1,6 +1,19 @@
 import unittest
+import asyncio
 import json
+import logging
+import tempfile
+import time
+from pathlib import Path
 from event_helper import Room, FilterConditions, EventRooms
+from event_helper.pretix import AttendeeMatrixInformation, Pretix
+from event_helper.ratelimit import RateLimiter
+from event_helper.replay import StandInSession
+from event_helper.attendee_index import AttendeeIndex
+from event_helper.retry import RetryEntry, RetryQueue
+from event_helper.shared_state import SharedState, upgrade_table
+from event_helper.standalone import build_plugin
+from mautrix.util.async_db import Database
 
 
 
@@ -13,6 +26,11 @@ class TestRoom(unittest.TestCase):
         self.assertIsNotNone(Room("identifier", FilterConditions("3", "4")))
         self.assertIsNotNone(Room("identifier", condition=FilterConditions("3", "4")))
 
+    def test_filter_ids_are_ints(self):
+        self.assertEqual(FilterConditions("3", "4"), FilterConditions(3, 4))
+        self.assertEqual(FilterConditions.from_json({"item": "3", "variant": None}).item, 3)
+        self.assertTrue(Room("identifier", FilterConditions("3", "4")).matches(3, 4))
+
     def test_can_add_to_set(self):
         testset = set()
         rm = Room("identifier", FilterConditions("3", "4"))
@@ -65,6 +83,16 @@ class TestEventRooms(unittest.TestCase):
 
         self.assertEqual(self.mapping.rooms_by_ticket_variant("a", "b", 1, 2), list([rm]))
 
+    def test_ticket_filter(self):
+        self.assertEqual(self.mapping.ticket_filter("a", "b"), FilterConditions())
+        self.mapping.add_object("a", "b", Room("c", FilterConditions("1")))
+        self.mapping.add_object("a", "b", Room("d", FilterConditions("1")))
+        self.assertEqual(self.mapping.ticket_filter("a", "b"), FilterConditions("1"))
+
+        # a room without a filter needs every ticket
+        self.mapping.add_object("a", "b", Room("e"))
+        self.assertEqual(self.mapping.ticket_filter("a", "b"), FilterConditions())
+
     def test_persists_to_file(self):
         self.assertEqual(self.mapping.rooms_by_event("a", "b"), set())
         rm = Room("c")
@@ -99,5 +127,315 @@ class TestEventRooms(unittest.TestCase):
         self.mapping.persistfile.unlink()
 
 
+class FakeRequest:
+    def __init__(self, body):
+        self.body = body
+        self.query = {}
+
+    async def json(self, loads=None):
+        return self.body
+
+
+class TestWebhookRouting(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        room_mapping = EventRooms(persist_filename="rooms_webhook_test.json")
+        room_mapping.add("fedora", "flock", "!room:test")
+        # no pretix instances, so any pretix access would fail
+        self.plugin = build_plugin(logging.getLogger("test"), room_mapping=room_mapping)
+
+    async def test_skips_unmapped_event(self):
+        response = await self.plugin.handle_pretix_webhook(FakeRequest(
+            {"organizer": "fedora", "event": "other", "code": "ABC", "action": "pretix.event.order.paid"}
+        ))
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.plugin.metrics["webhooks_skipped_unmapped"], 1)
+
+    async def test_skips_other_actions(self):
+        response = await self.plugin.handle_pretix_webhook(FakeRequest(
+            {"organizer": "fedora", "event": "flock", "code": "ABC", "action": "pretix.event.order.placed"}
+        ))
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.plugin.metrics["webhooks_skipped_action"], 1)
+
+    async def test_waits_for_startup(self):
+        self.plugin.ready.clear()
+        # other actions are answered without waiting for the room mapping
+        response = await self.plugin.handle_pretix_webhook(FakeRequest(
+            {"organizer": "fedora", "event": "flock", "code": "ABC", "action": "pretix.event.order.placed"}
+        ))
+        self.assertEqual(response.status, 200)
+
+        pending = asyncio.create_task(self.plugin.handle_pretix_webhook(FakeRequest(
+            {"organizer": "fedora", "event": "other", "code": "ABC", "action": "pretix.event.order.paid"}
+        )))
+        await asyncio.sleep(0)
+        self.assertFalse(pending.done())
+        self.plugin.ready.set()
+        self.assertEqual((await pending).status, 200)
+        self.assertEqual(self.plugin.metrics["webhooks_skipped_unmapped"], 1)
+
+    async def test_captures_webhooks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            capture = Path(tmp).joinpath("capture.jsonl")
+            self.plugin.config["webhook_capture_path"] = str(capture)
+            request = FakeRequest({"organizer": "fedora", "event": "flock", "code": "ABC",
+                                   "action": "pretix.event.order.placed"})
+            request.query = {"instance": "pretix.example.org"}
+            await self.plugin.handle_pretix_webhook(request)
+
+            lines = capture.read_text().splitlines()
+        self.assertEqual(len(lines), 1)
+        entry = json.loads(lines[0])
+        self.assertEqual(entry["body"]["code"], "ABC")
+        self.assertEqual(entry["query"], {"instance": "pretix.example.org"})
+        self.assertIn("received_at", entry)
+
+    def tearDown(self):
+        self.plugin.room_mapping.persistfile.unlink()
+
+
+class TestSharedRoomMapping(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        path = Path(self.tempdir.name)
+        url = f"sqlite://{path.joinpath('shared.db')}"
+        log = logging.getLogger("test")
+        self.replicas = []
+        for name in ("a", "b"):
+            shared_state = SharedState(Database.create(url, upgrade_table=upgrade_table), log, owner=name)
+            await shared_state.start()
+            self.replicas.append(build_plugin(
+                log, room_mapping=EventRooms(persist_path=path, persist_filename=f"rooms-{name}.json"),
+                shared_state=shared_state, workdir=path,
+            ))
+
+    async def test_webhook_sees_rooms_mapped_on_another_replica(self):
+        a, b = self.replicas
+        before = a.room_mapping.entries()
+        a.room_mapping.add_object("fedora", "flock", Room("!room:test", FilterConditions("3")))
+        await a.share_room_mapping(before)
+
+        processed = []
+
+        async def process_webhook(pretix, json):
+            processed.append(json["code"])
+        b._process_webhook = process_webhook
+        b.pretix_pool.add(FakeWebhookPretix())
+
+        async def sync_token(pretix):
+            pass
+        b.shared_state.sync_token = sync_token
+
+        await b.handle_pretix_webhook(FakeRequest(
+            {"organizer": "fedora", "event": "flock", "code": "ABC", "action": "pretix.event.order.paid"}
+        ))
+        self.assertEqual(processed, ["ABC"])
+        self.assertEqual(b.room_mapping.rooms_by_event("fedora", "flock"), {Room("!room:test", FilterConditions(3))})
+        # and it is kept on disk in case the database is gone on the next start
+        restored = EventRooms.from_path(Path(self.tempdir.name), persist_filename="rooms-b.json")
+        self.assertEqual(restored.entries(), b.room_mapping.entries())
+
+    async def asyncTearDown(self):
+        for replica in self.replicas:
+            await replica.shared_state.stop()
+        self.tempdir.cleanup()
+
+
+class TestInstanceFiles(unittest.TestCase):
+
+    def test_state_files_are_kept_per_instance(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp)
+            path.joinpath("invite_retries.json").write_text("[]")
+            plugin = build_plugin(logging.getLogger("test"))
+            plugin.id = "events one"
+            # the file of an older version is taken over
+            self.assertEqual(plugin._instance_filename(path, "invite_retries.json"), "invite_retries-events_one.json")
+            self.assertEqual([p.name for p in path.iterdir()], ["invite_retries-events_one.json"])
+
+            plugin.id = "events two"
+            self.assertEqual(len(plugin._load_instance_state(RetryQueue, path, "invite_retries.json")), 0)
+
+
+class FakeWebhookPretix(Pretix):
+    """a pretix client whose HTTP session is the stand-in of the replay tool"""
+
+    def __init__(self):
+        super().__init__("test", "test", "https://pretix.test/redirect", logging.getLogger("test"),
+                         instance_url="https://pretix.test", rate_limiter=RateLimiter())
+        self.oauth = StandInSession(latency=0.05)
+
+    @property
+    def fetches(self):
+        return self.oauth.order_fetches
+
+
+class TestWebhookConcurrency(unittest.IsolatedAsyncioTestCase):
+
+    async def test_duplicate_deliveries_invite_once(self):
+        room_mapping = EventRooms(persist_filename="rooms_concurrency_test.json")
+        room_mapping.add("fedora", "flock", "!room:test")
+        plugin = build_plugin(logging.getLogger("test"), room_mapping=room_mapping)
+        invites = []
+
+        async def invite_to_room(room, attendees, organizer=None, event=None):
+            invites.append(room)
+            await asyncio.sleep(0.01)
+            return []
+        plugin.invite_to_room = invite_to_room
+
+        pretix = FakeWebhookPretix()
+        webhook = {"organizer": "fedora", "event": "flock", "code": "ABC", "action": "pretix.event.order.paid"}
+        try:
+            await asyncio.gather(plugin._process_webhook(pretix, webhook), plugin._process_webhook(pretix, webhook))
+        finally:
+            plugin.room_mapping.persistfile.unlink()
+
+        self.assertEqual(pretix.fetches, 1)
+        self.assertEqual(invites, ["!room:test"])
+
+
+class TestWebhookFanOut(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        room_mapping = EventRooms(persist_filename="rooms_fanout_test.json")
+        for room in ("!a:test", "!b:test", "!c:test"):
+            room_mapping.add("fedora", "flock", room)
+        self.plugin = build_plugin(logging.getLogger("test"), room_mapping=room_mapping)
+        self.failing = {"!c:test"}
+        self.invites = []
+
+        async def invite_to_room(room, attendees, organizer=None, event=None):
+            await asyncio.sleep(0.05)
+            if room in self.failing:
+                raise ConnectionError("homeserver unavailable")
+            self.invites.append(room)
+            return []
+        self.plugin.invite_to_room = invite_to_room
+
+    async def test_rooms_are_invited_concurrently_and_tracked_per_room(self):
+        pretix = FakeWebhookPretix()
+        attendees = [AttendeeMatrixInformation("ABC", "@a:example.org")]
+
+        started = time.monotonic()
+        with self.assertRaises(ConnectionError):
+            await self.plugin._invite_order(pretix, "fedora", "flock", attendees)
+        self.assertLess(time.monotonic() - started, 0.14)
+        self.assertEqual(sorted(self.invites), ["!a:test", "!b:test"])
+        self.assertFalse(pretix.is_processed("ABC"))
+
+        # a redelivery only retries the room that failed
+        self.failing.clear()
+        await self.plugin._invite_order(pretix, "fedora", "flock", attendees)
+        self.assertEqual(sorted(self.invites), ["!a:test", "!b:test", "!c:test"])
+        self.assertTrue(pretix.is_processed("ABC"))
+
+    async def asyncTearDown(self):
+        self.plugin.room_mapping.persistfile.unlink()
+
+
+class FakeMatrixUtils:
+
+    def __init__(self):
+        self.invited = []
+
+    async def get_room_membership(self, room_id, use_cache=True):
+        return {"@joined:example.org"}, {"@invited:example.org"}
+
+    async def ensure_room_invitees(self, room_id, user_info_map):
+        self.invited.extend((room_id, mxid) for mxid in user_info_map)
+        return {}
+
+
+class TestPlanInvites(unittest.IsolatedAsyncioTestCase):
+
+    async def test_plans_without_inviting(self):
+        plugin = build_plugin(logging.getLogger("test"), matrix_utils=FakeMatrixUtils())
+        # invited by the bot before and declined, so invite_attendees would skip them
+        plugin.attendee_index.record("!room:test", ["@declined:example.org"], persist=False)
+        plan = await plugin.plan_invites("!room:test", [
+            AttendeeMatrixInformation("A", " @new:example.org"),
+            AttendeeMatrixInformation("B", "joined:example.org"),
+            AttendeeMatrixInformation("C", "@invited:example.org"),
+            AttendeeMatrixInformation("D", "not a matrix id"),
+            AttendeeMatrixInformation("E", "@declined:example.org"),
+        ])
+        self.assertEqual({k: [a.order_code for a in v] for k, v in plan.items()},
+                         {"invite": ["A"], "joined": ["B"], "invited": ["C", "E"], "invalid": ["D"]})
+
+
+class TestAttendeeIndex(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.plugin = build_plugin(logging.getLogger("test"), matrix_utils=FakeMatrixUtils(),
+                                   workdir=Path(self.tempdir.name))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    async def test_invites_each_person_once_per_room(self):
+        await self.plugin.invite_attendees("!room:test", [
+            AttendeeMatrixInformation("A", "@person:example.org"),
+            AttendeeMatrixInformation("B", "person:example.org"),
+        ], organizer="fedora", event="flock")
+        # a later order for another event routed to the same room
+        invalid = await self.plugin.invite_attendees("!room:test", [
+            AttendeeMatrixInformation("C", " @person:example.org"),
+        ], organizer="fedora", event="devconf")
+        await self.plugin.invite_attendees("!other:test", [
+            AttendeeMatrixInformation("D", "@person:example.org"),
+        ], organizer="fedora", event="devconf")
+
+        self.assertEqual(invalid, [])
+        self.assertEqual(self.plugin.matrix_utils.invited,
+                         [("!room:test", "@person:example.org"), ("!other:test", "@person:example.org")])
+
+        await self.plugin.attendee_index.flush()
+        index = AttendeeIndex.from_path(Path(self.tempdir.name))
+        rooms = {(r.room_id, r.event) for r in index.rooms_of("@person:example.org")}
+        self.assertEqual(rooms, {("!room:test", "flock"), ("!other:test", "devconf")})
+
+    async def test_index_writes_are_batched(self):
+        index = self.plugin.attendee_index
+        writes = []
+        write = index._write
+        index._write = lambda data: (writes.append(len(data)), write(data))
+
+        for n in range(10):
+            index.record("!room:test", [f"@user{n}:example.org"])
+        self.assertEqual(writes, [])
+        await index.flush()
+        self.assertEqual(writes, [10])
+        self.assertEqual(len(AttendeeIndex.from_path(Path(self.tempdir.name))), 10)
+
+    async def test_unreachable_room_is_queued_for_retry(self):
+        async def resolve_alias(alias):
+            raise ConnectionError("homeserver unavailable")
+        self.plugin.matrix_utils.resolve_alias = resolve_alias
+
+        invalid = await self.plugin.invite_attendees("#room:test", [
+            AttendeeMatrixInformation("A", "@a:example.org"),
+            AttendeeMatrixInformation("B", "@b:example.org"),
+        ], organizer="fedora", event="flock")
+        self.assertEqual([a.order_code for a in invalid], ["A", "B"])
+        self.assertIn(("#room:test", "@a:example.org"), self.plugin.retry_scheduler.queue)
+        self.assertIn(("#room:test", "@b:example.org"), self.plugin.retry_scheduler.queue)
+
+    async def test_retry_only_completes_order_with_all_rooms(self):
+        pretix = FakeWebhookPretix()
+        self.plugin.pretix_pool.add(pretix)
+        pretix.route_order("A", ["!one:test", "!two:test"])
+        pretix.mark_room_processed("A", "!one:test")
+
+        await self.plugin.retry_succeeded(RetryEntry("!two:test", "@a:example.org", "B", "fedora", "flock"))
+        self.assertFalse(pretix.is_processed("B"))
+        await self.plugin.retry_succeeded(RetryEntry("!two:test", "@a:example.org", "A", "fedora", "flock"))
+        self.assertTrue(pretix.is_processed("A"))
+        self.assertFalse(pretix.is_processed("B"))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,100 @@
+import unittest
+import asyncio
+import logging
+from event_helper import FilterConditions
+from event_helper.catalog import EventCatalog, ItemCatalog, ticket_id
+
+ITEMS = [
+    {"id": 1, "name": {"en": "Main Conference"}, "variations": []},
+    {"id": 2, "name": {"de": "Workshop"}, "variations": [
+        {"id": 20, "value": {"en": "Rust 101"}},
+        {"id": 21, "value": {"en": "Packaging"}},
+    ]},
+]
+
+
+class FakePretix:
+    def __init__(self):
+        self.fetches = 0
+        self.items = ITEMS
+        self.error = None
+
+    def fetch_items(self, organizer, event):
+        self.fetches += 1
+        if self.error is not None:
+            raise self.error
+        return self.items
+
+
+class TestEventCatalog(unittest.TestCase):
+
+    def test_ticket_id(self):
+        self.assertEqual(ticket_id("12"), 12)
+        self.assertEqual(ticket_id(12), 12)
+        self.assertEqual(ticket_id("x"), "x")
+        self.assertIsNone(ticket_id(None))
+
+    def test_validate(self):
+        catalog = EventCatalog.from_items(ITEMS)
+        self.assertIsNone(catalog.validate(None, None))
+        self.assertIsNone(catalog.validate(1, None))
+        self.assertIsNone(catalog.validate(2, 21))
+        self.assertIsNotNone(catalog.validate(3, None))
+        self.assertIsNotNone(catalog.validate(1, 20))
+        self.assertIsNotNone(catalog.validate(None, 20))
+
+    def test_describe(self):
+        catalog = EventCatalog.from_items(ITEMS)
+        self.assertEqual(catalog.describe(2, 20), "(item=2 Workshop, variant=20 Rust 101)")
+        self.assertEqual(catalog.describe(5, None), "(item=5)")
+
+
+class TestItemCatalog(unittest.IsolatedAsyncioTestCase):
+
+    async def test_caches_until_expired(self):
+        pretix = FakePretix()
+        catalog = ItemCatalog(logging.getLogger("test"), ttl=3600)
+        self.assertIsNone(catalog.cached("org", "event"))
+
+        await asyncio.gather(catalog.get(pretix, "org", "event"), catalog.get(pretix, "org", "event"))
+        await catalog.get(pretix, "org", "event")
+        self.assertEqual(pretix.fetches, 1)
+
+        catalog.ttl = 0
+        await catalog.get(pretix, "org", "event")
+        self.assertEqual(pretix.fetches, 2)
+
+    async def test_webhook_refreshes_unknown_items(self):
+        pretix = FakePretix()
+        catalog = ItemCatalog(logging.getLogger("test"), ttl=3600)
+        catalog.put("org", "event", ITEMS)
+
+        catalog.refresh_if_needed(pretix, "org", "event", [1, None])
+        await asyncio.sleep(0)
+        self.assertEqual(pretix.fetches, 0)
+
+        pretix.items = ITEMS + [{"id": 3, "name": {"en": "Speaker"}, "variations": []}]
+        catalog.refresh_if_needed(pretix, "org", "event", [3])
+        await asyncio.gather(*catalog._refreshes)
+        self.assertEqual(pretix.fetches, 1)
+        self.assertEqual(catalog.describe("org", "event", FilterConditions("3")), "(item=3 Speaker)")
+
+    async def test_failed_fetch_is_not_retried_by_every_webhook(self):
+        pretix = FakePretix()
+        pretix.error = ConnectionError("pretix unavailable")
+        catalog = ItemCatalog(logging.getLogger("test"), ttl=3600, failure_ttl=60)
+
+        for _ in range(3):
+            catalog.refresh_if_needed(pretix, "org", "event", [1])
+            await asyncio.gather(*catalog._refreshes)
+        self.assertEqual(pretix.fetches, 1)
+        self.assertTrue(catalog.recently_failed("org", "event"))
+
+        # once the failure has expired, the next webhook tries again
+        catalog.failure_ttl = 0
+        pretix.error = None
+        catalog.refresh_if_needed(pretix, "org", "event", [1])
+        await asyncio.gather(*catalog._refreshes)
+        self.assertEqual(pretix.fetches, 2)
+        self.assertFalse(catalog.recently_failed("org", "event"))
+
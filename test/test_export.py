@@ -0,0 +1,86 @@
+import unittest
+import csv
+import io
+import logging
+from event_helper.export import export_attendees, attendee_rows, csv_safe, EXPORT_HEADERS
+from event_helper.pretix import AttendeeMatrixInformation
+
+
+class FakePretix:
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.fetched = 0
+
+    def plan_for(self, organizer, event):
+        return None
+
+    def iter_order_pages(self, organizer, event):
+        for page in self.pages:
+            self.fetched += 1
+            yield page
+
+    def extract_answers(self, data, filter_processed=False, plan=None):
+        return data
+
+
+class TestExport(unittest.IsolatedAsyncioTestCase):
+
+    def rooms_for(self, attendee):
+        return ["!all:test", "!vip:test"] if attendee.order_code == "B" else ["!all:test"]
+
+    def test_rows(self):
+        memberships = {"!all:test": ({"@a:example.org"}, set()), "!vip:test": (set(), set())}
+        rows = list(attendee_rows([
+            AttendeeMatrixInformation("A", "a:example.org"),
+            AttendeeMatrixInformation("B", "@b:example.org"),
+            AttendeeMatrixInformation("C", "not valid"),
+        ], self.rooms_for, memberships, {("!vip:test", "@b:example.org")}))
+
+        self.assertEqual(rows[0], ["A", "a:example.org", "valid", "!all:test", "joined"])
+        self.assertEqual(rows[1], ["B", "'@b:example.org", "valid", "!all:test !vip:test", "not invited retrying"])
+        self.assertEqual(rows[2][2], "invalid: a matrix ID cannot contain spaces")
+        self.assertEqual(rows[2][4], "invalid")
+
+    def test_formulas_are_escaped(self):
+        rows = list(attendee_rows([
+            AttendeeMatrixInformation("A", '=HYPERLINK("https://example.org")'),
+            AttendeeMatrixInformation("B", "+1"),
+            AttendeeMatrixInformation("C", "-1"),
+        ], self.rooms_for, {}, set()))
+        self.assertEqual([row[1] for row in rows], ["'=HYPERLINK(\"https://example.org\")", "'+1", "'-1"])
+        self.assertEqual(csv_safe("plain"), "plain")
+
+    def test_rows_match_the_invite_path(self):
+        memberships = {"!all:test": (set(), set())}
+        rows = list(attendee_rows([
+            AttendeeMatrixInformation("A", " @a:example.org"),
+            AttendeeMatrixInformation("C", "@c:example.org"),
+        ], self.rooms_for, memberships, set(), lambda matrix_id, room: matrix_id == "@c:example.org"))
+
+        self.assertEqual(rows[0][2:], ["valid", "!all:test", "not invited"])
+        self.assertEqual(rows[1][4], "invited")
+
+    async def test_streams_pages(self):
+        pretix = FakePretix([
+            [AttendeeMatrixInformation("A", "@a:example.org")],
+            [AttendeeMatrixInformation("B", "@b:example.org")],
+        ])
+        lookups = []
+
+        async def membership_for(room):
+            lookups.append(room)
+            return set(), {"@b:example.org"}
+
+        chunks = []
+        async for chunk in export_attendees(pretix, "org", "event", self.rooms_for, membership_for, set(),
+                                            logging.getLogger("test")):
+            chunks.append(chunk)
+            # pages are fetched as the export is consumed
+            self.assertEqual(pretix.fetched, len(chunks) - 1)
+
+        rows = list(csv.reader(io.StringIO("".join(chunks))))
+        self.assertEqual(rows[0], EXPORT_HEADERS)
+        self.assertEqual([r[4] for r in rows[1:]], ["not invited", "invited invited"])
+        # each room is looked up once
+        self.assertEqual(sorted(lookups), ["!all:test", "!vip:test"])
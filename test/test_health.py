@@ -0,0 +1,73 @@
+import unittest
+import asyncio
+import logging
+from mautrix.api import HTTPAPI
+from mautrix.types import EventType, PowerLevelStateEventContent
+from event_helper.health import HealthChecks, probe_room_permissions
+from event_helper.matrix_utils import MatrixUtils
+
+
+class FakeRoomState:
+    def __init__(self, power_levels):
+        self.power_levels = power_levels
+
+    async def get_state_event(self, room_id, event_type, state_key=""):
+        return self.power_levels
+
+
+class TestHealthChecks(unittest.IsolatedAsyncioTestCase):
+
+    async def test_results_are_cached_and_shared(self):
+        health = HealthChecks(logging.getLogger("test"), ttl=30)
+        runs = []
+
+        async def probe():
+            runs.append(1)
+            await asyncio.sleep(0.01)
+            return True, "fine"
+
+        first, second = await asyncio.gather(health.check("a", probe), health.check("a", probe))
+        third = await health.check("a", probe)
+        self.assertEqual(len(runs), 1)
+        self.assertTrue(first.ok and second.ok and third.ok)
+
+        health.ttl = 0
+        await health.check("a", probe)
+        self.assertEqual(len(runs), 2)
+
+    async def test_failures_and_timeouts(self):
+        health = HealthChecks(logging.getLogger("test"), timeout=0.01)
+
+        async def broken():
+            raise ValueError("nope")
+
+        async def slow():
+            await asyncio.sleep(1)
+            return True, "fine"
+
+        results = await health.check_all({"broken": broken, "slow": slow})
+        self.assertFalse(results["broken"].ok)
+        self.assertIn("nope", results["broken"].detail)
+        self.assertFalse(results["slow"].ok)
+
+
+class TestRoomPermissions(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.api = HTTPAPI("https://matrix.example.org")
+        self.utils = MatrixUtils(self.api, logging.getLogger("test"))
+
+    async def check(self, users, set_power_levels=False):
+        power_levels = PowerLevelStateEventContent(users=users, invite=50, events={EventType.ROOM_POWER_LEVELS: 100})
+        self.utils.room_methods = FakeRoomState(power_levels)
+        self.utils.invalidate_room_state("!room:example.org")
+        return await probe_room_permissions(self.utils, "!room:example.org", "@bot:example.org", set_power_levels)
+
+    async def test_permissions(self):
+        self.assertTrue((await self.check({"@bot:example.org": 50}))[0])
+        self.assertFalse((await self.check({"@bot:example.org": 0}))[0])
+        self.assertFalse((await self.check({"@bot:example.org": 50}, set_power_levels=True))[0])
+        self.assertTrue((await self.check({"@bot:example.org": 100}, set_power_levels=True))[0])
+
+    async def asyncTearDown(self):
+        await self.api.session.close()
@@ -0,0 +1,25 @@
+import unittest
+import logging
+from event_helper.logutil import SampledLogger
+
+
+class TestSampledLogger(unittest.TestCase):
+
+    def test_samples_debug_messages(self):
+        logger = logging.getLogger("test.sampled")
+        logger.setLevel(logging.DEBUG)
+        sampled = SampledLogger(logger, every=3)
+        with self.assertLogs(logger, logging.DEBUG) as logs:
+            for i in range(7):
+                sampled.debug("attendee %d", i)
+        self.assertEqual([r.getMessage() for r in logs.records], ["attendee 0", "attendee 3", "attendee 6"])
+
+    def test_skips_formatting_when_disabled(self):
+        logger = logging.getLogger("test.sampled.off")
+        logger.setLevel(logging.INFO)
+
+        class Expensive:
+            def __str__(self):
+                raise AssertionError("formatted although debug logging is off")
+
+        SampledLogger(logger).debug("members: %s", Expensive())
@@ -0,0 +1,219 @@
+import unittest
+import asyncio
+import logging
+from mautrix.api import HTTPAPI
+from mautrix.errors import MNotFound
+from mautrix.types import (
+    EventType, PowerLevelStateEventContent, MemberStateEventContent, Membership, StateEvent, RoomDirectoryVisibility,
+)
+from event_helper.matrix_utils import MatrixUtils, UserInfo
+
+
+class FakeMatrix:
+    """stands in for both the room and event methods of the mautrix client"""
+
+    def __init__(self, state):
+        self.state = state
+        self.gets = 0
+        self.sent = []
+
+    async def get_state_event(self, room_id, event_type, state_key=""):
+        self.gets += 1
+        await asyncio.sleep(0)
+        return PowerLevelStateEventContent.deserialize(self.state[event_type].serialize())
+
+    async def send_state_event(self, room_id, event_type, content, state_key=""):
+        await asyncio.sleep(0)
+        self.sent.append((event_type, content))
+        self.state[event_type] = content
+
+
+class TestPowerLevels(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.matrix = FakeMatrix({EventType.ROOM_POWER_LEVELS: PowerLevelStateEventContent.deserialize(
+            {"users": {"@admin:test": 100}, "events": {"m.room.name": 50}, "ban": 75}
+        )})
+        self.api = HTTPAPI("https://matrix.test")
+        self.utils = MatrixUtils(self.api, logging.getLogger("test"))
+        self.utils.room_methods = self.matrix
+        self.utils.event_methods = self.matrix
+
+    async def test_batches_changes_and_keeps_other_fields(self):
+        await self.utils.ensure_room_power_levels("!room:test", {
+            "@a:test": UserInfo(power_level=10),
+            "@b:test": UserInfo(power_level=10),
+            "@c:test": UserInfo(power_level=None),
+        })
+
+        self.assertEqual(len(self.matrix.sent), 1)
+        content = self.matrix.sent[0][1]
+        self.assertEqual(content.users, {"@admin:test": 100, "@a:test": 10, "@b:test": 10})
+        self.assertEqual(content.ban, 75)
+        self.assertEqual(content.serialize()["events"], {"m.room.name": 50})
+
+    async def test_skips_write_when_unchanged(self):
+        await self.utils.ensure_room_power_levels("!room:test", {"@admin:test": UserInfo(power_level=100)})
+        await self.utils.ensure_room_power_levels("!room:test", {"@nobody:test": UserInfo(power_level=0)})
+
+        self.assertEqual(self.matrix.sent, [])
+        # the second call was answered from the cache
+        self.assertEqual(self.matrix.gets, 1)
+
+    async def test_concurrent_changes_are_all_kept(self):
+        await asyncio.gather(
+            self.utils.ensure_room_power_levels("!room:test", {"@a:test": UserInfo(power_level=10)}),
+            self.utils.ensure_room_power_levels("!room:test", {"@b:test": UserInfo(power_level=10)}),
+        )
+        self.assertEqual(self.matrix.state[EventType.ROOM_POWER_LEVELS].users,
+                         {"@admin:test": 100, "@a:test": 10, "@b:test": 10})
+
+    async def test_keeps_changes_made_after_caching(self):
+        await self.utils.get_room_state("!room:test", EventType.ROOM_POWER_LEVELS)
+        # an admin changes the power levels while the old ones are cached
+        self.matrix.state[EventType.ROOM_POWER_LEVELS].users["@mod:test"] = 50
+
+        await self.utils.ensure_room_power_levels("!room:test", {"@a:test": UserInfo(power_level=10)})
+        self.assertEqual(self.matrix.sent[0][1].users, {"@admin:test": 100, "@mod:test": 50, "@a:test": 10})
+
+    async def asyncTearDown(self):
+        await self.api.session.close()
+
+
+class FakeMembers:
+    """answers the membership endpoints of a room without a full member list"""
+
+    def __init__(self, memberships):
+        self.memberships = memberships
+        self.calls = []
+        self.invited = []
+
+    async def get_joined_members(self, room_id):
+        self.calls.append("joined_members")
+        return {user: None for user, m in self.memberships.items() if m == Membership.JOIN}
+
+    async def get_members(self, room_id, membership=None, not_membership=None):
+        self.calls.append(f"members?membership={membership}")
+        return [
+            StateEvent.deserialize({
+                "type": "m.room.member", "room_id": room_id, "event_id": f"${user}", "sender": user,
+                "origin_server_ts": 0, "state_key": user, "content": {"membership": str(m)},
+            })
+            for user, m in self.memberships.items() if m == membership
+        ]
+
+    async def get_state_event(self, room_id, event_type, state_key=""):
+        self.calls.append(f"state/{event_type}/{state_key}")
+        if state_key not in self.memberships:
+            raise MNotFound(404, "no member event")
+        return MemberStateEventContent(membership=self.memberships[state_key])
+
+    async def invite_user(self, room_id, user_id):
+        self.invited.append(user_id)
+
+
+class FakeDirectory:
+    def __init__(self, visibility):
+        self.visibility = visibility
+        self.sets = []
+
+    async def get_room_directory_visibility(self, room_id):
+        return self.visibility
+
+    async def set_room_directory_visibility(self, room_id, visibility):
+        self.sets.append(visibility)
+        self.visibility = visibility
+
+
+class TestVisibility(unittest.IsolatedAsyncioTestCase):
+
+    async def test_skips_write_when_unchanged(self):
+        api = HTTPAPI("https://matrix.test")
+        utils = MatrixUtils(api, logging.getLogger("test"))
+        utils.room_methods = FakeDirectory(RoomDirectoryVisibility.PRIVATE)
+        try:
+            await utils.ensure_room_visibility("!room:test", "private")
+            await utils.ensure_room_visibility("!room:test", "public")
+            await utils.ensure_room_visibility("!room:test", "public")
+        finally:
+            await api.session.close()
+        self.assertEqual(utils.room_methods.sets, [RoomDirectoryVisibility.PUBLIC])
+
+
+class TestMembership(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.matrix = FakeMembers({
+            "@joined:test": Membership.JOIN, "@invited:test": Membership.INVITE, "@left:test": Membership.LEAVE,
+        })
+        self.api = HTTPAPI("https://matrix.test")
+        self.utils = MatrixUtils(self.api, logging.getLogger("test"))
+        self.utils.room_methods = self.matrix
+        self.utils.event_methods = self.matrix
+
+    async def test_room_membership_uses_filtered_endpoints(self):
+        members, invitees = await self.utils.get_room_membership("!room:test")
+        self.assertEqual(members, {"@joined:test"})
+        self.assertEqual(invitees, {"@invited:test"})
+        self.assertEqual(self.matrix.calls, ["joined_members", "members?membership=invite"])
+
+    async def test_few_invitees_are_checked_individually(self):
+        await self.utils.ensure_room_invitees("!room:test", {
+            "@joined:test": UserInfo(power_level=None),
+            "@left:test": UserInfo(power_level=None),
+            "@new:test": UserInfo(power_level=None),
+        })
+        self.assertEqual(self.matrix.invited, ["@left:test", "@new:test"])
+        self.assertNotIn("joined_members", self.matrix.calls)
+
+    async def test_many_invitees_use_the_member_list(self):
+        self.utils.single_lookup_limit = 1
+        await self.utils.get_room_membership("!room:test")
+        await self.utils.ensure_room_invitees("!room:test", {
+            "@joined:test": UserInfo(power_level=None),
+            "@new:test": UserInfo(power_level=None),
+        })
+        self.assertEqual(self.matrix.invited, ["@new:test"])
+        self.assertEqual(self.matrix.calls.count("joined_members"), 2)
+        # the new invite is remembered for cached lookups
+        members, invitees = await self.utils.get_room_membership("!room:test")
+        self.assertIn("@new:test", invitees)
+
+    async def test_failed_member_lookup_fails_every_invite(self):
+        async def unavailable(room_id):
+            raise ConnectionError("homeserver unavailable")
+        self.matrix.get_joined_members = unavailable
+        self.utils.single_lookup_limit = 0
+
+        failures = await self.utils.ensure_room_invitees("!room:test", {
+            "@a:test": UserInfo(power_level=None), "@b:test": UserInfo(power_level=None),
+        })
+        self.assertEqual(set(failures), {"@a:test", "@b:test"})
+        self.assertIsInstance(failures["@a:test"], ConnectionError)
+        self.assertEqual(self.matrix.invited, [])
+
+    async def test_restored_membership_is_revalidated_once(self):
+        self.utils.restore_caches({}, {"!room:test": [["@old:test"], []]})
+        members, invitees = await self.utils.get_room_membership("!room:test")
+        # served from the snapshot right away, then fetched again in the background
+        self.assertEqual(members, {"@old:test"})
+        await asyncio.gather(*self.utils._revalidations)
+        members, invitees = await self.utils.get_room_membership("!room:test")
+        self.assertEqual(members, {"@joined:test"})
+        self.assertEqual(self.matrix.calls.count("joined_members"), 1)
+
+    async def test_export_and_restore_caches(self):
+        await self.utils.get_room_membership("!room:test")
+        aliases, members = self.utils.export_caches()
+        self.assertEqual(members, {"!room:test": [["@joined:test"], ["@invited:test"]]})
+
+        restored = MatrixUtils(self.api, logging.getLogger("test"))
+        restored.restore_caches({"#room:test": "!room:test"}, members)
+        self.assertEqual(restored.export_caches(), ({"#room:test": "!room:test"}, members))
+
+    async def asyncTearDown(self):
+        await self.api.session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
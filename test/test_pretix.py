@@ -1,6 +1,6 @@
 import unittest
 import json
-from event_helper.pretix import Pretix, AttendeeMatrixInformation, question_id_to_header
+from event_helper.pretix import Pretix, PretixPool, AnswerPlan, AttendeeMatrixInformation, question_id_to_header
 import logging
 class TestPretix(unittest.TestCase):
 
@@ -13,10 +13,87 @@ class TestPretix(unittest.TestCase):
         self.assertEqual(question_id_to_header("matrix"), "Matrix ID")
         # self.assertEqual(question_id_to_header("matrix"), "Matrix ID")
 
+    def test_answer_plan(self):
+        plan = AnswerPlan.compile({"matrix": "matrix_id", "pronouns": "pronouns"})
+        self.assertEqual(plan.headers, {"matrix_id": "Matrix ID", "pronouns": "pronouns"})
+        # the matrix question is always extracted
+        self.assertEqual(AnswerPlan.compile({}).headers, {"matrix": "Matrix ID"})
+
+    def test_extract_answers_with_event_questions(self):
+        pt = Pretix("12345", "67890", "redirect", logging.Logger("Test"))
+        pt.configure_questions({"matrix": "matrix"}, {"fedora/flock": {"matrix": "chat", "pronouns": "pronouns"}})
+        order = {"email": "a@example.com", "positions": [{"order": "ABC", "answers": [
+            {"question_identifier": "chat", "answer": "@a:example.com"},
+            {"question_identifier": "pronouns", "answer": "they/them"},
+        ]}]}
+
+        attendees = pt.extract_answers([order], plan=pt.plan_for("fedora", "flock"))
+        self.assertEqual(attendees, [AttendeeMatrixInformation("ABC", "@a:example.com")])
+        self.assertEqual(attendees[0].extra["pronouns"], "they/them")
+
+        # other events keep using the default questions
+        attendees = pt.extract_answers([order], plan=pt.plan_for("fedora", "other"))
+        self.assertEqual(attendees[0].matrix_id, "")
+
     def test_parse_url(self):
         self.assertEqual(Pretix.parse_invite_url("https://pretix.eu/fedora/matrix-test"), ("fedora", "matrix-test"))
 
 
+    def test_rooms_are_tracked_until_order_is_processed(self):
+        pt = Pretix("12345", "67890", "redirect", logging.Logger("Test"))
+        self.assertFalse(pt.order_rooms_done("ABC"))
+        pt.route_order("ABC", ["!a:test", "#b:test"])
+        pt.mark_room_processed("ABC", "!a:test")
+        self.assertEqual(pt.processed_rooms("ABC"), {"!a:test"})
+        self.assertFalse(pt.order_rooms_done("ABC"))
+        pt.mark_room_processed("ABC", "#b:test")
+        self.assertTrue(pt.order_rooms_done("ABC"))
+        self.assertFalse(pt.is_processed("ABC"))
+
+        pt.mark_codes_as_processed(["ABC"])
+        self.assertTrue(pt.is_processed("ABC"))
+        self.assertEqual(pt.processed_rooms("ABC"), set())
+
+    def test_room_progress_survives_a_restart(self):
+        pt = Pretix("12345", "67890", "redirect", logging.Logger("Test"))
+        pt.route_order("ABC", ["!a:test", "#b:test"])
+        pt.mark_room_processed("ABC", "!a:test")
+        pt.mark_room_processed("DEF", "!a:test")
+
+        restarted = Pretix("12345", "67890", "redirect", logging.Logger("Test"))
+        restarted.mark_codes_as_processed(["DEF"])
+        restarted.restore_room_progress(pt.room_progress())
+        self.assertEqual(restarted.processed_rooms("ABC"), {"!a:test"})
+        self.assertFalse(restarted.order_rooms_done("ABC"))
+        restarted.mark_room_processed("ABC", "#b:test")
+        self.assertTrue(restarted.order_rooms_done("ABC"))
+        # orders that were processed in the meantime are not tracked again
+        self.assertEqual(restarted.processed_rooms("DEF"), set())
+
+    def test_fetch_data_filters_server_side(self):
+        pt = Pretix("12345", "67890", "redirect", logging.Logger("Test"), instance_url="https://test.domain")
+        requests = []
+
+        class FakeResponse:
+            content = b'{"results": [], "next": null}'
+
+            def raise_for_status(self):
+                pass
+
+        def fake_get(url, **kwargs):
+            requests.append((url, kwargs))
+            return FakeResponse()
+
+        pt._get = fake_get
+        pt.fetch_data("fedora", "flock", item="5")
+        url, kwargs = requests[0]
+        self.assertEqual(url, "https://test.domain/api/v1/organizers/fedora/events/flock/orders/")
+        self.assertEqual(kwargs["params"]["status"], "p")
+        self.assertEqual(kwargs["params"]["testmode"], "false")
+        self.assertEqual(kwargs["params"]["item"], "5")
+        self.assertNotIn("variation", kwargs["params"])
+        self.assertIn("positions.answers", kwargs["params"]["include"])
+
     def test_extract_answers(self):
         response = """
 {
@@ -148,5 +225,28 @@ class TestPretix(unittest.TestCase):
         client = Pretix("http://localhost:8000", "1234", "5678", "http://localhost:8000")
         attendee = AttendeeMatrixInformation("PNKYZ", "@brodie:matrixbots.tinystage.test")
         self.assertEqual(client.extract_answers([resp]), [attendee])
+
+class TestPretixPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = PretixPool(logging.Logger("Test"))
+        self.eu = Pretix("1", "2", "redirect", logging.Logger("Test"), instance_url="https://pretix.eu")
+        self.own = Pretix("3", "4", "redirect", logging.Logger("Test"), instance_url="https://tickets.example.org/")
+        self.pool.add(self.eu)
+        self.pool.add(self.own, organizers=["example"])
+
+    def test_for_url(self):
+        self.assertEqual(self.pool.for_url("https://pretix.eu/fedora/flock"), (self.eu, "fedora", "flock"))
+        self.assertEqual(self.pool.for_url("https://tickets.example.org/other/meetup/"), (self.own, "other", "meetup"))
+        self.assertRaises(ValueError, self.pool.for_url, "https://unknown.test/fedora/flock")
+
+    def test_for_organizer(self):
+        self.assertIs(self.pool.for_organizer("example"), self.own)
+        self.assertIs(self.pool.for_organizer("fedora"), self.eu)
+        # organizers seen in an invite url are remembered
+        self.pool.for_url("https://tickets.example.org/other/meetup/")
+        self.assertIs(self.pool.for_organizer("other"), self.own)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,62 @@
+import unittest
+import asyncio
+from event_helper.provision import plan_rooms, provision_rooms, slugify, RoomSpec
+
+ITEMS = [
+    {"id": 1, "name": {"en": "Main Conference"}, "variations": []},
+    {"id": 2, "name": {"de": "Workshop"}, "variations": [
+        {"id": 20, "value": {"en": "Rust 101"}},
+        {"id": 21, "value": {"en": "Packaging"}},
+    ]},
+]
+
+
+class FakeMatrixUtils:
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+
+    async def ensure_room_with_alias(self, alias):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0)
+        self.running -= 1
+        if "broken" in alias:
+            raise ValueError("alias in use")
+        return f"!{alias[1:]}"
+
+    async def ensure_room_name(self, room_id, name):
+        pass
+
+    async def ensure_room_visibility(self, room_id, visibility):
+        pass
+
+
+class TestProvision(unittest.IsolatedAsyncioTestCase):
+
+    def test_slugify(self):
+        self.assertEqual(slugify("Rust 101: Intro!"), "rust-101-intro")
+
+    def test_plan_rooms(self):
+        specs = plan_rooms("flock", ITEMS, "example.org")
+        self.assertEqual(specs, [
+            RoomSpec("#flock-main-conference:example.org", "Main Conference", "1"),
+            RoomSpec("#flock-workshop-rust-101:example.org", "Workshop - Rust 101", "2", "20"),
+            RoomSpec("#flock-workshop-packaging:example.org", "Workshop - Packaging", "2", "21"),
+        ])
+        self.assertEqual(len(plan_rooms("flock", ITEMS, "example.org", item_ids=["2"])), 2)
+
+    async def test_provision_rooms(self):
+        matrix_utils = FakeMatrixUtils()
+        specs = [RoomSpec(f"#room{i}:test", "Room", "1") for i in range(5)]
+        specs.append(RoomSpec("#broken:test", "Room", "1"))
+
+        results = await provision_rooms(matrix_utils, specs, "private", concurrency=2)
+
+        self.assertEqual(len([r for r in results if r.ok]), 5)
+        self.assertIsInstance(results[-1].error, ValueError)
+        self.assertLessEqual(matrix_utils.max_running, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
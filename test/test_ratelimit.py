@@ -0,0 +1,122 @@
+import unittest
+import requests
+from event_helper.ratelimit import RateLimiter, CircuitBreaker, CircuitOpenError, TokenBucket, parse_retry_after
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_response(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return response
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_waits_when_empty(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, 1, clock=clock, sleep=clock.sleep)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertAlmostEqual(sum(clock.sleeps), 0.5)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_and_half_opens(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpenError, breaker.before_request)
+
+        clock.now += 10
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.before_request()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_lets_one_trial_through(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        clock.now += 10
+
+        self.assertTrue(breaker.before_request())
+        # everyone else keeps failing fast while the trial is in flight
+        self.assertRaises(CircuitOpenError, breaker.before_request)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        clock.now += 10
+        self.assertTrue(breaker.before_request())
+        breaker.release_trial()
+        self.assertTrue(breaker.before_request())
+        breaker.record_success()
+        self.assertFalse(breaker.before_request())
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(rate=100, burst=100, max_retries=2, failure_threshold=3,
+                                   clock=self.clock, sleep=self.clock.sleep)
+
+    def test_honours_retry_after(self):
+        responses = [make_response(429, {"Retry-After": "3"}), make_response(200)]
+        response = self.limiter.request(lambda: responses.pop(0))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(3.0, self.clock.sleeps)
+
+    def test_waits_for_long_retry_after_in_full(self):
+        responses = [make_response(429, {"Retry-After": "90"}), make_response(200)]
+        response = self.limiter.request(lambda: responses.pop(0))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.clock.sleeps, [90.0])
+
+    def test_returns_429_when_retry_after_is_too_long(self):
+        responses = [make_response(429, {"Retry-After": "3600"}), make_response(200)]
+        response = self.limiter.request(lambda: responses.pop(0))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_gives_up_after_retries(self):
+        response = self.limiter.request(lambda: make_response(503))
+        self.assertEqual(response.status_code, 503)
+        # the failures opened the circuit, so the next call fails fast
+        self.assertRaises(CircuitOpenError, self.limiter.request, lambda: make_response(200))
+
+    def test_trial_is_released_when_it_raises(self):
+        self.limiter.breaker.record_failure()
+        self.limiter.breaker.record_failure()
+        self.limiter.breaker.record_failure()
+        self.clock.now += 60
+
+        def fail():
+            raise ValueError("not a connection error")
+        self.assertRaises(ValueError, self.limiter.request, fail)
+        self.assertEqual(self.limiter.request(lambda: make_response(200)).status_code, 200)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("5"), 5.0)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+        self.assertIsNone(parse_retry_after("soon"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+import logging
+from event_helper import EventRooms, Room, FilterConditions
+from event_helper.pretix import AttendeeMatrixInformation
+from event_helper.reconcile import Reconciler
+
+
+class FakePretix:
+    has_token = True
+
+    def __init__(self, orders):
+        self.orders = orders
+        self.processed = []
+        self.fetches = []
+
+    def fetch_data(self, organizer, event, order_code=None, modified_since=None, item=None, variation=None):
+        self.fetches.append((organizer, event, modified_since))
+        return self.orders
+
+    def plan_for(self, organizer, event):
+        return None
+
+    def extract_answers(self, data, filter_processed=False, plan=None):
+        return [a for a in data if a.order_code not in self.processed]
+
+    def mark_as_processed(self, rows):
+        self.processed.extend(r.order_code for r in rows)
+
+
+class TestReconciler(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.mapping = EventRooms(persist_filename="rooms_reconcile_test.json")
+        self.mapping.add_object("org", "event", Room("!all:test"))
+        self.mapping.add_object("org", "event", Room("!vip:test", FilterConditions("1")))
+        self.invites = []
+
+    async def invite(self, room, attendees, organizer=None, event=None):
+        self.invites.append((room, [a.order_code for a in attendees]))
+        return []
+
+    async def test_routes_by_ticket(self):
+        pretix = FakePretix([
+            AttendeeMatrixInformation("A", "@a:test", {"Item ID": 1, "Variation ID": None}),
+            AttendeeMatrixInformation("B", "@b:test", {"Item ID": 2, "Variation ID": None}),
+        ])
+        reconciler = Reconciler(lambda organizer: pretix, self.mapping, self.invite, logging.getLogger("test"))
+        await reconciler.sweep()
+
+        self.assertIn(("!all:test", ["A", "B"]), self.invites)
+        self.assertIn(("!vip:test", ["A"]), self.invites)
+        self.assertEqual(sorted(pretix.processed), ["A", "B"])
+
+    async def test_routes_like_webhooks(self):
+        pretix = FakePretix([AttendeeMatrixInformation("A", "@a:test", {"Item ID": 3, "Variation ID": None})])
+
+        def rooms_for(organizer, event, attendee):
+            # no room is filtered on item 3, so it goes to every room of the event
+            return [room.matrix_id for room in self.mapping.rooms_by_event(organizer, event)]
+        reconciler = Reconciler(lambda organizer: pretix, self.mapping, self.invite, logging.getLogger("test"),
+                                rooms_for=rooms_for)
+        await reconciler.sweep()
+
+        self.assertEqual(sorted(self.invites), [("!all:test", ["A"]), ("!vip:test", ["A"])])
+        self.assertEqual(pretix.processed, ["A"])
+
+    async def test_second_run_only_fetches_changes(self):
+        pretix = FakePretix([AttendeeMatrixInformation("A", "@a:test")])
+        reconciler = Reconciler(lambda organizer: pretix, self.mapping, self.invite, logging.getLogger("test"))
+        await reconciler.sweep()
+        await reconciler.sweep()
+
+        self.assertIsNone(pretix.fetches[0][2])
+        self.assertIsNotNone(pretix.fetches[1][2])
+        # already processed attendees are not invited again
+        self.assertEqual(len(self.invites), 1)
+
+    async def test_watermarks_survive_a_restart(self):
+        pretix = FakePretix([AttendeeMatrixInformation("A", "@a:test")])
+        reconciler = Reconciler(lambda organizer: pretix, self.mapping, self.invite, logging.getLogger("test"))
+        await reconciler.sweep()
+
+        watermarks = reconciler.watermarks()
+        self.assertEqual(list(watermarks), ["org/event"])
+
+        restarted = Reconciler(lambda organizer: pretix, self.mapping, self.invite, logging.getLogger("test"))
+        restarted.restore_watermarks(watermarks)
+        await restarted.sweep()
+        self.assertEqual(pretix.fetches[1][2].isoformat(), watermarks["org/event"])
+
+    def tearDown(self):
+        self.mapping.persistfile.unlink()
+
+
+if __name__ == '__main__':
+    unittest.main()
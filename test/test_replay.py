@@ -0,0 +1,45 @@
+import unittest
+import json
+import logging
+import tempfile
+from pathlib import Path
+from event_helper.replay import load_capture, percentile, replay
+
+
+def webhook(received_at, code, event="flock"):
+    return {"received_at": received_at, "query": {},
+            "body": {"organizer": "fedora", "event": event, "code": code, "action": "pretix.event.order.paid"}}
+
+
+class TestPercentile(unittest.TestCase):
+
+    def test_nearest_rank(self):
+        values = [float(v) for v in range(1, 101)]
+        self.assertEqual(percentile(values, 50), 50.0)
+        self.assertEqual(percentile(values, 99), 99.0)
+        self.assertEqual(percentile(values, 100), 100.0)
+        self.assertEqual(percentile([3.0], 90), 3.0)
+        self.assertEqual(percentile([], 50), 0.0)
+
+
+class TestReplay(unittest.IsolatedAsyncioTestCase):
+
+    def test_load_capture_sorts_by_arrival(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            capture = Path(tmp).joinpath("capture.jsonl")
+            capture.write_text("\n".join(json.dumps(e) for e in [webhook(2, "B"), webhook(1, "A")]) + "\n")
+            entries = load_capture(capture)
+        self.assertEqual([e["body"]["code"] for e in entries], ["A", "B"])
+
+    async def test_replay_at_max_speed(self):
+        entries = [webhook(0, "A"), webhook(1, "B", "summit"), webhook(1.5, "A"), webhook(30, "C")]
+        report = await replay(entries, speed=None, pretix_latency=0.01, matrix_latency=0, log=logging.getLogger("test"))
+
+        self.assertEqual(report.sent, 4)
+        self.assertEqual(len(report.latencies), 4)
+        self.assertEqual(sum(report.errors.values()), 0)
+        # the redelivery of A is only invited once, and not looked up again
+        self.assertEqual(report.invites, 3)
+        self.assertEqual(report.pretix_fetches, 3)
+        # replayed at once, not 30 seconds
+        self.assertLess(report.duration, 5)
@@ -0,0 +1,105 @@
+import unittest
+import logging
+import tempfile
+import time
+from pathlib import Path
+from mautrix.errors import MForbidden, MLimitExceeded, MUnknown
+from event_helper.retry import RetryQueue, RetryScheduler, RetryEntry, is_permanent
+
+
+class TestIsPermanent(unittest.TestCase):
+
+    def test_classifies_errors(self):
+        self.assertTrue(is_permanent(MForbidden(403, "not allowed")))
+        self.assertTrue(is_permanent(ValueError("invalid matrix id")))
+        self.assertFalse(is_permanent(MLimitExceeded(429, "slow down")))
+        self.assertFalse(is_permanent(MUnknown(502, "bad gateway")))
+        self.assertFalse(is_permanent(ConnectionError("connection reset")))
+
+
+class TestRetryScheduler(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tempdir.name)
+        self.queue = RetryQueue.from_path(persist_path=self.path)
+        self.failures = {}
+        self.invites = []
+        self.succeeded = []
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    async def invite(self, room_id, matrix_id):
+        self.invites.append((room_id, matrix_id))
+        if matrix_id in self.failures:
+            raise self.failures[matrix_id]
+
+    async def on_success(self, entry):
+        self.succeeded.append(entry.order_code)
+
+    def scheduler(self, **kwargs):
+        return RetryScheduler(self.queue, self.invite, logging.getLogger("test"), on_success=self.on_success,
+                              base_delay=0, **kwargs)
+
+    async def test_queues_only_transient_failures_and_persists(self):
+        scheduler = self.scheduler()
+        self.assertTrue(scheduler.record_failure("!room:test", "@a:test", "A", MUnknown(502, "bad gateway"),
+                                                 organizer="org", event="event"))
+        self.assertFalse(scheduler.record_failure("!room:test", "@b:test", "B", MForbidden(403, "no")))
+
+        await self.queue.flush()
+        reloaded = RetryQueue.from_path(persist_path=self.path)
+        self.assertEqual(len(reloaded), 1)
+        entry = reloaded.due()[0]
+        self.assertEqual((entry.matrix_id, entry.order_code, entry.event, entry.error),
+                         ("@a:test", "A", "event", "MUnknown"))
+
+    async def test_retries_until_success(self):
+        scheduler = self.scheduler()
+        scheduler.record_failure("!room:test", "@a:test", "A", MUnknown(502, "bad gateway"))
+        self.failures["@a:test"] = MUnknown(503, "still down")
+
+        await scheduler.retry_due()
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue.due()[0].attempts, 2)
+
+        del self.failures["@a:test"]
+        await scheduler.retry_due()
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.succeeded, ["A"])
+
+    async def test_gives_up(self):
+        scheduler = self.scheduler(max_attempts=2)
+        scheduler.record_failure("!room:test", "@a:test", "A", MUnknown(502, "bad gateway"))
+        scheduler.record_failure("!room:test", "@b:test", "B", MUnknown(502, "bad gateway"))
+        self.failures["@a:test"] = MUnknown(502, "bad gateway")
+        self.failures["@b:test"] = MForbidden(403, "user is banned")
+
+        await scheduler.retry_due()
+        # permanent errors are dropped right away
+        self.assertEqual([e.matrix_id for e in self.queue.due()], ["@a:test"])
+        await scheduler.retry_due()
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.succeeded, [])
+
+    async def test_writes_once_per_pass(self):
+        scheduler = self.scheduler()
+        writes = []
+        write = self.queue._write
+        self.queue._write = lambda data: (writes.append(len(data)), write(data))
+        for n in range(10):
+            scheduler.record_failure("!room:test", f"@{n}:test", str(n), MUnknown(502, "bad gateway"), persist=False)
+            self.failures[f"@{n}:test"] = MUnknown(502, "bad gateway")
+        self.queue.persist_soon()
+
+        await scheduler.retry_due()
+        await self.queue.flush()
+        self.assertEqual(writes, [10])
+        self.assertEqual(RetryQueue.from_path(persist_path=self.path).due()[0].attempts, 2)
+
+    async def test_waits_for_backoff(self):
+        scheduler = self.scheduler()
+        self.queue.add(RetryEntry("!room:test", "@a:test", "A", attempts=1, next_attempt=time.time() + 60))
+        await scheduler.retry_due()
+        self.assertEqual(self.invites, [])
@@ -0,0 +1,38 @@
+import unittest
+import asyncio
+from event_helper.scheduler import PriorityScheduler, INTERACTIVE, BULK
+
+
+class TestPriorityScheduler(unittest.IsolatedAsyncioTestCase):
+
+    async def test_limits_bulk_work(self):
+        scheduler = PriorityScheduler(capacity=4, bulk_limit=2)
+        peak = []
+
+        async def job(priority):
+            async with scheduler.slot(priority):
+                peak.append(dict(scheduler.running))
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(job(BULK) for _ in range(5)), *(job(INTERACTIVE) for _ in range(5)))
+        self.assertTrue(all(p.get(BULK, 0) <= 2 for p in peak))
+        self.assertTrue(all(sum(p.values()) <= 4 for p in peak))
+
+    async def test_webhooks_go_before_waiting_bulk_chunks(self):
+        scheduler = PriorityScheduler(capacity=1, bulk_limit=1)
+        order = []
+
+        async def bulk_job():
+            # a bulk job made of chunks, each in its own slot
+            for chunk in range(3):
+                async with scheduler.slot(BULK):
+                    order.append(f"bulk {chunk}")
+                    await asyncio.sleep(0.01)
+
+        async def webhook():
+            await asyncio.sleep(0.005)
+            async with scheduler.slot(INTERACTIVE):
+                order.append("webhook")
+
+        await asyncio.gather(bulk_job(), webhook())
+        self.assertEqual(order, ["bulk 0", "webhook", "bulk 1", "bulk 2"])
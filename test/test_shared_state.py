@@ -0,0 +1,89 @@
+import unittest
+import logging
+import tempfile
+from pathlib import Path
+from mautrix.util.async_db import Database
+from event_helper.pretix import Pretix
+from event_helper.shared_state import SharedState, upgrade_table
+
+
+class TestSharedState(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        url = f"sqlite://{Path(self.tmpdir.name).joinpath('shared.db')}"
+        log = logging.getLogger("test")
+        # two replicas sharing one database
+        self.a = SharedState(Database.create(url, upgrade_table=upgrade_table), log, owner="a")
+        await self.a.start()
+        self.b = SharedState(Database.create(url, upgrade_table=upgrade_table), log, owner="b")
+        await self.b.start()
+
+    async def test_job_claimed_once(self):
+        self.assertTrue(await self.a.claim_job("org/event/ABC/paid", 300))
+        self.assertFalse(await self.b.claim_job("org/event/ABC/paid", 300))
+
+        # released jobs can be claimed by anyone, completed ones cannot
+        await self.a.release_job("org/event/ABC/paid")
+        self.assertTrue(await self.b.claim_job("org/event/ABC/paid", 300))
+        await self.b.complete_job("org/event/ABC/paid")
+        self.assertFalse(await self.a.claim_job("org/event/ABC/paid", 0))
+
+    async def test_expired_claim_can_be_taken_over(self):
+        self.assertTrue(await self.a.claim_job("job", 300))
+        self.assertTrue(await self.b.claim_job("job", -1))
+
+    async def test_processed_orders_are_shared(self):
+        await self.a.mark_processed("org", "event", ["ABC", "DEF"])
+        await self.a.mark_processed("org", "event", ["ABC"])
+        self.assertEqual(await self.b.processed_codes("org", "event"), {"ABC", "DEF"})
+        self.assertTrue(await self.b.is_processed("org", "event", "ABC"))
+        self.assertFalse(await self.b.is_processed("org", "other", "ABC"))
+
+    async def test_order_rooms_are_shared(self):
+        await self.a.route_order("org", "event", "ABC", ["!a:test", "!b:test"])
+        await self.a.mark_room_processed("org", "event", "ABC", "!a:test")
+        # a room done by a retry that was never routed here does not count as routed
+        await self.b.mark_room_processed("org", "event", "ABC", "!c:test")
+        self.assertEqual(await self.b.room_progress("org", "event", "ABC"),
+                         {"routed": ["!a:test", "!b:test"], "processed": ["!a:test", "!c:test"]})
+
+        await self.b.mark_processed("org", "event", ["ABC"])
+        self.assertEqual(await self.a.room_progress("org", "event", "ABC"), {"routed": [], "processed": []})
+
+    async def test_room_mapping_is_shared(self):
+        await self.a.update_mapped_rooms(added=[("org", "event", '{"matrix_id":"!a:test"}'),
+                                                ("org", "event", '{"matrix_id":"!b:test"}')])
+        await self.b.update_mapped_rooms(removed=[("org", "event", '{"matrix_id":"!a:test"}')])
+        self.assertEqual(await self.a.mapped_rooms(), {("org", "event", '{"matrix_id":"!b:test"}')})
+
+    async def test_lease(self):
+        self.assertTrue(await self.a.acquire_lease("token-refresh", 30))
+        self.assertFalse(await self.b.acquire_lease("token-refresh", 30))
+        await self.a.release_lease("token-refresh")
+        self.assertTrue(await self.b.acquire_lease("token-refresh", 30))
+
+    async def test_newer_token_wins(self):
+        await self.a.store_token("pretix.eu", {"access_token": "new"}, 2)
+        await self.b.store_token("pretix.eu", {"access_token": "old"}, 1)
+        self.assertEqual(await self.b.load_token("pretix.eu"), ({"access_token": "new"}, 2))
+
+    async def test_shared_client_does_not_refresh_by_itself(self):
+        pretix = Pretix("12345", "67890", "redirect", logging.getLogger("test"),
+                        token_storage_path=Path(self.tmpdir.name))
+        self.a.share_tokens_of(pretix)
+        self.assertIsNone(pretix.oauth.auto_refresh_url)
+
+        # tokens received from other replicas keep it that way
+        pretix.set_token({"access_token": "a", "refresh_token": "r", "token_type": "Bearer",
+                          "scope": ["read"], "expires_in": 3600}, 1)
+        self.assertIsNone(pretix.oauth.auto_refresh_url)
+
+    async def asyncTearDown(self):
+        await self.a.stop()
+        await self.b.stop()
+        self.tmpdir.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+import asyncio
+from event_helper.singleflight import SingleFlight, KeyedLocks
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+
+    async def test_coalesces_concurrent_calls(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def fetch(key):
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return f"result {key}"
+
+        results = await asyncio.gather(
+            flight.do("a", lambda: fetch("a")),
+            flight.do("a", lambda: fetch("a")),
+            flight.do("b", lambda: fetch("b")),
+        )
+        self.assertEqual(results, ["result a", "result a", "result b"])
+        self.assertEqual(calls, ["a", "b"])
+        self.assertEqual(len(flight), 0)
+
+        # finished calls are not cached
+        await flight.do("a", lambda: fetch("a"))
+        self.assertEqual(calls, ["a", "b", "a"])
+
+    async def test_shares_exceptions(self):
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("nope")
+
+        results = await asyncio.gather(flight.do("a", fail), flight.do("a", fail), return_exceptions=True)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+
+class TestKeyedLocks(unittest.IsolatedAsyncioTestCase):
+
+    async def test_serializes_per_key(self):
+        locks = KeyedLocks()
+        running = {"a": 0, "b": 0}
+        overlap = []
+
+        async def work(key):
+            async with locks.hold(key):
+                running[key] += 1
+                overlap.append(dict(running))
+                await asyncio.sleep(0.01)
+                running[key] -= 1
+
+        await asyncio.gather(work("a"), work("a"), work("b"))
+        self.assertTrue(all(r["a"] <= 1 for r in overlap))
+        # different keys run at the same time
+        self.assertIn({"a": 1, "b": 1}, overlap)
+        self.assertEqual(len(locks), 0)
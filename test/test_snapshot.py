@@ -0,0 +1,41 @@
+import unittest
+import logging
+import tempfile
+from pathlib import Path
+from event_helper.snapshot import CacheSnapshot, SnapshotWriter
+
+
+class TestCacheSnapshot(unittest.IsolatedAsyncioTestCase):
+
+    def test_persist_restore(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshot = CacheSnapshot(
+                {"#room:example.org": "!room:example.org"},
+                {"!room:example.org": [["@a:example.org"], ["@b:example.org"]]},
+                {"pretix.eu": ["ABC12"]},
+                {"pretix.eu": {"DEF34": {"routed": ["!a:example.org", "!b:example.org"], "processed": ["!a:example.org"]}}},
+                {"fedora/flock": "2024-08-01T12:00:00+00:00"},
+                persist_path=Path(tmp),
+            )
+            snapshot.persist()
+            restored = CacheSnapshot.from_path(Path(tmp))
+
+            self.assertEqual(restored.to_json(), snapshot.to_json())
+            self.assertEqual([p.name for p in Path(tmp).iterdir()], ["cache_snapshot.json"])
+
+    def test_missing_snapshot_is_empty(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshot = CacheSnapshot.from_path(Path(tmp))
+        self.assertEqual(snapshot.aliases, {})
+        self.assertEqual(snapshot.processed, {})
+
+    async def test_writer_writes_collected_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = SnapshotWriter(
+                lambda: CacheSnapshot(processed={"pretix.eu": ["ABC12"]}, persist_path=Path(tmp)),
+                logging.getLogger("test"),
+            )
+            await writer.write()
+            restored = CacheSnapshot.from_path(Path(tmp))
+        self.assertEqual(restored.processed, {"pretix.eu": ["ABC12"]})
+        self.assertLess(restored.age, 5)
@@ -0,0 +1,33 @@
+import unittest
+import asyncio
+import logging
+import time
+from event_helper.watchdog import LoopWatchdog
+
+
+class TestLoopWatchdog(unittest.IsolatedAsyncioTestCase):
+
+    async def test_records_blocking_stage(self):
+        watchdog = LoopWatchdog(logging.getLogger("test"), threshold=0.05)
+        watchdog.start()
+
+        async def blocking_handler():
+            watchdog.mark("blocking handler")
+            time.sleep(0.2)
+
+        try:
+            await asyncio.sleep(0.05)
+            await asyncio.create_task(blocking_handler())
+            await asyncio.sleep(0.1)
+        finally:
+            watchdog.stop()
+
+        self.assertGreaterEqual(watchdog.stall_count, 1)
+        stall = watchdog.stalls[-1]
+        self.assertEqual(stall.stage, "blocking handler")
+        self.assertIn("blocking_handler", stall.stack)
+        self.assertGreaterEqual(watchdog.max_lag, 0.1)
+
+    def test_disabled_status(self):
+        watchdog = LoopWatchdog(logging.getLogger("test"))
+        self.assertEqual(watchdog.status(), ["Event loop watchdog: disabled"])